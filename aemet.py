@@ -0,0 +1,238 @@
+import logging
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+
+
+# Tiempo en segundos que se guarda cada tipo de dato. Las observaciones se actualizan cada hora
+# y las predicciones unas pocas veces al dia
+OBSERVATION_TTL = 600
+FORECAST_TTL = 3600
+
+
+class AemetClient():
+    """Cliente de la API OpenData de AEMET.
+
+       Usa una unica sesion HTTP con keep-alive para todas las peticiones y guarda cada respuesta
+       en una cache durante el tiempo que tarda AEMET en actualizar ese dato. Si varios threads
+       piden a la vez el mismo dato que no esta en la cache, solo uno hace la peticion y el resto
+       espera su resultado. Entre dos peticiones a la API siempre pasa al menos minInterval segundos
+       y nunca hay mas de maxPerHost peticiones a la vez contra un mismo host.
+
+       Args:
+            apiKey: la API key de AEMET
+            baseUrl: la url base de la API
+            timeout: tiempo maximo en segundos de cada peticion
+            minInterval: tiempo minimo en segundos entre dos peticiones a la API
+            maxPerHost: numero maximo de peticiones simultaneas a un mismo host
+    """
+
+    def __init__(self, apiKey, baseUrl="https://opendata.aemet.es/opendata/api/", timeout=10, minInterval=1.2, maxPerHost=4):
+
+        self.baseUrl = baseUrl
+        self.timeout = timeout
+        self.minInterval = minInterval
+
+        self.session = requests.Session()
+        # Keep a connection for each concurrent request to a host, the default pool only keeps 10
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(maxPerHost, 10))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({'cache-control': "no-cache"})
+        self.session.params = {'api_key': apiKey}
+
+        # key -> (expiration time, value)
+        self.cache = {}
+        # key -> Event of the request in progress
+        self.inFlight = {}
+        self.cacheLock = threading.Lock()
+
+        self.rateLock = threading.Lock()
+        self.nextRequestTime = 0
+
+        # host -> semaphore that limits the concurrent requests to the host
+        self.maxPerHost = maxPerHost
+        self.hostSemaphores = {}
+        self.hostLock = threading.Lock()
+
+    def validateResponse(self, response):
+        """Esta funcion se encarga de validar la respuesta recibida de la API
+        Args:
+           response: instancia del objeto Response de la libreria Requests.
+        Returns:
+           devuelve la respuesta decodificada en un diccionario o
+           en formato de texto plano si no se ha podido decodificar el Json.
+           devuelve un array con un 0 si el servidor devuelve error.
+
+        """
+
+        #Comprobamos el status code
+        status = response.status_code
+        #Si el status code empieza con 5 significa que el servidor ha devuelto un error
+        if str(status).startswith('5'):
+            logging.error('validateResponse: Server failure... Status code: %s', status)
+            #Salimos indicando fallo
+            return [0]
+
+        #Convertimos el resultado en un diccionario
+        try:
+            result = response.json()
+        #Si falla, devolvemos el resultado como texto plano
+        except ValueError:
+            result = response.text
+            logging.warning("validateResponse: the response could not be json decoded. Response: %s", result)
+
+        return result
+
+    def waitRateLimit(self):
+        """Wait until a new request to the API is allowed
+
+        Args:
+            ---
+        Returns:
+           it does not return anything
+
+        """
+        with self.rateLock:
+            now = time.time()
+            waitTime = self.nextRequestTime - now
+            self.nextRequestTime = max(now, self.nextRequestTime) + self.minInterval
+
+        if waitTime > 0:
+            time.sleep(waitTime)
+
+    def hostSlot(self, url):
+        """Get the semaphore that limits the concurrent requests to the host of the url
+
+        Args:
+            url: the url to request
+        Returns:
+            a semaphore to be used in a with statement around the request
+
+        """
+        host = urlparse(url).netloc
+        with self.hostLock:
+            semaphore = self.hostSemaphores.get(host)
+            if semaphore is None:
+                semaphore = self.hostSemaphores[host] = threading.BoundedSemaphore(self.maxPerHost)
+
+        return semaphore
+
+    def get(self, url, **kwargs):
+        """Make a GET request with the session, waiting if there are already maxPerHost requests to the host
+
+        Args:
+            url: the url to request
+            kwargs: extra arguments for requests
+        Returns:
+            the Response
+
+        """
+        with self.hostSlot(url):
+            return self.session.get(url, timeout=self.timeout, **kwargs)
+
+    def request(self, path):
+        """Request a resource of the API. AEMET answers with the url where the data can be downloaded,
+           so two requests are made: the metadata and then the data
+
+        Args:
+            path: the path of the resource, relative to the base url
+        Returns:
+            the decoded data or None if it could not be retrieved
+
+        """
+        try:
+            self.waitRateLimit()
+            response = self.get(self.baseUrl + path)
+            jsonResponse = self.validateResponse(response)
+
+            if not isinstance(jsonResponse, dict) or jsonResponse.get("estado") != 200:
+                logging.error("AemetClient request: The request failed. path: %s. Response: %s", path, jsonResponse)
+                return
+
+            # The data url does not need the api key. The document is decoded once downloaded, not as a
+            # stream: the standard library has no incremental JSON parser and each document is a few KB
+            datosUrl = jsonResponse["datos"]
+            datos = self.validateResponse(self.get(datosUrl, params={'api_key': None}))
+
+            if not isinstance(datos, list) or not datos:
+                logging.error("AemetClient request: The data could not be retrieved. path: %s", path)
+                return
+
+            return datos
+
+        except requests.RequestException as e:
+            logging.error("AemetClient request: Exception when requesting the path: %s. Exception: %s", path, e)
+
+    def cached(self, key, ttl, path):
+        """Get a resource from the cache or request it if it has expired.
+           Concurrent calls for the same key wait for the same request
+
+        Args:
+            key: the cache key
+            ttl: number of seconds the resource is kept in the cache
+            path: the path of the resource, relative to the base url
+        Returns:
+            the decoded data or None if it could not be retrieved
+
+        """
+        while True:
+            with self.cacheLock:
+                entry = self.cache.get(key)
+                if entry and entry[0] > time.time():
+                    return entry[1]
+
+                event = self.inFlight.get(key)
+                # Nobody is requesting it, this thread makes the request
+                if event is None:
+                    event = self.inFlight[key] = threading.Event()
+                    break
+
+            # Wait for the request in progress and check the cache again
+            event.wait(self.timeout * 2 + self.minInterval)
+            with self.cacheLock:
+                entry = self.cache.get(key)
+                if entry and entry[0] > time.time():
+                    return entry[1]
+                # The request failed, do not retry it from every waiting thread
+                if self.inFlight.get(key) is not event:
+                    return
+
+        value = None
+        try:
+            value = self.request(path)
+        finally:
+            with self.cacheLock:
+                if value is not None:
+                    self.cache[key] = (time.time() + ttl, value)
+                del self.inFlight[key]
+            event.set()
+
+        return value
+
+    def getObservation(self, idema):
+        """Get the observations of the last hours of a weather station
+
+        Args:
+            idema: the identifier of the station
+        Returns:
+            a list with the observations or None if they could not be retrieved
+
+        """
+        return self.cached(("observation", idema), OBSERVATION_TTL, "observacion/convencional/datos/estacion/%s" % idema)
+
+    def getForecast(self, municipio):
+        """Get the daily forecast of a municipality
+
+        Args:
+            municipio: the identifier of the municipality
+        Returns:
+            the forecast or None if it could not be retrieved
+
+        """
+        datos = self.cached(("forecast", municipio), FORECAST_TTL, "prediccion/especifica/municipio/diaria/%s" % municipio)
+
+        if datos:
+            return datos[0]
@@ -0,0 +1,335 @@
+"""Agregacion de las muestras de los dispositivos.
+
+La ingesta agrega cada muestra al llegar con RunningAggregate, que ocupa lo mismo sin importar
+cuantas muestras se reciban. DeviceSamples y aggregate() (con aggregateVectorized si numpy esta
+instalado, o aggregateSamples si no) agregan series ya guardadas: los usa RetentionEngine para
+compactar cada hora de la tabla data, y los usan tambien las pruebas (como referencia del
+resultado de RunningAggregate) y benchmarks/bench_aggregation.py y bench_memory.py.
+"""
+import heapq
+import logging
+from array import array
+from collections import namedtuple
+
+# Numpy es opcional, si no esta instalado se agrega cada dispositivo por separado
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Result of the aggregation of the samples of a device. mean, minimum, maximum and last
+# are lists with a value for each feature, in the same order as they were saved
+Aggregate = namedtuple('Aggregate', ['timestamp', 'mean', 'minimum', 'maximum', 'last', 'count'])
+
+
+class DeviceSamples():
+    """Muestras de un dispositivo guardadas por columnas.
+
+       Cada columna es un array de doubles, por lo que cada muestra ocupa 8 bytes por valor
+       en lugar de una lista con sus floats. Los arrays crecen de forma amortizada.
+       Se utiliza para agregar series ya guardadas con aggregate().
+
+       Attributes:
+            timestamps: array con el timestamp de cada muestra
+            columns: lista con un array por cada valor de la muestra, en el mismo orden en que se han recibido
+    """
+
+    def __init__(self):
+
+        # Doubles, the reception timestamps have decimals and an epoch keeps microsecond precision
+        self.timestamps = array('d')
+        self.columns = []
+
+    def append(self, timestamp, values):
+        """Add a new sample
+
+        Args:
+            timestamp: the timestamp of the sample
+            values: a list with the values of the sample
+        Returns:
+           Does not return anything
+        Raises:
+           ValueError or TypeError if any of the values is not a number
+
+        """
+        # Convert the values before storing anything, so an invalid value does not leave the columns unaligned
+        values = [float(value) for value in values]
+        timestamp = float(timestamp)
+
+        # The number of columns is fixed by the first sample
+        if not self.columns:
+            self.columns = [array('d') for _ in values]
+
+        for column, value in zip(self.columns, values):
+            column.append(value)
+
+        self.timestamps.append(timestamp)
+
+    def last(self):
+        """Get the last sample
+
+        Args:
+            ---
+        Returns:
+           a list with the timestamp and the values of the last sample
+
+        """
+        return [int(self.timestamps[-1])] + [column[-1] for column in self.columns]
+
+    def __len__(self):
+        """Number of samples"""
+
+        return len(self.timestamps)
+
+
+class RunningAggregate():
+    """Agregado de las muestras de un dispositivo que se actualiza con cada muestra.
+
+       Solo guarda la suma de cada valor ponderada por el tiempo, el minimo, el maximo
+       y la ultima muestra, por lo que ocupa lo mismo sin importar cuantas muestras se reciban.
+       El resultado es el mismo que el de aggregate() sobre las mismas muestras ordenadas.
+
+       Las muestras se retienen durante reorderWindow segundos (respecto al timestamp mas nuevo
+       recibido) antes de sumarlas, para poder ordenar las que llegan desordenadas. Las que llegan
+       con un timestamp anterior al de la ultima muestra ya sumada no se pueden colocar en su
+       intervalo, por lo que solo se tienen en cuenta para el minimo, el maximo y el numero de
+       muestras, y se cuentan en late.
+
+       Args:
+            reorderWindow: segundos que se retiene cada muestra para ordenarla. Con 0 se suman al llegar
+    """
+
+    def __init__(self, reorderWindow=0):
+
+        self.reorderWindow = reorderWindow
+        self.count = 0
+        self.late = 0
+
+        # Heap of (timestamp, sequence, values) with the samples inside the reorder window
+        self.pending = []
+        self.sequence = 0
+        self.newestTimestamp = None
+
+    def add(self, timestamp, values):
+        """Add a new sample
+
+        Args:
+            timestamp: the timestamp of the sample
+            values: a list with the values of the sample
+        Returns:
+           Does not return anything
+        Raises:
+           ValueError or TypeError if any of the values is not a number
+
+        """
+        values = [float(value) for value in values]
+        timestamp = float(timestamp)
+
+        if self.reorderWindow <= 0:
+            self.integrate(timestamp, values)
+            return
+
+        # The sequence keeps the arrival order of the samples with the same timestamp
+        self.sequence += 1
+        heapq.heappush(self.pending, (timestamp, self.sequence, values))
+
+        if self.newestTimestamp is None or timestamp > self.newestTimestamp:
+            self.newestTimestamp = timestamp
+
+        # Add the samples that are already out of the window, in order
+        limit = self.newestTimestamp - self.reorderWindow
+        while self.pending and self.pending[0][0] <= limit:
+            timestamp, _, values = heapq.heappop(self.pending)
+            self.integrate(timestamp, values)
+
+    def flush(self):
+        """Add all the samples retained in the reorder window"""
+
+        while self.pending:
+            timestamp, _, values = heapq.heappop(self.pending)
+            self.integrate(timestamp, values)
+
+    def integrate(self, timestamp, values):
+        """Add a sample to the weighted sums, the minimum and the maximum
+
+        Args:
+            timestamp: the timestamp of the sample, as a float
+            values: a list with the values of the sample, as floats
+        Returns:
+           Does not return anything
+
+        """
+        # First sample
+        if not self.count:
+            self.firstTimestamp = timestamp
+            self.lastTimestamp = timestamp
+            self.last = values
+            self.weightedSums = [0.0] * len(values)
+            self.minimum = list(values)
+            self.maximum = list(values)
+            self.count = 1
+            return
+
+        self.count += 1
+        for index, value in enumerate(values):
+            if value < self.minimum[index]:
+                self.minimum[index] = value
+            if value > self.maximum[index]:
+                self.maximum[index] = value
+
+        # Out of order sample
+        if timestamp < self.lastTimestamp:
+            self.late += 1
+            return
+
+        # The last value has been valid until this sample
+        deltaTime = timestamp - self.lastTimestamp
+        for index, value in enumerate(self.last):
+            self.weightedSums[index] += deltaTime * value
+
+        self.lastTimestamp = timestamp
+        self.last = values
+
+    def result(self):
+        """Get the aggregate of the samples added until now
+
+        Args:
+            ---
+        Returns:
+            an Aggregate with the result or None if no sample has been added.
+            If no time has transcurred between the first and last samples, the mean is
+            the last value and the timestamp the one of the last sample.
+
+        """
+        # The samples still in the reorder window are the newest ones, nothing more will arrive
+        self.flush()
+
+        if not self.count:
+            return
+
+        # Calculate the elapsed time between the extremes values
+        totalTime = self.lastTimestamp - self.firstTimestamp
+
+        # If not time has transcurred return the last value
+        if totalTime <= 0:
+            logging.warning('RunningAggregate: the time transcurred between the data points is not valid. totalTime: %s.', totalTime)
+            return Aggregate(int(self.lastTimestamp), list(self.last), list(self.minimum), list(self.maximum), list(self.last), self.count)
+
+        mean = [weightedSum / totalTime for weightedSum in self.weightedSums]
+
+        return Aggregate(int(self.firstTimestamp), mean, list(self.minimum), list(self.maximum), list(self.last), self.count)
+
+    def __len__(self):
+        """Number of samples"""
+
+        return self.count + len(self.pending)
+
+
+def aggregate(generation):
+    """Calculate the weighted arithmetic mean, considering the time elapsed between each point,
+       and the minimum, maximum and last value of every feature for all the devices
+
+    Args:
+        generation: a dict with the DeviceSamples of each device, indexed by deviceId
+    Returns:
+        a dict with an Aggregate for each device with data, indexed by deviceId.
+        If no time has transcurred between the first and last samples of a device or the data is
+        not ordered, the mean is the last value and the timestamp the one of the last sample.
+
+    """
+    devices = [(deviceId, samples) for deviceId, samples in generation.items() if samples]
+
+    if not devices:
+        return {}
+
+    if numpy is not None:
+        return aggregateVectorized(devices)
+
+    return dict((deviceId, aggregateSamples(samples)) for deviceId, samples in devices)
+
+
+def aggregateSamples(samples):
+    """Aggregate the samples of a single device
+
+    Args:
+        samples: a not empty DeviceSamples instance
+    Returns:
+        an Aggregate with the result
+
+    """
+    timestamps = samples.timestamps
+
+    minimum = [min(column) for column in samples.columns]
+    maximum = [max(column) for column in samples.columns]
+    last = [column[-1] for column in samples.columns]
+
+    # Calculate the elapsed time between the extremes values
+    totalTime = timestamps[-1] - timestamps[0]
+
+    # If not time has transcurred or the data is not ordered, return the last value
+    if totalTime <= 0:
+        logging.warning('aggregateSamples: the time transcurred between the data points is not valid. totalTime: %s.', totalTime)
+        return Aggregate(int(timestamps[-1]), last, minimum, maximum, last, len(samples))
+
+    # Time elapsed between each point and the next one
+    deltaTimes = [nextTimestamp - timestamp for timestamp, nextTimestamp in zip(timestamps, timestamps[1:])]
+
+    # Calculate the average value of each feature considering the time elapsed between each point
+    mean = []
+    for column in samples.columns:
+        agregatedValue = sum(deltaTime * value for deltaTime, value in zip(deltaTimes, column))
+        mean.append(agregatedValue / totalTime)
+
+    return Aggregate(int(timestamps[0]), mean, minimum, maximum, last, len(samples))
+
+
+def aggregateVectorized(devices):
+    """Aggregate all the devices at once with numpy. The samples of every device are concatenated
+       and each reduction is done by segments, one segment per device
+
+    Args:
+        devices: a list of (deviceId, DeviceSamples) tuples, the samples must not be empty
+    Returns:
+        a dict with an Aggregate for each device, indexed by deviceId
+
+    """
+    counts = numpy.array([len(samples) for _, samples in devices])
+    starts = numpy.zeros(len(devices), dtype=numpy.intp)
+    numpy.cumsum(counts[:-1], out=starts[1:])
+    ends = starts + counts - 1
+
+    # The arrays are read without copying them, only the concatenation copies the data
+    timestamps = numpy.concatenate([numpy.frombuffer(samples.timestamps, dtype=numpy.float64) for _, samples in devices])
+    features = len(devices[0][1].columns)
+    values = numpy.empty((len(timestamps), features))
+    for feature in range(features):
+        values[:, feature] = numpy.concatenate([numpy.frombuffer(samples.columns[feature], dtype=numpy.float64) for _, samples in devices])
+
+    # Time elapsed between each point and the next one. The last point of each device has no next point
+    deltaTimes = numpy.zeros(len(timestamps))
+    deltaTimes[:-1] = numpy.diff(timestamps)
+    deltaTimes[ends] = 0
+
+    totalTimes = timestamps[ends] - timestamps[starts]
+
+    weightedSums = numpy.add.reduceat(deltaTimes[:, None] * values, starts, axis=0)
+    minimums = numpy.minimum.reduceat(values, starts, axis=0)
+    maximums = numpy.maximum.reduceat(values, starts, axis=0)
+    lasts = values[ends]
+
+    # If not time has transcurred or the data is not ordered, use the last value
+    valid = totalTimes > 0
+    means = lasts.copy()
+    means[valid] = weightedSums[valid] / totalTimes[valid][:, None]
+    aggregateTimestamps = numpy.where(valid, timestamps[starts], timestamps[ends])
+
+    if not valid.all():
+        logging.warning('aggregateVectorized: the time transcurred between the data points is not valid for %s devices.', len(valid) - valid.sum())
+
+    result = {}
+    rows = zip(aggregateTimestamps.tolist(), means.tolist(), minimums.tolist(), maximums.tolist(), lasts.tolist(), counts.tolist())
+    for (deviceId, _), (timestamp, mean, minimum, maximum, last, count) in zip(devices, rows):
+        result[deviceId] = Aggregate(int(timestamp), mean, minimum, maximum, last, count)
+
+    return result
@@ -0,0 +1,111 @@
+import logging
+import threading
+import time
+from collections import deque
+
+from ingest import receivedTimestamp
+
+
+class MessageBatcher():
+    """Agrupa los mensajes MQTT para procesarlos por lotes fuera del thread de red.
+
+       El callback del MQTT solo guarda el topic, el payload y el momento de recepcion (el epoch
+       y el reloj monotono, para medir la latencia) en una cola, sin decodificar nada. Un thread consumidor saca los mensajes en lotes de hasta
+       maxBatch mensajes, o los que haya cada maxDelay segundos, y los pasa juntos al handler.
+       Si la cola llega a maxSize mensajes los nuevos se descartan y se cuentan en dropped.
+
+       Args:
+            handler: funcion que recibe una lista de tuplas (topic, payload, receivedTimestamp, receivedMonotonic)
+            maxBatch: numero maximo de mensajes de cada lote
+            maxDelay: tiempo maximo en segundos que espera un mensaje antes de procesarse
+            maxSize: numero maximo de mensajes en la cola
+    """
+
+    def __init__(self, handler, maxBatch=500, maxDelay=0.05, maxSize=100000):
+
+        self.handler = handler
+        self.maxBatch = maxBatch
+        self.maxDelay = maxDelay
+        self.maxSize = maxSize
+
+        # Only the MQTT thread appends and only the consumer pops, both are atomic in a deque
+        self.pending = deque()
+        self.wakeup = threading.Event()
+        self.stopEvent = threading.Event()
+
+        self.processed = 0
+        self.batches = 0
+        self.dropped = 0
+
+        self.thread = threading.Thread(target=self.run, name="MessageBatcher")
+        self.thread.daemon = True
+
+    def start(self):
+        """Start the consumer thread"""
+
+        self.thread.start()
+
+    def on_message(self, client, userdata, msg):
+        """MQTT callback that queues the message without processing it
+
+        Args:
+            client: the client instance for this callback
+            userdata: the private user data as set in Client() or userdata_set()
+            msg: an instance of MQTTMessage. This is a class with members topic, payload, qos, retain.
+        Returns:
+           Does not return anything
+
+        """
+        pending = self.pending
+        if len(pending) >= self.maxSize:
+            self.dropped += 1
+            return
+
+        pending.append((msg.topic, msg.payload, receivedTimestamp(), time.monotonic()))
+
+        # Wake up the consumer as soon as there is a full batch
+        if len(pending) == self.maxBatch:
+            self.wakeup.set()
+
+    def run(self):
+        """Take the queued messages in batches and process them until the batcher is stopped
+
+        Args:
+            ---
+        Returns:
+           it does not return anything
+
+        """
+        while True:
+            stopping = self.stopEvent.is_set()
+
+            self.wakeup.wait(self.maxDelay)
+            self.wakeup.clear()
+
+            while self.pending:
+                batch = [self.pending.popleft() for _ in range(min(len(self.pending), self.maxBatch))]
+                try:
+                    self.handler(batch)
+                except Exception as e:
+                    logging.error("MessageBatcher run: Exception processing a batch of %s messages. Exception: %s", len(batch), e)
+
+                self.processed += len(batch)
+                self.batches += 1
+
+            # The messages queued before the stop have been processed
+            if stopping:
+                break
+
+    def stop(self, timeout=10):
+        """Stop the consumer after processing the messages already queued"""
+
+        self.stopEvent.set()
+        self.wakeup.set()
+
+        if self.thread.is_alive():
+            self.thread.join(timeout)
+
+    def __len__(self):
+        """Number of messages waiting to be processed"""
+
+        return len(self.pending)
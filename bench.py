@@ -0,0 +1,598 @@
+import json
+import logging
+import os
+import queue
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from array import array
+
+import paho.mqtt.client as mqtt
+
+import decoding
+
+
+# Escenarios de la prueba: rafagas cada burstEvery segundos y reconexiones cada reconnectEvery segundos
+SCENARIOS = {
+    "steady": {},
+    "burst": {"burstEvery": 2.0, "burstSize": 20000},
+    "reconnect": {"reconnectEvery": 2.0, "reconnects": 20},
+}
+SCENARIO_NAMES = ["steady", "burst", "reconnect"]
+
+# Numero maximo de tiempos de callback guardados para calcular los percentiles
+RESERVOIR_SIZE = 200000
+
+
+class FakeClient():
+    """Sustituto en memoria de paho.mqtt.client.Client para las pruebas de rendimiento.
+
+       Un thread de red, como el de loop_start() de paho, entrega los mensajes publicados por el
+       simulador a los callbacks registrados con message_callback_add y llama a on_connect,
+       on_subscribe y on_disconnect. Igual que un broker con QoS 0 y sesion limpia, los mensajes
+       que llegan sin conexion o antes de que se confirme la suscripcion se descartan, y las
+       suscripciones se pierden al desconectarse.
+
+       Mide el tiempo de cada callback de los mensajes, que es el tiempo que el thread de red de
+       paho no puede leer el socket.
+    """
+
+    def __init__(self, *args, **kwargs):
+
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_subscribe = None
+
+        # (topic filter, callback)
+        self.callbacks = []
+        self.subscriptions = set()
+        self.connected = False
+        self.mid = 0
+
+        self.events = queue.Queue()
+        self.thread = None
+
+        # Messages published by the application
+        self.published = []
+
+        # Metrics
+        self.delivered = 0
+        # topic filter -> messages delivered
+        self.deliveredBy = {}
+        self.dropped = 0
+        self.callbackCount = 0
+        self.callbackTimes = array('d')
+        self.maxCallbackTime = 0.0
+
+    def nextMid(self):
+        """Get the identifier of a new request"""
+
+        self.mid += 1
+        return self.mid
+
+    def connect(self, host, port=1883, keepalive=60):
+        """Queue the connection, on_connect is called from the network thread"""
+
+        self.events.put(("connect", 0))
+        return 0
+
+    def disconnect(self):
+        """Queue a requested disconnection"""
+
+        self.events.put(("disconnect", 0))
+        return 0
+
+    def reconnect(self, downtime=0.005):
+        """Simulate a lost connection followed by a new one
+
+        Args:
+            downtime: seconds until the client connects again. The messages published meanwhile are lost
+        Returns:
+           it does not return anything
+
+        """
+        self.events.put(("disconnect", 1))
+
+        timer = threading.Timer(downtime, self.events.put, [("connect", 0)])
+        timer.daemon = True
+        timer.start()
+
+    def loop_start(self):
+        """Start the network thread"""
+
+        self.thread = threading.Thread(target=self.run, name="FakeClient")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def loop_stop(self):
+        """Stop the network thread after the events already queued"""
+
+        self.events.put(("stop", None))
+        if self.thread is not None:
+            self.thread.join()
+
+    def subscribe(self, topic, qos=0):
+        """Subscribe to a topic filter. The shared subscription prefix is removed, there is a single subscriber
+
+        Args:
+            topic: the topic filter
+            qos: the quality of service
+        Returns:
+            a (result, mid) tuple, as paho does
+
+        """
+        if topic.startswith("$share/"):
+            topic = topic.split("/", 2)[2]
+
+        # The subscription is active once the broker confirms it
+        mid = self.nextMid()
+        self.events.put(("suback", (mid, topic)))
+        return mqtt.MQTT_ERR_SUCCESS, mid
+
+    def message_callback_add(self, sub, callback):
+        """Register the callback of a topic filter"""
+
+        self.callbacks.append((sub, callback))
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        """Record a message published by the application
+
+        Returns:
+            a (result, mid) tuple, as paho does
+
+        """
+        self.published.append((topic, payload))
+        return mqtt.MQTT_ERR_SUCCESS, self.nextMid()
+
+    def deliver(self, topic, payload):
+        """Queue a message from a device, it is delivered from the network thread"""
+
+        self.events.put(("message", (topic, payload)))
+
+    def run(self):
+        """Process the queued events until loop_stop is called
+
+        Args:
+            ---
+        Returns:
+           it does not return anything
+
+        """
+        while True:
+            event, value = self.events.get()
+            try:
+                self.handle(event, value)
+            except Exception as e:
+                # paho would stop its network thread, the benchmark keeps going and reports it
+                logging.error("FakeClient run: Exception processing a %s event. Exception: %s", event, e)
+            finally:
+                self.events.task_done()
+
+            if event == "stop":
+                break
+
+    def handle(self, event, value):
+        """Process an event of the network thread"""
+
+        if event == "message":
+            self.dispatch(*value)
+        elif event == "connect":
+            self.connected = True
+            if self.on_connect:
+                self.on_connect(self, None, {}, 0)
+        elif event == "suback":
+            mid, topic = value
+            if not self.connected:
+                return
+            self.subscriptions.add(topic)
+            if self.on_subscribe:
+                self.on_subscribe(self, None, mid, (0,))
+        elif event == "disconnect":
+            self.connected = False
+            self.subscriptions.clear()
+            if self.on_disconnect:
+                self.on_disconnect(self, None, value)
+
+    def dispatch(self, topic, payload):
+        """Call the callback of a message, measuring its time
+
+        Args:
+            topic: the topic of the message
+            payload: the bytes of the message
+        Returns:
+           it does not return anything
+
+        """
+        if not self.connected or not any(mqtt.topic_matches_sub(sub, topic) for sub in self.subscriptions):
+            self.dropped += 1
+            return
+
+        for sub, callback in self.callbacks:
+            if not mqtt.topic_matches_sub(sub, topic):
+                continue
+
+            message = mqtt.MQTTMessage(0, topic.encode())
+            message.payload = payload
+
+            startTime = time.perf_counter()
+            callback(self, None, message)
+            elapsedTime = time.perf_counter() - startTime
+
+            # Keep a uniform sample of the times with a bounded memory
+            self.deliveredBy[sub] = self.deliveredBy.get(sub, 0) + 1
+            self.callbackCount += 1
+            if len(self.callbackTimes) < RESERVOIR_SIZE:
+                self.callbackTimes.append(elapsedTime)
+            else:
+                index = random.randrange(self.callbackCount)
+                if index < RESERVOIR_SIZE:
+                    self.callbackTimes[index] = elapsedTime
+            if elapsedTime > self.maxCallbackTime:
+                self.maxCallbackTime = elapsedTime
+            break
+
+        self.delivered += 1
+
+    def wait(self):
+        """Wait until the network thread has processed every queued event"""
+
+        self.events.join()
+
+
+class DeviceFleet():
+    """Simulador de una flota de dispositivos que publican sus datos.
+
+       Cada dispositivo publica su configuracion al arrancar y despues mensajes realtime con el
+       mismo formato que procesa realtimeData (o el formato binario de realtimeBinaryData), a un
+       ritmo total de rate mensajes por segundo repartidos entre todos los dispositivos.
+
+       Args:
+            client: instancia de FakeClient donde se publican los mensajes
+            devices: numero de dispositivos
+            rate: mensajes por segundo de toda la flota
+            binary: fraccion de los mensajes que se envian en formato binario
+            timestamps: si es True los mensajes incluyen el timestamp del dispositivo
+            seed: semilla de los valores aleatorios, para que las pruebas sean reproducibles
+    """
+
+    def __init__(self, client, devices=1000, rate=5000, binary=0.0, timestamps=True, seed=0):
+
+        self.client = client
+        self.devices = devices
+        self.rate = rate
+        self.binary = binary
+        self.timestamps = timestamps
+        self.random = random.Random(seed)
+
+        self.sent = 0
+        self.next = 0
+
+    def confMessage(self, deviceId):
+        """Build the configuration message of a device"""
+
+        return "device/%s/conf" % deviceId, json.dumps({"deviceId": deviceId}).encode()
+
+    def realtimeMessage(self, deviceId):
+        """Build a realtime message of a device with random values
+
+        Args:
+            deviceId: the identifier of the device
+        Returns:
+            a (topic, payload) tuple
+
+        """
+        temperature = round(self.random.uniform(-5, 40), 2)
+        humidity = round(self.random.uniform(10, 100), 2)
+        rainPulses = self.random.randint(0, 3)
+        timestamp = int(time.time() * 1000) if self.timestamps else None
+
+        if self.random.random() < self.binary:
+            return "device/%s/realtime/bin" % deviceId, decoding.dumpsRealtimeBinary(deviceId, temperature, humidity, rainPulses, timestamp)
+
+        receivedData = {"deviceId": deviceId, "data": {"temperature": temperature, "humidity": humidity, "rainPulses": rainPulses}}
+        if timestamp is not None:
+            receivedData["timestamp"] = timestamp
+
+        return "device/%s/realtime" % deviceId, json.dumps(receivedData).encode()
+
+    def sendConf(self):
+        """Publish the configuration message of every device"""
+
+        for deviceId in range(self.devices):
+            self.client.deliver(*self.confMessage(deviceId))
+
+    def send(self, count):
+        """Publish the next count realtime messages, one device after another"""
+
+        for _ in range(count):
+            self.client.deliver(*self.realtimeMessage(self.next))
+            self.next = (self.next + 1) % self.devices
+        self.sent += count
+
+    def run(self, duration, burstEvery=0, burstSize=0, reconnectEvery=0, reconnects=0, tick=0.01):
+        """Publish messages at the configured rate for a number of seconds
+
+        Args:
+            duration: seconds to publish
+            burstEvery: optional, seconds between two bursts
+            burstSize: number of extra messages of each burst, published at once
+            reconnectEvery: optional, seconds between two reconnection storms
+            reconnects: number of reconnections of each storm
+            tick: seconds between two groups of messages
+        Returns:
+           it does not return anything
+
+        """
+        startTime = time.time()
+        nextBurst = startTime + burstEvery if burstEvery else None
+        nextReconnect = startTime + reconnectEvery if reconnectEvery else None
+        owed = 0.0
+        pendingReconnects = 0
+
+        while True:
+            now = time.time()
+            if now - startTime >= duration:
+                break
+
+            # The reconnections of a storm are spread over consecutive ticks, the messages of the tick are lost
+            if nextReconnect is not None and now >= nextReconnect:
+                pendingReconnects += reconnects
+                nextReconnect += reconnectEvery
+            if pendingReconnects:
+                self.client.reconnect()
+                pendingReconnects -= 1
+
+            # The messages due since the last tick
+            owed += self.rate * tick
+            count = int(owed)
+            owed -= count
+            self.send(count)
+
+            if nextBurst is not None and now >= nextBurst:
+                self.send(burstSize)
+                nextBurst += burstEvery
+
+            delay = startTime + tick * (int((now - startTime) / tick) + 1) - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+
+def percentiles(values, fractions=(0.5, 0.9, 0.99)):
+    """Get some percentiles of a list of values
+
+    Args:
+        values: an iterable with the values
+        fractions: the percentiles to calculate, between 0 and 1
+    Returns:
+        a dict with a pXX key for each percentile, or None values if there are no values
+
+    """
+    values = sorted(values)
+    result = {}
+    for fraction in fractions:
+        key = "p%g" % (fraction * 100)
+        result[key] = values[min(len(values) - 1, int(fraction * len(values)))] if values else None
+    return result
+
+
+def currentRss():
+    """Get the resident memory of the process in MB"""
+
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1048576.0
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def writeConfig(args):
+    """Write the config.ini of the benchmark in the working directory"""
+
+    with open("config.ini", "w") as configFile:
+        configFile.write("[AEMET]\napiKey = benchmark\n\n")
+        configFile.write("[INGEST]\nbatchSize = %s\nspool = %s\n\n" % (args.batchSize, "spool" if args.spool else ""))
+        configFile.write("[QUERY]\nport = 0\n\n")
+        configFile.write("[METRICS]\npublishInterval = 0\n\n")
+        configFile.write("[LOGGING]\nlevel = %s\n" % args.logLevel)
+
+
+def removeDatabase():
+    """Delete the database and the spool of a previous scenario"""
+
+    for path in ("carrascas.db", "carrascas.db-wal", "carrascas.db-shm"):
+        if os.path.exists(path):
+            os.remove(path)
+    shutil.rmtree("spool", ignore_errors=True)
+
+
+def runScenario(carrascas, name, args, options):
+    """Run a scenario with a new Carrascas instance connected to a FakeClient
+
+    Args:
+        carrascas: the carrascas module
+        name: the name of the scenario
+        args: the parsed command line arguments
+        options: a dict with the burst and reconnection options of the scenario
+    Returns:
+        a dict with the results
+
+    """
+    removeDatabase()
+
+    instance = carrascas.Carrascas(weather=False, queryPort=0)
+    client = instance.client
+
+    # Wait until the database is open and the topics are subscribed
+    while getattr(instance, 'pendingSubscriptions', None) is None or instance.pendingSubscriptions:
+        time.sleep(0.01)
+
+    fleet = DeviceFleet(client, args.devices, args.rate, args.binary, not args.noTimestamps, args.seed)
+    fleet.sendConf()
+
+    # Flush the buffer every flushInterval seconds while the fleet publishes, measuring until the commit
+    flushTimes = []
+    stopFlush = threading.Event()
+
+    def flush():
+        committed = threading.Event()
+
+        startTime = time.perf_counter()
+        generation, spoolGroup = instance.dataBuffer.swap()
+
+        def onCommit():
+            if instance.spool is not None:
+                instance.spool.release(spoolGroup)
+            committed.set()
+
+        instance.saveGeneration(generation, onCommit)
+        committed.wait()
+        flushTimes.append(time.perf_counter() - startTime)
+
+    def flushLoop():
+        while not stopFlush.wait(args.flushInterval):
+            flush()
+
+    flusher = threading.Thread(target=flushLoop, name="BenchmarkFlush")
+    flusher.start()
+
+    cpuStart = time.process_time()
+    startTime = time.time()
+    fleet.run(args.duration, **options)
+    publishTime = time.time() - startTime
+
+    # Wait until every message has been delivered and, with the batcher, processed
+    client.wait()
+    realtime = sum(client.deliveredBy.get(topic, 0) for topic in (instance.topicRealtime, instance.topicRealtimeBinary))
+    if instance.batcher is not None:
+        while instance.batcher.processed < realtime:
+            time.sleep(0.005)
+    elapsedTime = time.time() - startTime
+    cpuTime = time.process_time() - cpuStart
+
+    stopFlush.set()
+    flusher.join()
+    flush()
+
+    stats = instance.getStats()
+    metrics = instance.metrics.snapshot()
+
+    stopStart = time.time()
+    instance.stop()
+    stopTime = time.time() - stopStart
+
+    rows = instance.db.select('''SELECT count(*) FROM data''', [], scalar=1)
+    instance.db.close()
+
+    callbackTimes = [value * 1e6 for value in client.callbackTimes]
+    received = stats["received"]
+    commitTime = metrics.get("commit_seconds", {}).get("sum") or 0
+
+    result = {
+        "scenario": name,
+        "options": options,
+        "sent": fleet.sent,
+        "delivered": realtime,
+        "droppedByBroker": client.dropped,
+        "droppedByBatcher": stats.get("batchDropped", 0),
+        "received": received,
+        "publishSeconds": round(publishTime, 3),
+        "elapsedSeconds": round(elapsedTime, 3),
+        "throughput": round(received / elapsedTime, 1) if elapsedTime else None,
+        "cpuSeconds": round(cpuTime, 3),
+        "callbackLatencyUs": dict((key, round(value, 2) if value is not None else None) for key, value in percentiles(callbackTimes).items()),
+        "maxCallbackLatencyUs": round(client.maxCallbackTime * 1e6, 2),
+        "processingLatency": metrics.get("callback_latency_seconds"),
+        "flushes": len(flushTimes),
+        "flushSeconds": dict((key, round(value, 4) if value is not None else None) for key, value in percentiles(flushTimes).items()),
+        "maxFlushSeconds": round(max(flushTimes), 4) if flushTimes else None,
+        "stopSeconds": round(stopTime, 3),
+        "rowsInData": rows,
+        "rowsWritten": stats.get("written", 0),
+        "commits": stats.get("commits", 0),
+        "rowsPerSecond": round(stats.get("written", 0) / commitTime, 1) if commitTime else None,
+        "rssMB": round(currentRss() or 0, 1),
+        "maxRssMB": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1),
+    }
+
+    return result
+
+
+def gitVersion(directory):
+    """Get the commit of the code being measured, or None if it is not a git repository"""
+
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], cwd=directory, stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    """Run the benchmark from the command line and write the results as JSON"""
+
+    import argparse
+    import tempfile
+
+    parser = argparse.ArgumentParser(description="Benchmark de la ingesta con una flota de dispositivos simulada")
+    parser.add_argument("--scenarios", default=",".join(SCENARIO_NAMES), help="escenarios separados por comas: %s" % ", ".join(SCENARIO_NAMES))
+    parser.add_argument("--devices", type=int, default=1000, help="numero de dispositivos")
+    parser.add_argument("--rate", type=int, default=5000, help="mensajes por segundo de toda la flota")
+    parser.add_argument("--duration", type=float, default=10, help="segundos que publica la flota en cada escenario")
+    parser.add_argument("--binary", type=float, default=0.0, help="fraccion de mensajes en formato binario")
+    parser.add_argument("--noTimestamps", action="store_true", help="los mensajes no incluyen el timestamp del dispositivo")
+    parser.add_argument("--batchSize", type=int, default=500, help="batchSize del MessageBatcher, 0 para procesar cada mensaje en el callback")
+    parser.add_argument("--flushInterval", type=float, default=1.0, help="segundos entre dos volcados a la base de datos")
+    parser.add_argument("--spool", type=int, default=1, help="1 para guardar las muestras en el spool, 0 para desactivarlo")
+    parser.add_argument("--logLevel", default="WARNING", help="nivel de logging de carrascas.log")
+    parser.add_argument("--seed", type=int, default=0, help="semilla de los valores aleatorios")
+    parser.add_argument("--directory", default=None, help="directorio de trabajo, por defecto uno temporal")
+    parser.add_argument("--output", default="bench-results.json", help="fichero JSON con los resultados")
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    for name in names:
+        if name not in SCENARIOS:
+            parser.error("Unknown scenario: %s" % name)
+
+    codeDirectory = os.path.dirname(os.path.abspath(__file__))
+    output = os.path.abspath(args.output)
+    directory = args.directory or tempfile.mkdtemp(prefix="carrascas-bench-")
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    # carrascas reads the config.ini and opens its files in the working directory
+    os.chdir(directory)
+    writeConfig(args)
+
+    import carrascas
+    carrascas.mqtt.Client = FakeClient
+
+    results = {
+        "version": gitVersion(codeDirectory),
+        "timestamp": int(time.time()),
+        "python": sys.version.split()[0],
+        "decoder": decoding.DECODER,
+        "cpus": os.cpu_count(),
+        "parameters": vars(args),
+        "scenarios": [],
+    }
+
+    for name in names:
+        print("Escenario %s..." % name)
+        result = runScenario(carrascas, name, args, SCENARIOS[name])
+        results["scenarios"].append(result)
+        print("  %s mensajes/s, callback p99 %s us, flush p99 %s s, %s filas" % (result["throughput"], result["callbackLatencyUs"]["p99"], result["flushSeconds"]["p99"], result["rowsInData"]))
+
+    with open(output, "w") as outputFile:
+        json.dump(results, outputFile, indent=2, sort_keys=True)
+
+    print("Resultados guardados en %s" % output)
+
+
+if __name__ == '__main__':
+    # Mide la ingesta con una flota simulada y un cliente MQTT en memoria:
+    #   python bench.py --devices 1000 --rate 5000 --duration 10 --output bench-results.json
+    main()
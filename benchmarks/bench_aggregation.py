@@ -0,0 +1,106 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aggregation
+from aggregation import DeviceSamples
+
+
+def originalMean(samples):
+    """The weighted mean of the original getDataFromBuffer, with a loop over every sample and feature
+
+    Args:
+        samples: a list of [timestamp, value, ...] lists
+    Returns:
+        a list with the timestamp and the mean of each value
+
+    """
+    totalTime = samples[-1][0] - samples[0][0]
+    if totalTime <= 0:
+        return samples[-1]
+
+    agregatedValues = [0.0] * (len(samples[0]) - 1)
+    for index, sample in enumerate(samples[:-1]):
+        deltaTime = samples[index + 1][0] - sample[0]
+        for feature, value in enumerate(sample[1:]):
+            agregatedValues[feature] += deltaTime * value
+
+    return [samples[0][0]] + [value / totalTime for value in agregatedValues]
+
+
+def buildGeneration(devices, samples, seed):
+    """Build the samples of every device, as lists and as DeviceSamples"""
+
+    rng = random.Random(seed)
+    lists = {}
+    generation = {}
+    for deviceId in range(devices):
+        timestamp = 1523700000
+        deviceLists = lists[deviceId] = []
+        deviceSamples = generation[deviceId] = DeviceSamples()
+        for _ in range(samples):
+            timestamp += rng.choice([1, 2, 5])
+            values = [rng.uniform(-5, 40), rng.uniform(10, 100), rng.randint(0, 3)]
+            deviceLists.append([timestamp] + values)
+            deviceSamples.append(timestamp, values)
+
+    return lists, generation
+
+
+def timeIt(function, repeat):
+    """Get the best time of several calls of a function, and its last result"""
+
+    best = None
+    for _ in range(repeat):
+        startTime = time.perf_counter()
+        result = function()
+        elapsedTime = time.perf_counter() - startTime
+        best = elapsedTime if best is None else min(best, elapsedTime)
+
+    return best, result
+
+
+def main():
+    """Run the benchmark from the command line"""
+
+    parser = argparse.ArgumentParser(description="Tiempo de la agregacion de las muestras de todos los dispositivos")
+    parser.add_argument("--devices", type=int, default=10000, help="numero de dispositivos")
+    parser.add_argument("--samples", type=int, default=60, help="muestras de cada dispositivo")
+    parser.add_argument("--repeat", type=int, default=3, help="repeticiones de cada medida, se muestra la mejor")
+    parser.add_argument("--seed", type=int, default=0, help="semilla de los valores aleatorios")
+    args = parser.parse_args()
+
+    lists, generation = buildGeneration(args.devices, args.samples, args.seed)
+
+    originalTime, original = timeIt(lambda: dict((deviceId, originalMean(samples)) for deviceId, samples in lists.items()), args.repeat)
+    perDeviceTime, perDevice = timeIt(lambda: dict((deviceId, aggregation.aggregateSamples(samples)) for deviceId, samples in generation.items()), args.repeat)
+    print("original          %8.3f s" % originalTime)
+    print("aggregateSamples  %8.3f s" % perDeviceTime)
+
+    results = [perDevice]
+    if aggregation.numpy is not None:
+        vectorizedTime, vectorized = timeIt(lambda: aggregation.aggregate(generation), args.repeat)
+        results.append(vectorized)
+        print("aggregate (numpy) %8.3f s, %.1fx mas rapido que el original" % (vectorizedTime, originalTime / vectorizedTime))
+    else:
+        print("aggregate (numpy) numpy no esta instalado")
+
+    # Every implementation must give the same mean as the original
+    maxError = 0.0
+    for result in results:
+        for deviceId, expected in original.items():
+            got = [result[deviceId].timestamp] + result[deviceId].mean
+            maxError = max(maxError, max(abs(a - b) for a, b in zip(expected, got)))
+    print("diferencia maxima con el original: %g" % maxError)
+
+    return 0 if maxError < 1e-6 else 1
+
+
+if __name__ == '__main__':
+    # Agrega 10000 dispositivos con 60 muestras cada uno:
+    #   python benchmarks/bench_aggregation.py --devices 10000 --samples 60
+    sys.exit(main())
@@ -0,0 +1,124 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import paho.mqtt.client as mqtt
+
+import bench
+from batching import MessageBatcher
+from bench import DeviceFleet, FakeClient, percentiles
+
+
+def measure(carrascas, batchSize, payloads):
+    """Get the throughput of a Carrascas instance processing the messages
+
+    Args:
+        carrascas: the carrascas module
+        batchSize: batchSize of the MessageBatcher, 0 to process each message in its callback
+        payloads: a list of (topic, payload) tuples with the realtime messages
+    Returns:
+        a dict with the results
+
+    """
+    bench.removeDatabase()
+    carrascas.config.set("INGEST", "batchSize", str(batchSize))
+
+    instance = carrascas.Carrascas(weather=False, queryPort=0)
+    client = instance.client
+    while getattr(instance, 'pendingSubscriptions', None) is None or instance.pendingSubscriptions:
+        time.sleep(0.01)
+
+    startTime = time.perf_counter()
+    for topic, payload in payloads:
+        client.deliver(topic, payload)
+    client.wait()
+    callbackTime = time.perf_counter() - startTime
+    if instance.batcher is not None:
+        while instance.batcher.processed < len(payloads):
+            time.sleep(0.001)
+    elapsedTime = time.perf_counter() - startTime
+
+    received = instance.received
+    stageThroughput = measureStage(instance, batchSize, payloads)
+    instance.stop()
+    instance.db.close()
+
+    callbackTimes = percentiles(client.callbackTimes)
+    return {"received": received,
+            "throughput": received / elapsedTime,
+            "stageThroughput": stageThroughput,
+            "callbackSeconds": callbackTime,
+            "p50": callbackTimes["p50"] * 1e6,
+            "p99": callbackTimes["p99"] * 1e6}
+
+
+def measureStage(instance, batchSize, payloads):
+    """Get the throughput of the ingest stage alone, calling the callbacks without the MQTT client
+
+    Args:
+        instance: a Carrascas instance
+        batchSize: batchSize of the MessageBatcher, 0 to call realtimeData for each message
+        payloads: a list of (topic, payload) tuples with the realtime messages
+    Returns:
+        the messages processed per second
+
+    """
+    messages = []
+    for topic, payload in payloads:
+        message = mqtt.MQTTMessage(0, topic.encode())
+        message.payload = payload
+        messages.append(message)
+
+    received = instance.received
+    startTime = time.perf_counter()
+
+    if batchSize > 0:
+        batcher = MessageBatcher(instance.processMessages, batchSize, maxSize=len(messages))
+        for message in messages:
+            batcher.on_message(None, None, message)
+        batcher.start()
+        batcher.stop(timeout=None)
+    else:
+        for message in messages:
+            if message.topic.endswith("/bin"):
+                instance.realtimeBinaryData(None, None, message)
+            else:
+                instance.realtimeData(None, None, message)
+
+    return (instance.received - received) / (time.perf_counter() - startTime)
+
+
+def main():
+    """Run the benchmark from the command line"""
+
+    parser = argparse.ArgumentParser(description="Mensajes por segundo procesando cada mensaje en su callback o por lotes")
+    parser.add_argument("--messages", type=int, default=200000, help="numero de mensajes realtime")
+    parser.add_argument("--devices", type=int, default=1000, help="numero de dispositivos")
+    parser.add_argument("--batchSizes", default="0,100,500", help="batchSize de cada medida, 0 procesa cada mensaje en su callback")
+    parser.add_argument("--binary", type=float, default=0.0, help="fraccion de mensajes en formato binario")
+    args = parser.parse_args()
+
+    # carrascas reads the config.ini and opens its files in the working directory
+    os.chdir(tempfile.mkdtemp(prefix="carrascas-bench-"))
+    bench.writeConfig(argparse.Namespace(batchSize=0, spool=0, logLevel="WARNING"))
+
+    import carrascas
+    carrascas.mqtt.Client = FakeClient
+
+    fleet = DeviceFleet(None, devices=args.devices, binary=args.binary)
+    payloads = [fleet.realtimeMessage(index % args.devices) for index in range(args.messages)]
+
+    print("%s mensajes de %s dispositivos" % (args.messages, args.devices))
+    for batchSize in [int(batchSize) for batchSize in args.batchSizes.split(",")]:
+        result = measure(carrascas, batchSize, payloads)
+        print("batchSize %4s: %8.0f mensajes/s (%8.0f sin el cliente MQTT), callback p50 %.1f us, p99 %.1f us, %s procesados" % (batchSize, result["throughput"], result["stageThroughput"], result["p50"], result["p99"], result["received"]))
+
+
+if __name__ == '__main__':
+    # Compara el procesamiento de cada mensaje en su callback con el de lotes de 100 y 500 mensajes:
+    #   python benchmarks/bench_batching.py --messages 200000 --batchSizes 0,100,500
+    main()
@@ -0,0 +1,84 @@
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ingest import IngestBuffer
+
+
+def produce(buffer, rate, duration, devices, tick=0.01):
+    """Append samples to the buffer at a fixed rate, as the MQTT thread does
+
+    Args:
+        buffer: the IngestBuffer
+        rate: samples per second
+        duration: seconds to produce
+        devices: number of different deviceIds
+        tick: seconds between two groups of samples
+    Returns:
+        the number of samples appended
+
+    """
+    sent = 0
+    startTime = time.time()
+
+    while time.time() - startTime < duration:
+        # The samples due since the start, the producer catches up if it falls behind
+        count = int(rate * (time.time() - startTime)) - sent
+        for _ in range(count):
+            buffer.append(sent % devices, sent, [21.5, 60.0, 0])
+            sent += 1
+
+        delay = tick - (time.time() - startTime) % tick
+        time.sleep(delay)
+
+    return sent
+
+
+def main():
+    """Run the benchmark from the command line"""
+
+    parser = argparse.ArgumentParser(description="Prueba de carga del IngestBuffer: ninguna muestra se pierde entre dos swaps")
+    parser.add_argument("--rate", type=int, default=50000, help="muestras por segundo")
+    parser.add_argument("--duration", type=float, default=10, help="segundos de la prueba")
+    parser.add_argument("--devices", type=int, default=3000, help="numero de dispositivos")
+    parser.add_argument("--swapInterval", type=float, default=0.005, help="segundos entre dos swaps del buffer")
+    args = parser.parse_args()
+
+    buffer = IngestBuffer()
+    received = [0]
+    swaps = [0]
+    stop = threading.Event()
+
+    def flush():
+        generation, _ = buffer.swap()
+        received[0] += sum(len(runningAggregate) for runningAggregate in generation.values())
+        swaps[0] += 1
+
+    def flushLoop():
+        while not stop.wait(args.swapInterval):
+            flush()
+
+    flusher = threading.Thread(target=flushLoop, name="BenchmarkFlush")
+    flusher.start()
+
+    startTime = time.time()
+    sent = produce(buffer, args.rate, args.duration, args.devices)
+    elapsedTime = time.time() - startTime
+
+    stop.set()
+    flusher.join()
+    flush()
+
+    print("%s muestras enviadas en %.2f s (%.0f muestras/s), %s recibidas en %s swaps, %s perdidas" % (sent, elapsedTime, sent / elapsedTime, received[0], swaps[0], sent - received[0]))
+
+    return 0 if sent == received[0] else 1
+
+
+if __name__ == '__main__':
+    # Envia muestras al buffer a 50k/s mientras otro thread lo vacia, y comprueba que no se pierde ninguna:
+    #   python benchmarks/bench_buffer.py --rate 50000 --duration 10
+    sys.exit(main())
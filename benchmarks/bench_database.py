@@ -0,0 +1,91 @@
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench import percentiles
+from database import Database
+
+READ_QUERY = '''SELECT count(*), avg(temperature) FROM data WHERE deviceId = ? AND currentTimestamp >= ?'''
+INSERT_QUERY = '''INSERT INTO data (deviceId, temperature, humidity, rainPulses, currentTimestamp) VALUES (?, ?, ?, ?, ?)'''
+
+
+def sharedSelect(db, query, values):
+    """A read through the writer connection, as every read was done before the reader connections"""
+
+    with db.writeLock:
+        return db.conn.execute(query, values).fetchone()[0]
+
+
+def run(mode, args):
+    """Write the batches while the reader threads query the database
+
+    Args:
+        mode: "readers" to read with the connection of each thread, "shared" to read with the writer connection
+        args: the parsed command line arguments
+    Returns:
+        a (write seconds, list of read latencies in seconds) tuple
+
+    """
+    directory = tempfile.mkdtemp(prefix="carrascas-bench-")
+    db = Database(os.path.join(directory, "carrascas.db"))
+
+    rows = [[deviceId, 21.5, 60.0, 0, 1523700000] for deviceId in range(args.rows)]
+    latencies = []
+    stop = threading.Event()
+
+    def reader():
+        readLatencies = []
+        deviceId = 0
+        while not stop.is_set():
+            deviceId = (deviceId + 1) % args.rows
+            startTime = time.perf_counter()
+            if mode == "readers":
+                db.select(READ_QUERY, [deviceId, 0], scalar=1)
+            else:
+                sharedSelect(db, READ_QUERY, [deviceId, 0])
+            readLatencies.append(time.perf_counter() - startTime)
+            time.sleep(args.readInterval)
+        latencies.extend(readLatencies)
+
+    readers = [threading.Thread(target=reader, name="BenchmarkReader%s" % index) for index in range(args.readers)]
+    for thread in readers:
+        thread.start()
+
+    startTime = time.perf_counter()
+    for _ in range(args.batches):
+        db.insertBatch([(INSERT_QUERY, rows)])
+    writeTime = time.perf_counter() - startTime
+
+    stop.set()
+    for thread in readers:
+        thread.join()
+    db.close()
+
+    return writeTime, latencies
+
+
+def main():
+    """Run the benchmark from the command line"""
+
+    parser = argparse.ArgumentParser(description="Lecturas concurrentes mientras se escriben lotes en la base de datos")
+    parser.add_argument("--readers", type=int, default=4, help="numero de threads de lectura")
+    parser.add_argument("--rows", type=int, default=20000, help="filas de cada lote, una por dispositivo")
+    parser.add_argument("--batches", type=int, default=20, help="numero de lotes escritos")
+    parser.add_argument("--readInterval", type=float, default=0.001, help="segundos entre dos lecturas de cada thread")
+    args = parser.parse_args()
+
+    for mode in ("shared", "readers"):
+        writeTime, latencies = run(mode, args)
+        result = percentiles(latencies)
+        print("%-8s escritura %.2f s, %s lecturas, p50 %.2f ms, p99 %.2f ms, max %.2f ms" % (mode, writeTime, len(latencies), result["p50"] * 1e3, result["p99"] * 1e3, max(latencies) * 1e3))
+
+
+if __name__ == '__main__':
+    # Compara las lecturas con la conexion de escritura compartida y con una conexion por thread:
+    #   python benchmarks/bench_database.py --readers 4 --rows 20000 --batches 20
+    main()
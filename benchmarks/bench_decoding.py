@@ -0,0 +1,88 @@
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import decoding
+from bench import DeviceFleet
+
+# Decodificadores de JSON opcionales que se miden si estan instalados
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def buildPayloads(count, binary, timestamps):
+    """Build the payloads of the realtime messages of a simulated fleet
+
+    Args:
+        count: number of messages
+        binary: True for the binary format, False for JSON
+        timestamps: True to include the timestamp of the device
+    Returns:
+        a list with the payload of each message
+
+    """
+    fleet = DeviceFleet(None, devices=1000, binary=1.0 if binary else 0.0, timestamps=timestamps)
+    return [fleet.realtimeMessage(index % 1000)[1] for index in range(count)]
+
+
+def perMessage(function, payloads, repeat):
+    """Get the best time in microseconds per message of decoding the payloads one by one"""
+
+    timer = timeit.Timer(lambda: [function(payload) for payload in payloads])
+    return min(timer.repeat(repeat, 1)) / len(payloads) * 1e6
+
+
+def perBatch(function, payloads, batchSize, repeat):
+    """Get the best time in microseconds per message of decoding the payloads in batches"""
+
+    batches = [payloads[index:index + batchSize] for index in range(0, len(payloads), batchSize)]
+    timer = timeit.Timer(lambda: [function(batch) for batch in batches])
+    return min(timer.repeat(repeat, 1)) / len(payloads) * 1e6
+
+
+def main():
+    """Run the benchmark from the command line"""
+
+    parser = argparse.ArgumentParser(description="Tiempo de decodificacion de cada mensaje realtime segun su formato")
+    parser.add_argument("--messages", type=int, default=100000, help="numero de mensajes de cada formato")
+    parser.add_argument("--batchSize", type=int, default=500, help="mensajes de cada lote de las funciones *Many")
+    parser.add_argument("--repeat", type=int, default=5, help="repeticiones de cada medida, se muestra la mejor")
+    args = parser.parse_args()
+
+    jsonPayloads = buildPayloads(args.messages, False, True)
+    binaryPayloads = buildPayloads(args.messages, True, False)
+    binaryTimestampPayloads = buildPayloads(args.messages, True, True)
+
+    measures = [("json (stdlib)", perMessage(json.loads, jsonPayloads, args.repeat))]
+    if orjson is not None:
+        measures.append(("orjson", perMessage(orjson.loads, jsonPayloads, args.repeat)))
+    if ujson is not None:
+        measures.append(("ujson", perMessage(ujson.loads, jsonPayloads, args.repeat)))
+    measures.extend([
+        ("loadsMany (%s)" % decoding.DECODER, perBatch(decoding.loadsMany, jsonPayloads, args.batchSize, args.repeat)),
+        ("binario v1", perMessage(decoding.loadsRealtimeBinary, binaryPayloads, args.repeat)),
+        ("binario v2", perMessage(decoding.loadsRealtimeBinary, binaryTimestampPayloads, args.repeat)),
+        ("binario v1 Many", perBatch(decoding.loadsRealtimeBinaryMany, binaryPayloads, args.batchSize, args.repeat)),
+        ("binario v2 Many", perBatch(decoding.loadsRealtimeBinaryMany, binaryTimestampPayloads, args.batchSize, args.repeat)),
+    ])
+
+    print("JSON de %s bytes, binario de %s y %s bytes" % (len(jsonPayloads[0]), len(binaryPayloads[0]), len(binaryTimestampPayloads[0])))
+    for name, microseconds in measures:
+        print("%-22s %6.2f us/mensaje" % (name, microseconds))
+
+
+if __name__ == '__main__':
+    # Mide cada formato con 100000 mensajes de una flota simulada:
+    #   python benchmarks/bench_decoding.py --messages 100000
+    main()
@@ -0,0 +1,71 @@
+import argparse
+import os
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import Database
+from export import EXPORT_FORMATS, DataExporter
+
+
+def fill(db, rows, devices):
+    """Fill the data table up to a number of rows, one row per device and minute, in commits of a million rows"""
+
+    existing = db.select('''SELECT count(*) FROM data''', [], scalar=1)
+    startTimestamp = 1500000000
+    for offset in range(existing, rows, 1000000):
+        count = min(1000000, rows - offset)
+        db.insertBatch([db.dataOperation([[index % devices, 20 + index % 100 / 10.0, 50 + index % 50 / 10.0, index % 3, startTimestamp + index // devices * 60]
+                                          for index in range(offset, offset + count)])])
+
+
+def run(rows, directory, format="parquet", devices=1000):
+    """Measure the export of a synthetic rowid table of minute rows
+
+    Args:
+        rows: the number of rows of the table
+        directory: a directory for the database and the exported files. The table is reused if it already exists
+        format: one of EXPORT_FORMATS
+        devices: the number of devices of the table
+    Returns:
+        a (rows exported, seconds, max RSS in MB) tuple
+
+    """
+    db = Database(os.path.join(directory, "benchmark.db"))
+    fill(db, rows, devices)
+
+    exporter = DataExporter(db, os.path.join(directory, format), format)
+    startTime = time.perf_counter()
+    exported = exporter.export()
+    elapsedTime = time.perf_counter() - startTime
+    db.close()
+
+    return exported, elapsedTime, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def main():
+    """Run the benchmark from the command line"""
+
+    parser = argparse.ArgumentParser(description="Velocidad y memoria de la exportacion de la tabla data")
+    parser.add_argument("--rows", type=int, default=1000000, help="filas de la tabla data")
+    parser.add_argument("--devices", type=int, default=1000, help="numero de dispositivos")
+    parser.add_argument("--format", choices=sorted(EXPORT_FORMATS), default="parquet", help="formato de los ficheros exportados")
+    parser.add_argument("--directory", help="directorio de la base de datos y de los ficheros, por defecto uno temporal")
+    args = parser.parse_args()
+
+    directory = args.directory or tempfile.mkdtemp(prefix="carrascas-bench-")
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    exported, elapsedTime, maxRss = run(args.rows, directory, args.format, args.devices)
+    print("%s filas exportadas a %s en %.3f s (%.0f filas/s). Memoria maxima: %.1f MB"
+          % (exported, args.format, elapsedTime, exported / elapsedTime if elapsedTime else 0, maxRss))
+
+
+if __name__ == '__main__':
+    # Exporta una tabla de 10 millones de filas a parquet:
+    #   python benchmarks/bench_export.py --rows 10000000 --format parquet
+    main()
@@ -0,0 +1,70 @@
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import DATA_LAYOUTS, Database
+
+
+def buildRows(devices, samples, seed):
+    """Build the rows of every flush, a row per device every 60 seconds"""
+
+    rng = random.Random(seed)
+    return [[deviceId, round(rng.uniform(-5, 40), 2), round(rng.uniform(10, 100), 2), rng.randint(0, 3), 1514764800 + sample * 60]
+            for sample in range(samples) for deviceId in range(devices)]
+
+
+def run(layout, rows, batchSize, directory):
+    """Insert the rows in a new database with a layout
+
+    Args:
+        layout: one of DATA_LAYOUTS
+        rows: the rows to insert, in the order they are flushed
+        batchSize: rows of each commit
+        directory: directory of the database
+    Returns:
+        a (rows per second, size in bytes) tuple
+
+    """
+    path = os.path.join(directory, "%s.db" % layout)
+    db = Database(path, layout)
+
+    startTime = time.perf_counter()
+    for index in range(0, len(rows), batchSize):
+        db.insertBatch([db.dataOperation(rows[index:index + batchSize])])
+    elapsedTime = time.perf_counter() - startTime
+
+    # The size of the file once the WAL is written back and the free pages released
+    db.executescript("PRAGMA wal_checkpoint(TRUNCATE); VACUUM;")
+    db.close()
+
+    return len(rows) / elapsedTime, os.path.getsize(path)
+
+
+def main():
+    """Run the benchmark from the command line"""
+
+    parser = argparse.ArgumentParser(description="Velocidad de insercion y tamaño en disco de cada formato de la tabla data")
+    parser.add_argument("--devices", type=int, default=1000, help="numero de dispositivos")
+    parser.add_argument("--samples", type=int, default=200, help="muestras de cada dispositivo")
+    parser.add_argument("--batchSize", type=int, default=1000, help="filas de cada commit")
+    parser.add_argument("--seed", type=int, default=0, help="semilla de los valores aleatorios")
+    args = parser.parse_args()
+
+    rows = buildRows(args.devices, args.samples, args.seed)
+    directory = tempfile.mkdtemp(prefix="carrascas-bench-")
+
+    print("%s filas en commits de %s" % (len(rows), args.batchSize))
+    for layout in sorted(DATA_LAYOUTS, key=lambda layout: layout != "rowid"):
+        rate, size = run(layout, rows, args.batchSize, directory)
+        print("%-8s %10.0f filas/s %8.1f MB %6.1f bytes/fila" % (layout, rate, size / 1048576.0, size / float(len(rows))))
+
+
+if __name__ == '__main__':
+    # Inserta 200 muestras de 1000 dispositivos con cada formato:
+    #   python benchmarks/bench_layouts.py --devices 1000 --samples 200
+    main()
@@ -0,0 +1,87 @@
+import argparse
+import os
+import random
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aggregation import DeviceSamples, RunningAggregate
+
+
+def listLayout(devices, samples, rng):
+    """The original layout, a list [timestamp, temperature, humidity, rainPulses] per sample"""
+
+    buffer = {}
+    for deviceId in range(devices):
+        buffer[deviceId] = [[1523700000 + index, rng.uniform(-5, 40), rng.uniform(10, 100), rng.randint(0, 3)] for index in range(samples)]
+    return buffer
+
+
+def columnarLayout(devices, samples, rng):
+    """A DeviceSamples per device, the values in array('d') columns"""
+
+    buffer = {}
+    for deviceId in range(devices):
+        deviceSamples = buffer[deviceId] = DeviceSamples()
+        for index in range(samples):
+            deviceSamples.append(1523700000 + index, [rng.uniform(-5, 40), rng.uniform(10, 100), rng.randint(0, 3)])
+    return buffer
+
+
+def runningLayout(devices, samples, rng):
+    """A RunningAggregate per device, the state of the IngestBuffer"""
+
+    buffer = {}
+    for deviceId in range(devices):
+        runningAggregate = buffer[deviceId] = RunningAggregate()
+        for index in range(samples):
+            runningAggregate.add(1523700000 + index, [rng.uniform(-5, 40), rng.uniform(10, 100), rng.randint(0, 3)])
+    return buffer
+
+
+LAYOUTS = [("list", listLayout), ("DeviceSamples", columnarLayout), ("RunningAggregate", runningLayout)]
+
+
+def measure(layout, devices, samples, seed):
+    """Get the memory allocated by a buffer built with a layout
+
+    Args:
+        layout: the function that builds the buffer
+        devices: number of devices
+        samples: samples of each device
+        seed: the seed of the random values
+    Returns:
+        the bytes allocated while the buffer is alive
+
+    """
+    rng = random.Random(seed)
+
+    tracemalloc.start()
+    buffer = layout(devices, samples, rng)
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    del buffer
+    return allocated
+
+
+def main():
+    """Run the benchmark from the command line"""
+
+    parser = argparse.ArgumentParser(description="Memoria del buffer de muestras segun su estructura")
+    parser.add_argument("--devices", type=int, default=3000, help="numero de dispositivos")
+    parser.add_argument("--samples", type=int, default=60, help="muestras de cada dispositivo entre dos volcados")
+    parser.add_argument("--seed", type=int, default=0, help="semilla de los valores aleatorios")
+    args = parser.parse_args()
+
+    total = args.devices * args.samples
+    for name, layout in LAYOUTS:
+        allocated = measure(layout, args.devices, args.samples, args.seed)
+        print("%-16s %8.1f MB %8.1f bytes/muestra" % (name, allocated / 1048576.0, allocated / float(total)))
+
+
+if __name__ == '__main__':
+    # Compara la memoria de las muestras de 3000 dispositivos con 60 muestras cada uno:
+    #   python benchmarks/bench_memory.py --devices 3000 --samples 60
+    main()
@@ -0,0 +1,126 @@
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import MIGRATIONS, Database
+from query import DataQuery
+
+# Consultas sin el indice ni las tablas de agregados, como se hacian antes de las migraciones
+RANGE_QUERY = '''SELECT deviceId, temperature, humidity, rainPulses, currentTimestamp FROM data
+                 WHERE deviceId = ? AND currentTimestamp >= ? AND currentTimestamp < ? ORDER BY currentTimestamp'''
+DAILY_QUERY = '''SELECT currentTimestamp - currentTimestamp % 86400, count(*), avg(temperature), min(temperature), max(temperature)
+                 FROM data WHERE deviceId = ? AND currentTimestamp >= ? AND currentTimestamp < ? GROUP BY 1'''
+
+START_TIMESTAMP = 1514764800   # 2018-01-01
+
+
+def createDatabase(path, devices, days, interval):
+    """Create a database with the original schema and a sample of every device every interval seconds
+
+    Args:
+        path: the path of the database
+        devices: number of devices
+        days: days of data
+        interval: seconds between two samples of a device
+    Returns:
+        the number of rows inserted
+
+    """
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(MIGRATIONS[0])
+    conn.execute("PRAGMA user_version = 1")
+
+    rng = random.Random(0)
+    rows = 0
+    # The samples are inserted in the order they are received, every device in each flush
+    for timestamp in range(START_TIMESTAMP, START_TIMESTAMP + days * 86400, interval):
+        conn.executemany('''INSERT INTO data (deviceId, temperature, humidity, rainPulses, currentTimestamp) VALUES (?,?,?,?,?)''',
+                         [(deviceId, round(rng.uniform(-5, 40), 2), round(rng.uniform(10, 100), 2), rng.randint(0, 3), timestamp) for deviceId in range(devices)])
+        rows += devices
+    conn.commit()
+    conn.close()
+
+    return rows
+
+
+def timeQueries(run, devices, totalDays, days, queries):
+    """Get the mean time of a query for random devices and ranges
+
+    Args:
+        run: a function with the deviceId, fromTimestamp and toTimestamp arguments that returns the rows
+        devices: number of devices
+        totalDays: days of data in the database
+        days: days of the range
+        queries: number of queries
+    Returns:
+        a (mean milliseconds, mean rows) tuple
+
+    """
+    rng = random.Random(1)
+    rows = 0
+    startTime = time.perf_counter()
+    for _ in range(queries):
+        deviceId = rng.randrange(devices)
+        fromTimestamp = START_TIMESTAMP + rng.randrange(max(1, totalDays - days + 1)) * 86400
+        rows += len(list(run(deviceId, fromTimestamp, fromTimestamp + days * 86400)))
+
+    return (time.perf_counter() - startTime) * 1000.0 / queries, rows / float(queries)
+
+
+def main():
+    """Run the benchmark from the command line"""
+
+    parser = argparse.ArgumentParser(description="Consultas de rango antes y despues del indice y de las tablas de agregados")
+    parser.add_argument("--devices", type=int, default=1000, help="numero de dispositivos")
+    parser.add_argument("--days", type=int, default=365, help="dias de datos")
+    parser.add_argument("--interval", type=int, default=3600, help="segundos entre dos muestras de un dispositivo")
+    parser.add_argument("--queries", type=int, default=20, help="consultas de cada tipo")
+    parser.add_argument("--directory", default=None, help="directorio de la base de datos, por defecto uno temporal")
+    args = parser.parse_args()
+
+    directory = args.directory or tempfile.mkdtemp(prefix="carrascas-bench-")
+    path = os.path.join(directory, "carrascas.db")
+    if os.path.exists(path):
+        os.remove(path)
+
+    startTime = time.time()
+    rows = createDatabase(path, args.devices, args.days, args.interval)
+    print("%s filas creadas en %.1f s, %.1f MB" % (rows, time.time() - startTime, os.path.getsize(path) / 1048576.0))
+
+    conn = sqlite3.connect(path)
+    before = [
+        ("rango 1 dia", timeQueries(lambda *values: conn.execute(RANGE_QUERY, values).fetchall(), args.devices, args.days, 1, args.queries)),
+        ("rango 7 dias", timeQueries(lambda *values: conn.execute(RANGE_QUERY, values).fetchall(), args.devices, args.days, 7, args.queries)),
+        ("diario %s dias" % args.days, timeQueries(lambda *values: conn.execute(DAILY_QUERY, values).fetchall(), args.devices, args.days, args.days, args.queries)),
+    ]
+    conn.close()
+
+    # Database applies the pending migrations: the covering index and the backfill of the rollups
+    startTime = time.time()
+    db = Database(path)
+    print("migraciones aplicadas en %.1f s, %.1f MB" % (time.time() - startTime, os.path.getsize(path) / 1048576.0))
+
+    query = DataQuery(db)
+    after = [
+        timeQueries(query.range, args.devices, args.days, 1, args.queries),
+        timeQueries(query.range, args.devices, args.days, 7, args.queries),
+        timeQueries(lambda *values: query.rollup("dataDaily", *values), args.devices, args.days, args.days, args.queries),
+    ]
+    db.close()
+
+    print("%-16s %12s %12s %8s" % ("consulta", "antes (ms)", "despues (ms)", "filas"))
+    for (name, (beforeTime, beforeRows)), (afterTime, afterRows) in zip(before, after):
+        print("%-16s %12.2f %12.2f %8.0f" % (name, beforeTime, afterTime, afterRows))
+
+
+if __name__ == '__main__':
+    # Un año de datos horarios de 1000 dispositivos (8.76 millones de filas):
+    #   python benchmarks/bench_queries.py --devices 1000 --days 365 --interval 3600
+    main()
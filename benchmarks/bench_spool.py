@@ -0,0 +1,76 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ingest import IngestBuffer
+from spool import SampleSpool
+
+
+def timeAppends(buffer, samples, devices):
+    """Get the time in microseconds per sample of appending the samples one by one"""
+
+    startTime = time.perf_counter()
+    for index in range(samples):
+        buffer.append(index % devices, 1523700000.5 + index, [21.5, 60.0, 1])
+    return (time.perf_counter() - startTime) / samples * 1e6
+
+
+def timeAppendMany(buffer, samples, devices, batchSize):
+    """Get the time in microseconds per sample of appending the samples in batches, as the MessageBatcher does"""
+
+    batches = []
+    for start in range(0, samples, batchSize):
+        batch = {}
+        for index in range(start, min(start + batchSize, samples)):
+            batch.setdefault(index % devices, []).append((1523700000.5 + index, [21.5, 60.0, 1]))
+        batches.append(batch)
+
+    startTime = time.perf_counter()
+    for batch in batches:
+        buffer.appendMany(batch)
+    return (time.perf_counter() - startTime) / samples * 1e6
+
+
+def main():
+    """Run the benchmark from the command line"""
+
+    parser = argparse.ArgumentParser(description="Coste por muestra de escribir tambien en el spool")
+    parser.add_argument("--samples", type=int, default=500000, help="numero de muestras")
+    parser.add_argument("--devices", type=int, default=1000, help="numero de dispositivos")
+    parser.add_argument("--batchSize", type=int, default=500, help="muestras de cada appendMany")
+    parser.add_argument("--syncInterval", type=float, default=1.0, help="segundos entre dos sincronizaciones del spool")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="carrascas-bench-")
+
+    results = {}
+    for name in ("sin spool", "con spool"):
+        spool = SampleSpool(os.path.join(directory, "spool"), syncInterval=args.syncInterval) if name == "con spool" else None
+        results[name] = (timeAppends(IngestBuffer(5, spool), args.samples, args.devices),
+                         timeAppendMany(IngestBuffer(5, spool), args.samples, args.devices, args.batchSize))
+
+        if spool is not None:
+            startTime = time.perf_counter()
+            spool.sync()
+            syncTime = time.perf_counter() - startTime
+            spool.close()
+
+    print("%s muestras de %s dispositivos" % (args.samples, args.devices))
+    for name, (append, appendMany) in results.items():
+        print("%-10s append %5.2f us/muestra, appendMany %5.2f us/muestra" % (name, append, appendMany))
+    print("sobrecoste del spool: append %.2f us, appendMany %.2f us por muestra" %
+          tuple(results["con spool"][index] - results["sin spool"][index] for index in range(2)))
+    print("sync de los segmentos: %.1f ms" % (syncTime * 1000))
+
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    # Mide el coste de copiar cada muestra al spool:
+    #   python benchmarks/bench_spool.py --samples 500000
+    main()
@@ -0,0 +1,92 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# carrascas reads the config.ini and opens its files in the working directory
+os.chdir(tempfile.mkdtemp(prefix="carrascas-bench-"))
+with open("config.ini", "w") as configFile:
+    configFile.write("[AEMET]\napiKey = benchmark\n\n[INGEST]\nspool =\n\n[QUERY]\nport = 0\n\n[METRICS]\npublishInterval = 0\n\n"
+                     "[STATIONS]\nobservations =\nforecasts =\n\n[LOGGING]\nlevel = WARNING\n")
+
+import carrascas
+from bench import DeviceFleet
+from fakebroker import FakeBroker
+from supervisor import Supervisor
+
+
+def measure(broker, workers, partition, devices, messages, timeout=300):
+    """Get the throughput of the workers processing the messages published by the broker
+
+    Args:
+        broker: the FakeBroker
+        workers: number of worker processes
+        partition: "shared" or "hash"
+        devices: number of devices
+        messages: number of realtime messages
+        timeout: maximum seconds to wait for the messages to be processed
+    Returns:
+        a (messages processed, seconds) tuple
+
+    """
+    for path in ("carrascas.db", "carrascas.db-wal", "carrascas.db-shm"):
+        if os.path.exists(path):
+            os.remove(path)
+
+    supervisor = Supervisor(workers, partition, statsInterval=0.1)
+    supervisor.start()
+
+    try:
+        while broker.subscriptions() < 3 * workers:
+            time.sleep(0.01)
+
+        fleet = DeviceFleet(None, devices=devices)
+        broker.publish([fleet.confMessage(deviceId) for deviceId in range(devices)])
+        payloads = [fleet.realtimeMessage(index % devices) for index in range(messages)]
+
+        startTime = time.time()
+        for index in range(0, messages, 1000):
+            broker.publish(payloads[index:index + 1000])
+
+        deadline = startTime + timeout
+        while supervisor.getStats().get("received", 0) < messages and time.time() < deadline:
+            supervisor.collect(0.05)
+        elapsedTime = time.time() - startTime
+    finally:
+        supervisor.stop()
+
+    return supervisor.getStats().get("received", 0), elapsedTime
+
+
+def main():
+    """Run the benchmark from the command line"""
+
+    parser = argparse.ArgumentParser(description="Escalado de la ingesta con el numero de workers del supervisor")
+    parser.add_argument("--workers", default="1,2,4", help="numero de workers de cada medida, separados por comas")
+    parser.add_argument("--partition", default="shared", choices=["shared", "hash"], help="reparto de los mensajes")
+    parser.add_argument("--devices", type=int, default=1000, help="numero de dispositivos")
+    parser.add_argument("--messages", type=int, default=200000, help="mensajes realtime de cada medida")
+    args = parser.parse_args()
+
+    broker = FakeBroker()
+    broker.start()
+    carrascas.config.read_dict({"MQTT": {"host": broker.host, "port": str(broker.port)}})
+
+    print("%s mensajes, %s, %s cores" % (args.messages, args.partition, os.cpu_count()))
+    baseline = None
+    for workers in [int(workers) for workers in args.workers.split(",")]:
+        received, elapsedTime = measure(broker, workers, args.partition, args.devices, args.messages)
+        rate = received / elapsedTime
+        baseline = baseline or rate
+        print("%3s workers: %8.0f mensajes/s, %.2fx, %s procesados" % (workers, rate, rate / baseline, received))
+
+    broker.stop()
+
+
+if __name__ == '__main__':
+    # Mide la ingesta con 1, 2 y 4 workers y un broker local (fakebroker.py):
+    #   python benchmarks/bench_supervisor.py --workers 1,2,4 --messages 200000
+    main()
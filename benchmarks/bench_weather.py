@@ -0,0 +1,87 @@
+import argparse
+import configparser
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aemet import AemetClient
+from database import Database
+from fakeaemet import FakeAemet
+from scheduler import WeatherScheduler
+from stations import readStations
+from writer import DatabaseWriter
+
+
+def refresh(db, fakeAemet, stations, workers, minInterval):
+    """Download the observations of every station once with a WeatherScheduler
+
+    Args:
+        db: the Database where the observations are saved
+        fakeAemet: the FakeAemet server
+        stations: the list of station identifiers
+        workers: number of workers of the scheduler, and of concurrent requests to the host
+        minInterval: minimum seconds between two requests to the API
+    Returns:
+        the seconds until the observations of every station are saved
+
+    """
+    db.executescript("DELETE FROM observations;")
+    writer = DatabaseWriter(db)
+    client = AemetClient("benchmark", baseUrl=fakeAemet.baseUrl, minInterval=minInterval, maxPerHost=workers)
+    scheduler = WeatherScheduler(client, writer, workers=workers, jitter=0)
+    for idema in stations:
+        scheduler.scheduleObservation(idema)
+
+    startTime = time.time()
+    scheduler.start()
+    while db.select('''SELECT count(DISTINCT idema) FROM observations''', [], scalar=1) < len(stations):
+        time.sleep(0.01)
+    elapsedTime = time.time() - startTime
+
+    scheduler.stop()
+    writer.stop()
+
+    return elapsedTime
+
+
+def main():
+    """Run the benchmark from the command line"""
+
+    parser = argparse.ArgumentParser(description="Tiempo de descarga de las observaciones de todas las estaciones contra una API de AEMET local")
+    parser.add_argument("--stations", type=int, default=500, help="numero de estaciones")
+    parser.add_argument("--workers", default="1,8,32", help="numero de workers de cada medida, separados por comas")
+    parser.add_argument("--delay", type=float, default=0.05, help="segundos que tarda la API en responder cada peticion")
+    parser.add_argument("--minInterval", default="0,1.2",
+                        help="segundos minimos entre dos peticiones a la API de cada medida, separados por comas. "
+                             "Con 0 se mide el reparto entre los workers y el parseo, con 1.2 (el limite por defecto) lo que se tarda de verdad")
+    args = parser.parse_args()
+
+    # The stations are read from the configuration, as carrascas does
+    config = configparser.ConfigParser()
+    config.read_string("[STATIONS]\nobservations = %s\n" % ", ".join("S%04d" % index for index in range(args.stations)))
+    stations, _ = readStations(config)
+
+    fakeAemet = FakeAemet(delay=args.delay)
+    fakeAemet.start()
+    db = Database(os.path.join(tempfile.mkdtemp(prefix="carrascas-bench-"), "carrascas.db"))
+
+    print("%s estaciones, %.0f ms por peticion" % (len(stations), args.delay * 1000))
+    for minInterval in [float(minInterval) for minInterval in args.minInterval.split(",")]:
+        # With a rate limit the refresh can not take less than a request every minInterval seconds
+        print("Limite de %.1f s entre peticiones, minimo %.1f s" % (minInterval, (len(stations) - 1) * minInterval))
+        for workers in [int(workers) for workers in args.workers.split(",")]:
+            elapsedTime = refresh(db, fakeAemet, stations, workers, minInterval)
+            print("%3s workers: %7.2f s, %6.1f estaciones/s" % (workers, elapsedTime, len(stations) / elapsedTime))
+
+    db.close()
+    fakeAemet.stop()
+
+
+if __name__ == '__main__':
+    # Descarga 500 estaciones con 1, 8 y 32 workers contra la API falsa de fakeaemet.py, sin limite y con el
+    # limite real de 1.2 s entre peticiones (este tarda mas de 10 minutos por medida):
+    #   python benchmarks/bench_weather.py --stations 500 --workers 1,8,32 --minInterval 0,1.2
+    main()
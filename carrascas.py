@@ -1,106 +1,154 @@
-import json  # Para serializar los datos
+import decoding  # Para decodificar los mensajes
+import json
 import logging  # Para guardar los loggings
 #Esperamos de forma indefinida. Todas las tareas se ejecutan el threads en el background.
+import os
 import signal
-import time  # Para obtener el epoch
 import threading
+import time
+import zlib  # Para repartir los dispositivos entre procesos
+from functools import partial
 from database import Database
-from collections import defaultdict
-import requests
-from datetime import datetime
+from writer import DatabaseWriter
+from registry import DeviceRegistry
+from rollups import rollupOperations
+from ingest import IngestBuffer, receivedTimestamp
+from batching import MessageBatcher
+from spool import SampleSpool, tryLock
+from query import DataQuery, HotCache, QueryServer
+from metrics import Metrics
+from retention import RetentionEngine, RETENTION_TABLES
+from aemet import AemetClient
+from scheduler import WeatherScheduler
+from stations import readStations
+from forecast import parseForecasts, maxProbPrecipitacion
 import configparser
 
 import paho.mqtt.client as mqtt  # Libreria cliente MQTT #pip install paho-mqtt
 
 
-#Guaramos el fichero de logs en smappee.log, con nivel de logging en "DEBUG" y reemplazamos el fichero en cada arranque
-logging.basicConfig(filename='carrascas.log', level=logging.DEBUG, filemode="w")
-
 config = configparser.ConfigParser()
 config.read('config.ini')
 
+#Guaramos el fichero de logs en smappee.log, por defecto con nivel de logging en "DEBUG", y reemplazamos el fichero en cada arranque.
+#Los mensajes de los niveles desactivados no se llegan a formatear
+logging.basicConfig(filename='carrascas.log', level=config.get('LOGGING', 'level', fallback="DEBUG"), filemode="w")
+
+# Descripcion de las metricas de cada instancia
+METRICS = {
+    "messages_received_total": "Realtime messages of the devices of this instance",
+    "decode_failures_total": "Messages that could not be decoded",
+    "samples_buffered_total": "Samples added to the buffer",
+    "db_retries_total": "Retries of the commits to the database",
+    "callback_latency_seconds": "Time from the reception of a realtime message until its sample is in the buffer",
+    "aggregation_seconds": "Time to aggregate the buffered samples of a flush",
+    "commit_seconds": "Time of each commit of the database writer",
+    "buffered_samples": "Samples in the buffer waiting to be saved",
+    "device_buffered_samples": "Samples of each device in the buffer waiting to be saved",
+    "spool_skipped_total": "Samples not copied to the spool because their deviceId is not a 64 bit integer",
+}
+
+# Grupo de la suscripcion compartida de los workers del Supervisor. Tambien se puede usar en [MQTT] shareGroup
+# si el broker soporta suscripciones compartidas (MQTT 5, mosquitto 1.6 o posterior): durante un reinicio
+# sin corte el proceso anterior y el nuevo estan en el mismo grupo, y el broker entrega cada mensaje a uno
+# solo de ellos. Un broker sin soporte no entrega nada a las suscripciones $share, por eso no se usa por defecto
+SHARE_GROUP = "carrascas"
+
+# Fichero bloqueado con flock por el proceso que descarga los datos de AEMET y ejecuta la retencion.
+# Durante un reinicio sin corte el proceso nuevo no los arranca hasta que el anterior termina
+JOBS_LOCK = "carrascas.lock"
+
 class Carrascas():
     """Esta clase se conecta con el broker interno del Smappee, recibe los datos, los almacena 
        y se conecta con el blockchain de forma periodica para transmitir la informacion guardada
 
+       Varias instancias, cada una en su propio proceso, pueden repartirse los mensajes de los
+       dispositivos con una suscripcion compartida del broker o particionando por deviceId.
+
        Args:
-            MQTT_addr: host del broker MQTT
-            MQTT_port: puerto del broker MQTT
+            shareGroup: opcional, nombre del grupo de la suscripcion compartida ($share/<grupo>/...).
+                        Por defecto el de la seccion MQTT del config.ini, si lo hay. Sin grupo se
+                        usa una suscripcion normal, y durante un reinicio los dos procesos guardan
+                        los mismos mensajes. Las instancias con shard no usan grupo
+            shard: opcional, tupla (indice, numero de particiones). Solo se procesan los dispositivos
+                   cuyo deviceId pertenece a la particion
+            weather: si es False no se descargan los datos de AEMET ni se ejecuta la retencion. Si es True
+                     solo se hace en el proceso que tiene el lock de JOBS_LOCK
+            queryPort: opcional, puerto del servidor de consultas. Por defecto el del config.ini, con 0 no se arranca
     """
 
-    def __init__(self):
+    def __init__(self, shareGroup=None, shard=None, weather=True, queryPort=None):
 
-        # API key for the AEMET API
-        self.apiAEMET = [config['AEMET']['apiKey']]
+        self.shard = shard
+        self.weather = weather
+        # Lock of JOBS_LOCK, taken when the weather downloads and the retention are started
+        self.jobsLock = None
+        self.queryPort = queryPort if queryPort is not None else config.getint('QUERY', 'port', fallback=0)
+        self.spoolDirectory = config.get('INGEST', 'spool', fallback="spool")
+        # Number of realtime messages processed by this instance
+        self.received = 0
 
-        serverAddr = 'iothub.sytes.net'
-        serverPort = 1883
+        # Metrics served in the /metrics endpoint of the query server and published periodically
+        self.metrics = Metrics()
+        for name, description in METRICS.items():
+            self.metrics.describe(name, description)
+        self.metrics.addCollector(self.collectMetrics)
+        self.statsInterval = config.getint('METRICS', 'publishInterval', fallback=60)
 
-         # Set the topic header
-        self.topicConf = "device/+/conf"
-        self.topicRealtime = "device/+/realtime"
+        # Range of the timestamps sent by the devices that are accepted, relative to the reception time.
+        # Outside of it the clock of the device is considered wrong and the reception time is used
+        self.maxTimestampAge = config.getfloat('INGEST', 'maxTimestampAge', fallback=3600)
+        self.maxTimestampAhead = config.getfloat('INGEST', 'maxTimestampAhead', fallback=60)
 
-        self.initMQTT(serverAddr, serverPort)
+        # Client of the AEMET API
+        self.aemet = AemetClient(config['AEMET']['apiKey'],
+                                 minInterval=config.getfloat('AEMET', 'minInterval', fallback=1.2),
+                                 maxPerHost=config.getint('AEMET', 'maxPerHost', fallback=4))
 
-    def validateResponse(self, response):
-        """Esta funcion se encarga de validar la respuesta recibida de la API
-        Args:
-           response: instancia del objeto Response de la libreria Requests. 
-        Returns:
-           devuelve la respuesta decodificada en un diccionario o 
-           en formato de texto plano si no se ha podido decodificar el Json.
-           devuelve un array con un 0 si el servidor devuelve error.
+        # AEMET stations and municipalities downloaded in the background
+        self.stations, self.municipios = readStations(config)
 
-        """
+        serverAddr = config.get('MQTT', 'host', fallback='iothub.sytes.net')
+        serverPort = config.getint('MQTT', 'port', fallback=1883)
 
-        #Comprobamos el status code
-        status = response.status_code
-        #Si el status code empieza con 5 significa que el servidor ha devuelto un error
-        if str(status).startswith('5'):
-            logging.error('send: Server failure...')
-            #Salimos indicando fallo
-            return [0]
+         # Set the topic header
+        self.topicConf = "device/+/conf"
+        self.topicRealtime = "device/+/realtime"
+        self.topicRealtimeBinary = "device/+/realtime/bin"
+        self.topicStats = "carrascas/stats"
 
-        #Convertimos el resultado en un diccionario
-        try:
-            result = response.json()
-        #Si falla, devolvemos el resultado como texto plano
-        except:
-            result = response.text
-            logging.warning("validateResponse: the response could not be json decoded. Response: %s" % result)
+        # The subscriptions of a shared group are distributed by the broker between its members.
+        # During a restart without downtime the old and the new process share the messages instead of duplicating them.
+        # The partitioned instances need every message, each one discards the devices of the other partitions
+        if shareGroup is None:
+            shareGroup = config.get('MQTT', 'shareGroup', fallback="") if shard is None else ""
+        self.subscriptionPrefix = "$share/%s/" % shareGroup if shareGroup else ""
 
-        return result
+        self.initMQTT(serverAddr, serverPort)
 
     def getCurrentWeather(self):
         """Get the current weather from the AEMET API
         Args:
            ---
         Returns:
-           
+           a dict with the observation of the station or None if it could not be retrieved
 
         """
 
-        idema = "8523X"
-        url = "https://opendata.aemet.es/opendata/api/observacion/convencional/datos/estacion/"
+        # The observations can be disabled with an empty list of stations
+        if not self.stations:
+            logging.debug("getCurrentWeather: No station configured")
+            return
 
-        headers = {'cache-control': "no-cache"}
-        response = requests.request("GET", url+idema, headers=headers, params=self.apiAEMET)
+        idema = self.stations[0]
 
-        jsonResponse = self.validateResponse(response)
+        datos = self.aemet.getObservation(idema)
 
         # Si exito
-        if jsonResponse["estado"] == 200:
-            datosUrl = jsonResponse["datos"]
-            datosResponse = requests.request("GET", datosUrl, headers=headers)
-
-            datos = self.validateResponse(datosResponse)
+        if datos:
             latestData = datos[0]
 
-            print latestData["prec"]
-            print latestData["hr"]
-            print latestData["ta"]
-            print latestData["tamin"]
-            print latestData["tamax"]
+            logging.debug("getCurrentWeather: prec: %s, hr: %s, ta: %s, tamin: %s, tamax: %s", latestData["prec"], latestData["hr"], latestData["ta"], latestData["tamin"], latestData["tamax"])
 
             return latestData
 
@@ -112,32 +160,24 @@ class Carrascas():
             dicc with the rain probability for the next days
 
         """
-        municipio = "12027"
-        headers = {'cache-control': "no-cache"}
-        url = "https://opendata.aemet.es/opendata/api/prediccion/especifica/municipio/diaria/"
+        # The forecasts can be disabled with an empty list of municipalities
+        if not self.municipios:
+            logging.debug("getProbPrecipitacion: No municipality configured")
+            return
 
-        response = requests.request("GET", url+municipio, headers=headers, params=self.apiAEMET)
+        municipio = self.municipios[0]
 
-        jsonResponse = self.validateResponse(response)
+        latestData = self.aemet.getForecast(municipio)
 
         result = {}
 
         # Si exito
-        if jsonResponse["estado"] == 200:
-            datosUrl = jsonResponse["datos"]
-            datosResponse = requests.request("GET", datosUrl, headers=headers)
-
-            datos = self.validateResponse(datosResponse)
-            latestData = datos[0]
+        if latestData:
+            columns = parseForecasts([(municipio, latestData)])
 
-            predicciones = latestData["prediccion"]["dia"]
-
-            format = '%Y-%m-%d'
-
-            for prediccion in predicciones:
-                dayDelta = (datetime.strptime(prediccion["fecha"], format).date()-datetime.utcnow().date()).days
+            for (_, _, dayDelta), probability in maxProbPrecipitacion(columns).items():
                 key = "pred_%s_d" % (dayDelta)
-                result[key] = max(probability["value"] for probability in prediccion["probPrecipitacion"])
+                result[key] = probability
 
             return result
 
@@ -153,8 +193,13 @@ class Carrascas():
         """
         logging.debug("Initializing the MQTT client...")
 
+        # Copy on disk of the buffered samples, it is disabled with an empty directory
+        self.spool = None
+        if self.spoolDirectory:
+            self.spool = SampleSpool(self.spoolDirectory, syncInterval=config.getfloat('INGEST', 'spoolSyncInterval', fallback=1.0))
+
         # Data buffer
-        self.dataBuffer = defaultdict(list)
+        self.dataBuffer = IngestBuffer(config.getfloat('INGEST', 'reorderWindow', fallback=5), self.spool)
 
         #Inicializamos el cliente MQTT
         self.client = mqtt.Client()
@@ -162,10 +207,22 @@ class Carrascas():
         #Creamos la llamada a las funciones de conexion y de desconexion del MQTT
         self.client.on_connect = self.on_connect
         self.client.on_disconnect = self.on_disconnect
+        self.client.on_subscribe = self.on_subscribe
         
         #Definimos los callbacks segun los diferentes topicos
-        self.client.message_callback_add(self.topicConf, self.configureDevice)
-        self.client.message_callback_add(self.topicRealtime, self.realtimeData)
+        self.client.message_callback_add(self.topicConf, self.ownTopicFilter(self.configureDevice))
+
+        # The realtime messages are queued and processed in batches, unless batchSize is 0
+        batchSize = config.getint('INGEST', 'batchSize', fallback=500)
+        if batchSize > 0:
+            self.batcher = MessageBatcher(self.processMessages, batchSize, config.getint('INGEST', 'batchDelay', fallback=50) / 1000.0)
+            self.batcher.start()
+            self.client.message_callback_add(self.topicRealtime, self.ownTopicFilter(self.batcher.on_message))
+            self.client.message_callback_add(self.topicRealtimeBinary, self.ownTopicFilter(self.batcher.on_message))
+        else:
+            self.batcher = None
+            self.client.message_callback_add(self.topicRealtime, self.ownTopicFilter(self.realtimeData))
+            self.client.message_callback_add(self.topicRealtimeBinary, self.ownTopicFilter(self.realtimeBinaryData))
 
         #Nos conectamos al broker MQTT
         logging.debug("Connecting with the MQTT broker...")
@@ -189,6 +246,60 @@ class Carrascas():
         self.saveBufferedDataThread = threading.Thread(target=self.saveBufferedData, args=(self.stopThreads, ))
         self.saveBufferedDataThread.start()
 
+        # Publish the metrics periodically, it is disabled with a publishInterval of 0
+        if self.statsInterval > 0:
+            self.publishStatsThread = threading.Thread(target=self.publishStats, args=(self.stopThreads, ))
+            self.publishStatsThread.daemon = True
+            self.publishStatsThread.start()
+
+        # The weather data and the cleanup of the database only run in one of the processes
+        if not self.weather:
+            return
+
+        self.backgroundJobsThread = threading.Thread(target=self.startBackgroundJobs, args=(self.stopThreads, ), name="BackgroundJobs")
+        self.backgroundJobsThread.daemon = True
+        self.backgroundJobsThread.start()
+
+    def startBackgroundJobs(self, stopThread):
+        """Start the retention and the weather downloads once this process holds the lock of JOBS_LOCK.
+           During a restart without downtime the previous process keeps it until it exits
+
+        Args:
+            stopThread: event set to stop the thread
+        Returns:
+           it does not return anything
+
+        """
+        logged = False
+        while True:
+            self.jobsLock = tryLock(JOBS_LOCK)
+            if self.jobsLock is not None:
+                break
+
+            # Only the first attempt is logged, it is expected while the previous process is stopping
+            if not logged:
+                logging.info("startBackgroundJobs: Another process runs the weather downloads and the retention, waiting for it to exit")
+                logged = True
+
+            if stopThread.wait(1):
+                return
+
+        retention = dict((table, config.getint('RETENTION', table, fallback=0)) for table, _ in RETENTION_TABLES)
+        self.retentionEngine = RetentionEngine(self.db, self.writer,
+                                               compactAfter=config.getint('RETENTION', 'compactAfter', fallback=0),
+                                               retention=retention,
+                                               interval=config.getint('RETENTION', 'interval', fallback=3600))
+        self.retentionEngine.start()
+
+        # Download the weather data in the background
+
+        self.weatherScheduler = WeatherScheduler(self.aemet, self.writer, workers=config.getint('AEMET', 'workers', fallback=4))
+        for idema in self.stations:
+            self.weatherScheduler.scheduleObservation(idema)
+        for municipio in self.municipios:
+            self.weatherScheduler.scheduleForecast(municipio)
+        self.weatherScheduler.start()
+
     def on_connect(self, client, userdata, flags, rc):
         """Esta funcion es llamada por la libreria cuando recibimos una respuesta de tipo CONNACK del servidor
 
@@ -210,21 +321,88 @@ class Carrascas():
 
         # If the connection was unsuccessful
         if rc != 0:
-            logging.error("MQTT on_connect: It was not posible to connect to the broker. Connection result: %s" % rc)
+            logging.error("MQTT on_connect: It was not posible to connect to the broker. Connection result: %s", rc)
             return
 
-        # Start the database
-        self.db = Database("carrascas.db")
+        # Start the database and the threads only the first time we connect
+        if not hasattr(self, 'db'):
+            self.db = Database("carrascas.db")
+            self.writer = DatabaseWriter(self.db, metrics=self.metrics)
+            self.devices = DeviceRegistry(self.db, self.writer)
+
+            # Cache of the latest data, updated with every flush, and the queries of the dashboards
+            self.query = DataQuery(self.db)
+            self.cache = HotCache(self.query,
+                                  maxDevices=config.getint('QUERY', 'cacheDevices', fallback=1000),
+                                  window=config.getint('QUERY', 'window', fallback=86400),
+                                  ttl=config.getint('QUERY', 'cacheTTL', fallback=300))
+            # The query server is started once the topics are subscribed
+            self.queryServer = None
+
+            # Save the samples that were not saved by the previous execution
+            self.replaySpool()
 
-        # Setup the threads
-        self.setupThreads()
+            # Setup the threads
+            self.setupThreads()
 
         # Subsription to the relevant topics
-        client.subscribe(self.topicConf, 0)
-        client.subscribe(self.topicRealtime, 0)
+        # The process is ready when the broker confirms all the subscriptions
+        self.pendingSubscriptions = set()
+        for topic in (self.topicConf, self.topicRealtime, self.topicRealtimeBinary):
+            result, mid = client.subscribe(self.subscriptionPrefix + topic, 0)
+            self.pendingSubscriptions.add(mid)
+
+        # A failure to open its port does not stop the ingest, the server keeps retrying in its own thread
+        if self.queryPort and self.queryServer is None:
+            self.queryServer = QueryServer(self.cache, self.query, port=self.queryPort, metrics=self.metrics)
+            self.queryServer.start()
 
         logging.debug("MQTT on_connect: Connected with result code "+str(rc))
 
+    def on_subscribe(self, client, userdata, mid, granted_qos):
+        """Esta funcion es llamada por la libreria cuando el servidor confirma una suscripcion
+
+        Args:
+            client: the client instance for this callback
+            userdata: the private user data as set in Client() or userdata_set()
+            mid: the message id of the subscribe request
+            granted_qos: list with the qos granted by the broker for each topic
+        Returns:
+           Does not return anything
+
+        """
+        pendingSubscriptions = getattr(self, 'pendingSubscriptions', None)
+        if not pendingSubscriptions or mid not in pendingSubscriptions:
+            return
+
+        pendingSubscriptions.discard(mid)
+        if not pendingSubscriptions:
+            self.notifyReady()
+
+    def notifyReady(self):
+        """Tell the updater that this process is receiving messages, writing its pid and the current time
+           in the file given in the environment variable CARRASCAS_READY_FILE
+
+        Args:
+            ---
+        Returns:
+           Does not return anything
+
+        """
+        logging.info("notifyReady: subscribed to all the topics")
+
+        readyFile = os.environ.get('CARRASCAS_READY_FILE')
+        if not readyFile:
+            return
+
+        try:
+            # Write it with another name and rename it, so the updater never reads it half written
+            with open(readyFile + ".tmp", "w") as f:
+                f.write("%s %.3f" % (os.getpid(), time.time()))
+            os.rename(readyFile + ".tmp", readyFile)
+        except (IOError, OSError) as e:
+            logging.error("notifyReady: The ready file could not be written. Exception: %s", e)
+
     def on_disconnect(self, client, userdata, rc):
         """Esta funcion es llamada por la libreria cuando se desconecta del servidor
 
@@ -260,12 +438,12 @@ class Carrascas():
             logging.warning('publish: a topic must be specified')
             return
 
-        logging.debug("publish: publishing message: %s to the topic: %s" % (payload, topic))
+        logging.debug("publish: publishing message: %s to the topic: %s", payload, topic)
 
         result, mid = self.client.publish(topic, payload, qos=qos, retain=retain)
 
         if result != mqtt.MQTT_ERR_SUCCESS:
-            logging.error('publish: It was not possible to pusblish the payload: %s to the topic: %s. Result code: %s' % (payload, topic, result))
+            logging.error('publish: It was not possible to pusblish the payload: %s to the topic: %s. Result code: %s', payload, topic, result)
 
         return
 
@@ -285,20 +463,20 @@ class Carrascas():
 
         # The incoming data is json encoded
         try:
-            receivedData = json.loads(msg.payload)
+            receivedData = decoding.loads(msg.payload)
         except ValueError:
-            logging.error("saveDeviceStatus: The received data is not a valid JSON object. receivedData: %s" % msg.payload)
+            self.metrics.increment("decode_failures_total")
+            logging.error("saveDeviceStatus: The received data is not a valid JSON object. receivedData: %s", msg.payload)
             return
 
         deviceId = receivedData["deviceId"]
 
-        logging.debug("saveDeviceStatus: detected device : %s" % (deviceId))
+        if not self.isOwnDevice(deviceId):
+            return
 
-        # Save the status of the device in the database
-        while not self.db.insert('''--- Insert or replace the device
-                                    INSERT OR REPLACE INTO devices (deviceId) ; ''', [deviceId]):
-            logging.error("saveDeviceStatus: retrying to save the status for the device with serial number: %s" % deviceId)
-            time.sleep(1)
+        # Only the new devices are saved in the database
+        if self.devices.register(deviceId):
+            logging.debug("saveDeviceStatus: detected new device : %s", deviceId)
 
 
     def realtimeData(self, client, userdata, msg):
@@ -313,88 +491,258 @@ class Carrascas():
            Does not return anything
 
         """
+        startTime = time.monotonic()
+
         # The incoming data is json encoded
         try:
-            receivedData = json.loads(msg.payload)
+            receivedData = decoding.loads(msg.payload)
         except ValueError:
-            logging.error("realtimeData: The received data is not a valid JSON object. receivedData: %s" % msg.payload)
+            self.metrics.increment("decode_failures_total")
+            logging.error("realtimeData: The received data is not a valid JSON object. receivedData: %s", msg.payload)
+            return
+
+        self.saveRealtimeData(receivedData)
+        self.metrics.observe("callback_latency_seconds", time.monotonic() - startTime)
+
+    def realtimeBinaryData(self, client, userdata, msg):
+        """This functions is called when a message is received in the topic device/+/realtime/bin
+
+        Args:
+            client: the client instance for this callback
+            userdata: the private user data as set in Client() or userdata_set()
+            msg: an instance of MQTTMessage. This is a class with members topic, payload, qos, retain.
+           
+        Returns:
+           Does not return anything
+
+        """
+        startTime = time.monotonic()
+
+        # The incoming data is encoded with the fixed binary layout
+        try:
+            receivedData = decoding.loadsRealtimeBinary(msg.payload)
+        except ValueError as e:
+            self.metrics.increment("decode_failures_total")
+            logging.error("realtimeBinaryData: The received data is not a valid binary message. Exception: %s", e)
             return
 
+        self.saveRealtimeData(receivedData)
+        self.metrics.observe("callback_latency_seconds", time.monotonic() - startTime)
+
+    def isOwnDevice(self, deviceId):
+        """Check if the messages of a device are processed by this instance
+
+        Args:
+            deviceId: the identifier of the device
+        Returns:
+            True if there is no partitioning or the device belongs to the partition of this instance
+
+        """
+        if self.shard is None:
+            return True
+
+        index, count = self.shard
+        return shardOf(deviceId, count) == index
+
+    def ownTopicFilter(self, callback):
+        """Wrap a message callback so that, when partitioning by deviceId, the messages of the devices of
+           other partitions are discarded by their topic, device/<deviceId>/..., before queueing or decoding them
+
+        Args:
+            callback: the MQTT message callback
+        Returns:
+            the callback itself if there is no partitioning, otherwise a callback that filters the messages
+
+        """
+        if self.shard is None:
+            return callback
+
+        index, count = self.shard
+
+        def on_message(client, userdata, msg):
+            topic = msg.topic.split("/", 2)
+            if len(topic) > 1 and shardOf(topic[1], count) == index:
+                callback(client, userdata, msg)
+
+        return on_message
+
+    def parseRealtimeData(self, receivedData):
+        """Get the values of a decoded realtime message
+
+        Args:
+            receivedData: a dict with the deviceId and the data of the message
+           
+        Returns:
+           a tuple (deviceId, values, deviceTimestamp) or None if the message is not valid or belongs to another partition.
+           deviceTimestamp is the optional timestamp of the message in milliseconds, None if the device does not send it
+
+        """
+
         # Check if the client has sent his indentification
-        if "deviceId" not in receivedData:
-            logging.error("realtimeData: Could not find the client id in the received data. receivedData: %s" % receivedData)
+        if not isinstance(receivedData, dict) or "deviceId" not in receivedData:
+            logging.error("parseRealtimeData: Could not find the client id in the received data. receivedData: %s", receivedData)
+            return
+
+        deviceId = receivedData["deviceId"]
+
+        # The deviceId indexes the buffer, a list or an object would fail the whole batch of messages
+        try:
+            hash(deviceId)
+        except TypeError:
+            logging.error("parseRealtimeData: Invalid client id in the received data. receivedData: %s", receivedData)
+            return
+
+        # The device belongs to another partition
+        if not self.isOwnDevice(deviceId):
             return
 
         # Retrieve the data
-        data = receivedData["data"]
+        try:
+            data = receivedData["data"]
+            values = [data["temperature"], data["humidity"], data["rainPulses"]]
+        except (KeyError, TypeError) as e:
+            logging.error("parseRealtimeData: Missing value in the received data. receivedData: %s. Exception: %s", receivedData, e)
+            return
 
-        deviceId = receivedData["deviceId"]
-        temperature = data["temperature"]
-        humidity = data["humidity"]
-        rainPulses = data["rainPulses"]
+        return deviceId, values, receivedData.get("timestamp")
+
+    def sampleTimestamp(self, deviceTimestamp, receivedTimestamp):
+        """Get the timestamp of a sample
+
+        Args:
+            deviceTimestamp: the timestamp sent by the device in milliseconds or None
+            receivedTimestamp: the reception time of the message in seconds
+        Returns:
+            the timestamp in seconds sent by the device if it is valid, otherwise the reception time
+
+        """
+        if deviceTimestamp is None:
+            return receivedTimestamp
 
-        currentTimestamp = int(time.time())
+        try:
+            timestamp = deviceTimestamp / 1000.0
+        except TypeError:
+            return receivedTimestamp
+
+        if not receivedTimestamp - self.maxTimestampAge <= timestamp <= receivedTimestamp + self.maxTimestampAhead:
+            logging.warning("sampleTimestamp: Invalid device timestamp: %s. Reception time: %s", deviceTimestamp, receivedTimestamp)
+            return receivedTimestamp
 
-        self.dataBuffer[deviceId].append([currentTimestamp, temperature, humidity, rainPulses])
+        return timestamp
 
+    def saveRealtimeData(self, receivedData):
+        """Save a decoded realtime message in the buffer
 
-    def getDataFromBuffer(self, deviceId):
-        """This function gets the data from the buffer and then calculates the weighted arithmetic mean
         Args:
-            serialNumber: a string with the serial number of the device
+            receivedData: a dict with the deviceId and the data of the message
            
         Returns:
-           a list containing the timestamp and the agregated values in the same order as there were saved
+           Does not return anything
 
         """
+        parsed = self.parseRealtimeData(receivedData)
+        if parsed is None:
+            return
 
-        # Is the serial number in the buffer data
-        if not deviceId in self.dataBuffer:
-            logging.warning('getDataFromBuffer: the serial number could not be found in the buffer. serialNumber: %s' % deviceId)
-            return 
+        deviceId, values, deviceTimestamp = parsed
+        self.received += 1
 
-        # Create a local copy of the buffer
-        dataBuffer = self.dataBuffer[deviceId]
-        # Clear the selected buffer
-        self.dataBuffer[deviceId] = []
+        timestamp = self.sampleTimestamp(deviceTimestamp, receivedTimestamp())
 
-        # First check if there are any data in the buffer
-        if not dataBuffer:
-            logging.warning('getDataFromBuffer: data buffer empty, nothing to do.')
+        try:
+            self.dataBuffer.append(deviceId, timestamp, values)
+        except (TypeError, ValueError) as e:
+            logging.error("saveRealtimeData: Invalid value in the received data. receivedData: %s. Exception: %s", receivedData, e)
             return
 
-        try:
-            # Calculate the elapsed time between the extremes values
-            totalTime = dataBuffer[-1][0] - dataBuffer[0][0]
+        self.metrics.increment("samples_buffered_total")
+
+    def processMessages(self, messages):
+        """Decode a batch of realtime messages taken from the MessageBatcher and save them in the buffer,
+           appending the samples of each device together
+
+        Args:
+            messages: a list of (topic, payload, receivedTimestamp, receivedMonotonic) tuples
+           
+        Returns:
+           Does not return anything
 
-            # If not time has transcurred or the data is not ordered, return the last value
-            if totalTime <= 0:
-                logging.warning('getDataFromBuffer: the time transcurred between the data points is not valid. totalTime: %s.' % totalTime)
-                return dataBuffer[-1]
+        """
+        jsonMessages = []
+        binaryMessages = []
+        for message in messages:
+            if message[0].endswith("/bin"):
+                binaryMessages.append(message)
+            else:
+                jsonMessages.append(message)
+
+        # deviceId -> [(timestamp, values), ...]
+        samples = {}
+        count = 0
+        failures = 0
+        for decode, batch in ((decoding.loadsMany, jsonMessages), (decoding.loadsRealtimeBinaryMany, binaryMessages)):
+            if not batch:
+                continue
+
+            for (topic, payload, received, _), receivedData in zip(batch, decode([message[1] for message in batch])):
+                if receivedData is None:
+                    failures += 1
+                    logging.error("processMessages: The received data could not be decoded. topic: %s. receivedData: %s", topic, payload)
+                    continue
+
+                parsed = self.parseRealtimeData(receivedData)
+                if parsed is None:
+                    continue
+
+                deviceId, values, deviceTimestamp = parsed
+                samples.setdefault(deviceId, []).append((self.sampleTimestamp(deviceTimestamp, received), values))
+                self.received += 1
+                count += 1
+
+        failed = self.dataBuffer.appendMany(samples)
+        for deviceId, timestamp, values, e in failed:
+            logging.error("processMessages: Invalid value in the received data. deviceId: %s. values: %s. Exception: %s", deviceId, values, e)
+
+        # The metrics are updated once per batch
+        if failures:
+            self.metrics.increment("decode_failures_total", failures)
+        self.metrics.increment("samples_buffered_total", count - len(failed))
+
+        processedTime = time.monotonic()
+        self.metrics.observeMany("callback_latency_seconds", [processedTime - message[3] for message in messages])
+
+
+    def getDataFromBuffer(self, generation):
+        """This function gets the weighted arithmetic mean of the data buffered for every device
+        Args:
+            generation: a dict with the RunningAggregate of each device taken from a swapped buffer generation
+           
+        Returns:
+           a dict with the Aggregate of each device, indexed by deviceId
 
-            # Initialize the list
-            agregatedValues = [0.0] * len(dataBuffer[0][1:])
+        """
 
-            # Calculate the average value from all the data considering the time elapsed between each point
-            for index, data in enumerate(dataBuffer[:-1]):
-                timestamp = data[0]
-                deltaTime = dataBuffer[index+1][0] - timestamp
+        # First check if there are any data in the buffer
+        if not generation:
+            logging.debug('getDataFromBuffer: data buffer empty, nothing to do.')
+            return {}
 
-                # Process the different data features
-                for i, value in enumerate(data[1:]):
-                    agregatedValues[i] += deltaTime * value
-                    
+        try:
+            result = {}
+            for deviceId, runningAggregate in generation.items():
+                if runningAggregate.late:
+                    logging.warning('getDataFromBuffer: %s out of order samples ignored in the mean. deviceId: %s', runningAggregate.late, deviceId)
 
-            # Calculate the final value for each feature
-            for index, agregatedValue in enumerate(agregatedValues):
-                agregatedValues[index] = agregatedValue / totalTime
+                data = runningAggregate.result()
+                if data:
+                    result[deviceId] = data
 
-            return [dataBuffer[0][0]] + agregatedValues
+            return result
 
         except Exception as e:
-            logging.error('getDataFromBuffer: The buffer data cant be processed. Probably because of an invalid value. Exception: %s' % e)
+            logging.error('getDataFromBuffer: The buffer data cant be processed. Probably because of an invalid value. Exception: %s', e)
 
-        return  
+        return {}
 
     def saveBufferedData(self, stopThread):
         """
@@ -407,21 +755,146 @@ class Carrascas():
 
         """
 
-        while not stopThread.isSet():
-            for deviceId in self.dataBuffer:
-
-                data = self.getDataFromBuffer(deviceId)
+        while True:
+            # Take the samples received until now, new samples go to an empty generation
+            generation, spoolGroup = self.dataBuffer.swap()
 
-                if data:
+            # Its copy in the spool is deleted once the data is saved
+            self.saveGeneration(generation, partial(self.spool.release, spoolGroup) if self.spool is not None else None)
 
-                    currentTimestamp, temperature, humidity, rainPulses = data
+            # The last cycle saves the data received until the stop
+            if stopThread.is_set():
+                break
 
-                    while not self.db.insert('''INSERT INTO data (deviceId, temperature, humidity, rainPulses, currentTimestamp) VALUES (?,?,?,?,?)''',
-                                                    [deviceId, temperature, humidity, rainPulses, currentTimestamp]):
-                        logging.error("saveBufferedData: Reintentando guardar los datos...")
-                        time.sleep(0.5)
             stopThread.wait(60)
 
+    def saveGeneration(self, generation, onCommit=None):
+        """Save the aggregated data of a buffer generation and update the rollups in the same commit
+
+        Args:
+            generation: a dict with the RunningAggregate of each device
+            onCommit: optional function called once the data is saved
+        Returns:
+           it does not return anything
+
+        """
+        # Gather the aggregated data from all the devices
+        rows = []
+        startTime = time.time()
+        aggregates = list(self.getDataFromBuffer(generation).items())
+        self.metrics.observe("aggregation_seconds", time.time() - startTime)
+        for deviceId, data in aggregates:
+
+            temperature, humidity, rainPulses = data.mean
+            rows.append([deviceId, temperature, humidity, rainPulses, data.timestamp])
+
+        if not rows:
+            if onCommit is not None:
+                onCommit()
+            return
+
+        def committed():
+            # The cache only serves rows that a reader of the database would also see
+            self.cache.update(rows)
+            if onCommit is not None:
+                onCommit()
+
+        # Wait if the writer queue is full, the data of this cycle is not dropped
+        batch = [self.db.dataOperation(rows)]
+        batch.extend(rollupOperations(aggregates))
+        self.writer.putBatch(batch, block=True, onCommit=committed)
+
+    def replaySpool(self):
+        """Save the samples left in the spool by the previous execution, as a single aggregate per device
+
+        Args:
+            ---
+        Returns:
+           it does not return anything
+
+        """
+        if self.spool is None or not self.spool.recovered:
+            return
+
+        samples = self.spool.replay()
+        logging.warning("replaySpool: %s samples recovered from %s spool files", len(samples), len(self.spool.recovered))
+
+        recoveredBuffer = IngestBuffer(config.getfloat('INGEST', 'reorderWindow', fallback=5))
+        for deviceId, timestamp, values in samples:
+            recoveredBuffer.append(deviceId, timestamp, values)
+
+        # The recovered buffer has no spool, its files are deleted all together
+        generation, _ = recoveredBuffer.swap()
+        self.saveGeneration(generation, self.spool.discardRecovered)
+
+    def getStats(self):
+        """Get the ingest metrics of this instance
+
+        Args:
+            ---
+        Returns:
+            a dict with the number of messages received, the devices in the buffer and the metrics of the batcher, the writer and the cache
+
+        """
+        stats = {"received": self.received, "buffered": len(self.dataBuffer)}
+
+        if self.batcher is not None:
+            stats.update({"pending": len(self.batcher), "batches": self.batcher.batches, "batchDropped": self.batcher.dropped})
+
+        # The writer and the cache are created with the first connection
+        if hasattr(self, 'writer'):
+            stats.update(self.writer.getStats())
+            stats.update(self.cache.getStats())
+        if hasattr(self, 'retentionEngine'):
+            stats.update(self.retentionEngine.getStats())
+
+        return stats
+
+    def collectMetrics(self):
+        """Read the metrics kept by this instance and its components, for the Metrics registry
+
+        Args:
+            ---
+        Returns:
+            a list of (name, type, value, labels) tuples
+
+        """
+        depths = self.dataBuffer.depths()
+
+        samples = [("messages_received_total", "counter", self.received, None),
+                   ("buffered_samples", "gauge", sum(depths.values()), None)]
+        samples.extend(("device_buffered_samples", "gauge", depth, {"deviceId": deviceId}) for deviceId, depth in depths.items())
+
+        if self.batcher is not None:
+            samples.extend([("batcher_pending", "gauge", len(self.batcher), None),
+                            ("batcher_dropped_total", "counter", self.batcher.dropped, None)])
+
+        # The writer is created with the first connection
+        if hasattr(self, 'writer'):
+            samples.extend([("db_retries_total", "counter", self.writer.retries, None),
+                            ("db_dropped_total", "counter", self.writer.dropped, None),
+                            ("db_queued", "gauge", self.writer.queue.qsize(), None),
+                            ("db_rows_written_total", "counter", self.writer.written, None)])
+
+        if self.spool is not None:
+            samples.append(("spool_skipped_total", "counter", self.spool.skipped, None))
+
+        return samples
+
+    def publishStats(self, stopThread):
+        """Publish the metrics in the stats topic every statsInterval seconds until the threads are stopped
+
+        Args:
+            stopThread: event set to stop the thread
+        Returns:
+           it does not return anything
+
+        """
+        while not stopThread.wait(self.statsInterval):
+            stats = self.metrics.snapshot()
+            stats["pid"] = os.getpid()
+            self.publish(self.topicStats, json.dumps(stats))
+
     def stop(self):
         """
         This stops and disconnects gracefully all the opened tasks
@@ -433,21 +906,76 @@ class Carrascas():
 
         """
 
+        stopTime = time.time()
+
         # Disconnect the MQTT client
         self.client.disconnect()
 
+        # Process the messages already received
+        if self.batcher is not None:
+            self.batcher.stop()
+
+        # The threads are started with the first connection
+        if not hasattr(self, 'db'):
+            self.client.loop_stop()
+            if self.spool is not None:
+                self.spool.close()
+            return
+
+        if self.queryServer is not None:
+            self.queryServer.stop()
+
         # Stop the threads
-        r.stopThreads.set()
+        self.stopThreads.set()
         # Wait for the thread to stop for 60 seconds max
-        r.saveBufferedDataThread.join(60)
+        self.saveBufferedDataThread.join(60)
+        if self.weather:
+            self.backgroundJobsThread.join(60)
+            if hasattr(self, 'weatherScheduler'):
+                self.weatherScheduler.stop()
+                self.retentionEngine.stop()
+            if self.jobsLock is not None:
+                self.jobsLock.close()
+
+        # Save the operations still queued
+        self.writer.stop()
+
+        # The spool files of the data saved have been deleted, the rest are replayed in the next start
+        if self.spool is not None:
+            self.spool.close()
+
+        logging.info("stop: disconnected at %.3f. Data saved in %.3f s", stopTime, time.time() - stopTime)
+        self.client.loop_stop()
+
+
+def shardOf(deviceId, count):
+    """Get the partition of a device. The hash is stable between processes and restarts
+
+    Args:
+        deviceId: the identifier of the device
+        count: the number of partitions
+    Returns:
+        the index of the partition, from 0 to count - 1
+
+    """
+    return zlib.crc32(str(deviceId).encode()) % count
 
    
+def handleTerminate(signum, frame):
+    """Convierte el SIGTERM del updater en una parada ordenada"""
+
+    raise SystemExit(0)
+
+
 if __name__ == '__main__':
 
     try:
         r = Carrascas()
+        # With SIGTERM the buffers are saved before exiting, the same as with Ctrl+C
+        signal.signal(signal.SIGTERM, handleTerminate)
         signal.pause()
-    except KeyboardInterrupt:
+    except (KeyboardInterrupt, SystemExit):
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
         print("Parando la aplicacion...")
         r.stop()
-        print("La aplicacion se ha cerrado")
\ No newline at end of file
+        print("La aplicacion se ha cerrado")
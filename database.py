@@ -1,29 +1,236 @@
 import logging
 import sqlite3 #Conexion con la base de datos
+import threading
+
+# Migraciones del esquema de la base de datos. La version aplicada se guarda en PRAGMA user_version
+# y cada migracion se aplica una sola vez, en orden, dentro de una transaccion
+MIGRATIONS = [
+    # 1: Initial schema
+    '''CREATE TABLE IF NOT EXISTS `devices` (
+        `deviceId`	INTEGER,
+        PRIMARY KEY(`deviceId`)
+    );
+    CREATE TABLE IF NOT EXISTS "data" (
+        `dataId`	INTEGER PRIMARY KEY AUTOINCREMENT,
+        `deviceId`	INTEGER,
+        `temperature`	REAL,
+        `humidity`	REAL,
+        `rainPulses`	INTEGER,
+        `currentTimestamp`	INTEGER,
+        FOREIGN KEY(`deviceId`) REFERENCES `devices`(`deviceId`)
+    );''',
+
+    # 2: Covering index for the time series queries and the hourly and daily rollups
+    '''CREATE INDEX IF NOT EXISTS `dataDeviceTimestamp` ON `data` (`deviceId`, `currentTimestamp`, `temperature`, `humidity`, `rainPulses`);
+    CREATE TABLE IF NOT EXISTS `dataHourly` (
+        `deviceId`	INTEGER,
+        `bucketTimestamp`	INTEGER,
+        `samples`	INTEGER,
+        `temperatureSum`	REAL,
+        `temperatureMin`	REAL,
+        `temperatureMax`	REAL,
+        `humiditySum`	REAL,
+        `humidityMin`	REAL,
+        `humidityMax`	REAL,
+        `rainPulsesSum`	REAL,
+        `rainPulsesMin`	REAL,
+        `rainPulsesMax`	REAL,
+        PRIMARY KEY(`deviceId`, `bucketTimestamp`)
+    );
+    CREATE TABLE IF NOT EXISTS `dataDaily` (
+        `deviceId`	INTEGER,
+        `bucketTimestamp`	INTEGER,
+        `samples`	INTEGER,
+        `temperatureSum`	REAL,
+        `temperatureMin`	REAL,
+        `temperatureMax`	REAL,
+        `humiditySum`	REAL,
+        `humidityMin`	REAL,
+        `humidityMax`	REAL,
+        `rainPulsesSum`	REAL,
+        `rainPulsesMin`	REAL,
+        `rainPulsesMax`	REAL,
+        PRIMARY KEY(`deviceId`, `bucketTimestamp`)
+    );
+    INSERT OR IGNORE INTO `dataHourly`
+        SELECT deviceId, currentTimestamp - currentTimestamp % 3600, count(*),
+               sum(temperature), min(temperature), max(temperature),
+               sum(humidity), min(humidity), max(humidity),
+               sum(rainPulses), min(rainPulses), max(rainPulses)
+        FROM data GROUP BY 1, 2;
+    INSERT OR IGNORE INTO `dataDaily`
+        SELECT deviceId, currentTimestamp - currentTimestamp % 86400, count(*),
+               sum(temperature), min(temperature), max(temperature),
+               sum(humidity), min(humidity), max(humidity),
+               sum(rainPulses), min(rainPulses), max(rainPulses)
+        FROM data GROUP BY 1, 2;''',
+
+    # 3: Observations and forecasts downloaded from AEMET
+    '''CREATE TABLE IF NOT EXISTS `observations` (
+        `idema`	TEXT,
+        `observationTimestamp`	INTEGER,
+        `ta`	REAL,
+        `hr`	REAL,
+        `prec`	REAL,
+        `tamin`	REAL,
+        `tamax`	REAL,
+        PRIMARY KEY(`idema`, `observationTimestamp`)
+    );
+    CREATE TABLE IF NOT EXISTS `forecasts` (
+        `municipio`	TEXT,
+        `fecha`	TEXT,
+        `elaborado`	TEXT,
+        `probPrecipitacion`	INTEGER,
+        PRIMARY KEY(`municipio`, `fecha`)
+    );''',
+
+    # 4: Forecasts by period and indexes by date
+    '''CREATE TABLE IF NOT EXISTS `forecastPeriods` (
+        `municipio`	TEXT,
+        `fecha`	TEXT,
+        `periodo`	TEXT,
+        `elaborado`	TEXT,
+        `probPrecipitacion`	INTEGER,
+        `estadoCielo`	TEXT,
+        `temperaturaMaxima`	REAL,
+        `temperaturaMinima`	REAL,
+        PRIMARY KEY(`municipio`, `fecha`, `periodo`)
+    );
+    CREATE INDEX IF NOT EXISTS `forecastPeriodsFecha` ON `forecastPeriods` (`fecha`);
+    CREATE INDEX IF NOT EXISTS `forecastsFecha` ON `forecasts` (`fecha`);''',
+
+    # 5: Progress of the retention jobs
+    '''CREATE TABLE IF NOT EXISTS `retention` (
+        `job`	TEXT,
+        `timestamp`	INTEGER,
+        PRIMARY KEY(`job`)
+    );''',
+]
+
+# Formatos disponibles para la tabla data:
+#   rowid: el formato original, con un dataId AUTOINCREMENT como clave
+#   compact: tabla WITHOUT ROWID con (deviceId, currentTimestamp) como clave
+#   fixed: como compact, pero con la temperatura y la humedad guardadas como enteros en centesimas
+DATA_LAYOUTS = {
+    "rowid": '''CREATE TABLE IF NOT EXISTS "%s" (
+        `dataId`	INTEGER PRIMARY KEY AUTOINCREMENT,
+        `deviceId`	INTEGER,
+        `temperature`	REAL,
+        `humidity`	REAL,
+        `rainPulses`	INTEGER,
+        `currentTimestamp`	INTEGER,
+        FOREIGN KEY(`deviceId`) REFERENCES `devices`(`deviceId`)
+    )''',
+    "compact": '''CREATE TABLE IF NOT EXISTS "%s" (
+        `deviceId`	INTEGER,
+        `currentTimestamp`	INTEGER,
+        `temperature`	REAL,
+        `humidity`	REAL,
+        `rainPulses`	INTEGER,
+        PRIMARY KEY(`deviceId`, `currentTimestamp`)
+    ) WITHOUT ROWID''',
+    "fixed": '''CREATE TABLE IF NOT EXISTS "%s" (
+        `deviceId`	INTEGER,
+        `currentTimestamp`	INTEGER,
+        `temperature`	INTEGER,
+        `humidity`	INTEGER,
+        `rainPulses`	INTEGER,
+        PRIMARY KEY(`deviceId`, `currentTimestamp`)
+    ) WITHOUT ROWID''',
+}
+
+# Escala de los valores guardados en formato fixed
+FIXED_POINT_SCALE = 100
+
+
+def isTransientError(e):
+    """Comprueba si un error de escritura desaparece al reintentar la operacion
+
+    Args:
+        e: la excepcion lanzada al escribir
+    Returns:
+        True si la base de datos estaba bloqueada u ocupada por otra conexion, o cerrada y ya se ha
+        vuelto a abrir. Cualquier otro error (valores fuera de rango, claves repetidas...) se repite
+        siempre con los mismos datos
+    """
+    if isinstance(e, sqlite3.OperationalError):
+        return "locked" in str(e) or "busy" in str(e)
+
+    return isinstance(e, sqlite3.ProgrammingError) and "Cannot operate on a closed database" in str(e)
+
 
 class Database():
     """Esta clase gestiona todas las tareas relacionadas con la base de datoss
 
+    Todas las escrituras se hacen a traves de una unica conexion de escritura protegida por un lock.
+    Las lecturas usan una conexion propia de cada thread, que en modo WAL pueden ejecutarse
+    a la vez que se escribe.
+
+    El formato de la tabla data se detecta al abrir la base de datos. El parametro layout solo
+    se utiliza si la tabla todavia no existe.
+
     Args:
-        dbPath: la ruta del fichero de la base de datos"""
+        dbPath: la ruta del fichero de la base de datos
+        layout: formato de la tabla data si se crea la base de datos, uno de DATA_LAYOUTS"""
         
-    def __init__(self, dbPath):
+    def __init__(self, dbPath, layout="rowid"):
         #Ruta de la base de datoss
         self.dbPath = dbPath
 
+        # Only one thread can use the writer connection at the same time
+        self.writeLock = threading.RLock()
+        # Exception of the last insertBatch that failed, used by the writer to decide if it is retried
+        self.lastError = None
+
+        # Reader connections, one per thread
+        self.local = threading.local()
+        self.readers = []
+        self.readersLock = threading.Lock()
+
         #Nos conectamos con la base de datos
         self.connect()
+
+        # Create the data table with the requested layout if it is a new database
+        if layout not in DATA_LAYOUTS:
+            raise ValueError("Unknown data layout: %s" % layout)
+        self.executescript(DATA_LAYOUTS[layout] % "data")
+
+        # Bring the schema up to date
+        self.migrate()
+
+        self.layout = self.detectLayout()
+
+        # The key of the compact layouts already covers the time series queries
+        if self.layout != "rowid":
+            self.executescript("DROP INDEX IF EXISTS `dataDeviceTimestamp`;")
+
+    def openConnection(self, writer=False):
+        """Abre una nueva conexion con la base de datos
+
+        Args:
+            writer: True si es la conexion de escritura
+        Returns:
+            la conexion abierta
+        """
+        conn = sqlite3.connect(self.dbPath, check_same_thread=False)
+        # A new database releases the space of the deleted rows with incremental_vacuum. It must be set
+        # before the file is initialized, and has no effect on an existing one until it is rebuilt with VACUUM.
+        # Only the writer sets it, the pragma waits for the write lock and would block a new reader during a commit
+        if writer:
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA busy_timeout = 30000")   # 30 s
+        #Configuramos el conector para que devuelva cada fila como un diccionario
+        conn.row_factory = sqlite3.Row
+
+        return conn
         
     def connect(self):
-        """Inicializa la conexion con la base de datos
+        """Inicializa la conexion de escritura con la base de datos
         """
         try:
             logging.debug("Database connect: Starting the database...")
-            self.conn = sqlite3.connect(self.dbPath, check_same_thread=False)
-            self.conn.execute("PRAGMA journal_mode=WAL")
-            self.conn.execute("PRAGMA busy_timeout = 30000")   # 30 s
-            #Configuramos el conector para que devuelva cada fila como un diccionario
-            self.conn.row_factory = sqlite3.Row
+            self.conn = self.openConnection(writer=True)
 
             self.cursor = self.conn.cursor()
             logging.debug("Database connect: Connected to the database.")
@@ -31,7 +238,180 @@ class Database():
         except Exception as e:
             logging.error("Database connect: Could not start the database")
             #Atencion datos sensibles. NO mostar en produccion.
-            logging.debug("Database connect: Exception: %s" % e)
+            logging.debug("Database connect: Exception: %s", e)
+
+    def migrate(self):
+        """Aplica las migraciones del esquema que todavia no se han aplicado
+
+        Returns:
+            devuelve la version del esquema despues de aplicar las migraciones
+        """
+        with self.writeLock:
+            version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+
+            for index, migration in enumerate(MIGRATIONS[version:], version + 1):
+                logging.info("Database migrate: Applying the migration: %s", index)
+
+                if not self.executescript("BEGIN;\n%s\nPRAGMA user_version = %d;\nCOMMIT;" % (migration, index)):
+                    logging.error("Database migrate: Could not apply the migration: %s", index)
+                    # Discard the partial migration
+                    try:
+                        self.conn.execute("ROLLBACK")
+                    except Exception:
+                        pass
+                    break
+
+                version = index
+
+        return version
+
+    def detectLayout(self):
+        """Detecta el formato de la tabla data
+
+        Returns:
+            el nombre del formato, uno de DATA_LAYOUTS
+        """
+        with self.writeLock:
+            row = self.conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'data'").fetchone()
+            if "WITHOUT ROWID" not in row["sql"].upper():
+                return "rowid"
+
+            columns = dict((column["name"], column["type"]) for column in self.conn.execute("PRAGMA table_info(data)"))
+            if columns["temperature"].upper() == "INTEGER":
+                return "fixed"
+
+        return "compact"
+
+    def dataOperation(self, rows):
+        """Devuelve la operacion que guarda filas en la tabla data segun su formato
+
+        Args:
+            rows: lista de filas [deviceId, temperature, humidity, rainPulses, currentTimestamp]
+        Returns:
+            una tupla (query, valuesList) para insertMany, insertBatch o DatabaseWriter
+        """
+        if self.layout == "rowid":
+            return ('''INSERT INTO data (deviceId, temperature, humidity, rainPulses, currentTimestamp) VALUES (?,?,?,?,?)''', rows)
+
+        if self.layout == "fixed":
+            rows = [[deviceId, int(round(temperature * FIXED_POINT_SCALE)), int(round(humidity * FIXED_POINT_SCALE)), rainPulses, currentTimestamp]
+                    for deviceId, temperature, humidity, rainPulses, currentTimestamp in rows]
+
+        # The key is (deviceId, currentTimestamp), a repeated row replaces the previous one instead of failing the whole commit
+        return ('''INSERT OR REPLACE INTO data (deviceId, temperature, humidity, rainPulses, currentTimestamp) VALUES (?,?,?,?,?)''', rows)
+
+    def dataColumns(self):
+        """Devuelve las columnas de la tabla data para una select, con los valores ya decodificados
+
+        Returns:
+            un string con las columnas deviceId, temperature, humidity, rainPulses y currentTimestamp
+        """
+        if self.layout == "fixed":
+            return "deviceId, temperature / %(scale)s.0 AS temperature, humidity / %(scale)s.0 AS humidity, rainPulses, currentTimestamp" % {"scale": FIXED_POINT_SCALE}
+
+        return "deviceId, temperature, humidity, rainPulses, currentTimestamp"
+
+    def getDeviceIds(self, table="data"):
+        """Devuelve los dispositivos que tienen filas en una tabla, esten o no en la tabla devices
+
+        Args:
+            table: nombre de la tabla, con un indice que empieza por deviceId (data, dataHourly o dataDaily)
+        Returns:
+            una lista ordenada con los deviceId
+        """
+        # Each step jumps to the next deviceId of the index instead of reading all the rows, as a DISTINCT would
+        query = '''WITH RECURSIVE ids(deviceId) AS (
+                       SELECT min(deviceId) FROM %(table)s
+                       UNION ALL
+                       SELECT (SELECT min(deviceId) FROM %(table)s WHERE deviceId > ids.deviceId) FROM ids WHERE ids.deviceId IS NOT NULL)
+                   SELECT deviceId FROM ids WHERE deviceId IS NOT NULL''' % {"table": table}
+
+        return [row["deviceId"] for row in self.iterate(query, [])]
+
+    def migrateLayout(self, layout):
+        """Convierte la tabla data a otro formato, copiando todos los datos. Bloquea las escrituras mientras dura
+
+        Args:
+            layout: el nuevo formato, uno de DATA_LAYOUTS
+        Returns:
+            devulve true si la tabla se ha convertido de forma correcta.
+        """
+        if layout not in DATA_LAYOUTS:
+            raise ValueError("Unknown data layout: %s" % layout)
+
+        if layout == self.layout:
+            return 1
+
+        with self.writeLock:
+            # Decode the values from the current layout and encode them for the new one
+            columns = self.dataColumns()
+            if layout == "fixed":
+                columns = "deviceId, CAST(round(temperature * %(scale)s) AS INTEGER), CAST(round(humidity * %(scale)s) AS INTEGER), rainPulses, currentTimestamp" % {"scale": FIXED_POINT_SCALE}
+                columns = "SELECT %s FROM (SELECT %s FROM data)" % (columns, self.dataColumns())
+            else:
+                columns = "SELECT %s FROM data" % columns
+
+            # The rowid layout keeps all the rows, the others have a key and keep the last row of each key
+            insert = "INSERT INTO" if layout == "rowid" else "INSERT OR REPLACE INTO"
+
+            script = '''BEGIN;
+                DROP TABLE IF EXISTS dataMigration;
+                %(create)s;
+                %(insert)s dataMigration (deviceId, temperature, humidity, rainPulses, currentTimestamp) %(select)s ORDER BY deviceId, currentTimestamp;
+                DROP TABLE data;
+                ALTER TABLE dataMigration RENAME TO data;
+                %(index)s
+                COMMIT;''' % {"create": DATA_LAYOUTS[layout] % "dataMigration",
+                                "insert": insert,
+                                "select": columns,
+                                # The key of the other layouts already covers the time series queries
+                                "index": "CREATE INDEX IF NOT EXISTS `dataDeviceTimestamp` ON `data` (`deviceId`, `currentTimestamp`, `temperature`, `humidity`, `rainPulses`);" if layout == "rowid" else ""}
+
+            logging.info("Database migrateLayout: Converting the data table from %s to %s", self.layout, layout)
+
+            if not self.executescript(script):
+                logging.error("Database migrateLayout: Could not convert the data table")
+                try:
+                    self.conn.execute("ROLLBACK")
+                except Exception:
+                    pass
+                return 0
+
+            self.layout = self.detectLayout()
+
+        return 1
+
+    def readerConnection(self):
+        """Devuelve la conexion de lectura del thread actual, abriendola si es necesario
+
+        Returns:
+            la conexion de lectura del thread
+        """
+        conn = getattr(self.local, 'conn', None)
+
+        if conn is None:
+            logging.debug("Database readerConnection: Opening a reader connection for the thread: %s", threading.current_thread().name)
+            conn = self.openConnection()
+            self.local.conn = conn
+            with self.readersLock:
+                self.readers.append(conn)
+
+        return conn
+
+    def closeReaderConnection(self):
+        """Cierra la conexion de lectura del thread actual, se abrira una nueva en la siguiente lectura
+        """
+        conn = getattr(self.local, 'conn', None)
+
+        if conn is not None:
+            self.local.conn = None
+            with self.readersLock:
+                if conn in self.readers:
+                    self.readers.remove(conn)
+            try:
+                conn.close()
+            except Exception:
+                pass
 
     def insert(self, query, values, getKey=0):
         """Realiza una operacion de insert/update sobre la base de datos configurada
@@ -46,30 +426,92 @@ class Database():
 
         """
         if query:
+            with self.writeLock:
+                try:
+                    # Insert data
+                    self.cursor.execute(query, values)
+
+                    # Save (commit) the changes
+                    self.conn.commit()
+
+                    #Return the inserted key
+                    if getKey:
+                        return self.cursor.lastrowid
+
+                    return 1
+
+                #Si la base de datos esta cerrada la abrimos:
+                except sqlite3.ProgrammingError as e:
+                    logging.debug("insert: Exception: %s", e)
+                    if "Cannot operate on a closed database" in str(e):
+                        self.connect()
+
+                except Exception as e:
+
+                    logging.error('insert: Exception when trying to perform an insert')
+                    #Importante: nunca mostrar trazas de debug en entorno de produccion, estamos exponiendo datos potencialmente sensibles.
+                    logging.debug('insert: Detalles de la excepcion: ' + str(e))
+
+        return 0
+
+    def insertMany(self, query, valuesList):
+        """Realiza la misma operacion de insert/update para cada lista de valores,
+        todo dentro de una unica transaccion (un solo commit)
+
+        Args:
+            query: un string con la query a ejecutar
+            valuesList: una lista de arrays, cada uno con los valores a pasar como parametros a la query
+        Returns:
+            devulve true si todas las filas se han guardado de forma correcta.
+            Si falla no se guarda ninguna fila.
+
+        """
+        if query:
+            return self.insertBatch([(query, valuesList)])
+
+        return 0
+
+    def insertBatch(self, batch):
+        """Realiza varias operaciones de insert/update dentro de una unica transaccion (un solo commit)
+
+        Args:
+            batch: una lista de tuplas (query, valuesList). Cada query se ejecuta con cada una de las
+                   listas de valores de su valuesList
+        Returns:
+            devulve true si todas las operaciones se han guardado de forma correcta.
+            Si falla no se guarda ninguna.
+
+        """
+        with self.writeLock:
             try:
-                # Insert data
-                self.cursor.execute(query, values)
+                # Insert all the rows in the same transaction
+                for query, valuesList in batch:
+                    self.cursor.executemany(query, valuesList)
 
                 # Save (commit) the changes
                 self.conn.commit()
 
-                #Return the inserted key
-                if getKey:
-                    return self.cursor.lastrowid
-
                 return 1
 
             #Si la base de datos esta cerrada la abrimos:
             except sqlite3.ProgrammingError as e:
-                logging.debug("insert: Exception: %s" % e)
+                self.lastError = e
+                logging.debug("insertBatch: Exception: %s", e)
                 if "Cannot operate on a closed database" in str(e):
                     self.connect()
 
             except Exception as e:
+                self.lastError = e
 
-                logging.error('insert: Exception when trying to perform an insert')
+                logging.error('insertBatch: Exception when trying to perform a bulk insert')
                 #Importante: nunca mostrar trazas de debug en entorno de produccion, estamos exponiendo datos potencialmente sensibles.
-                logging.debug('insert: Detalles de la excepcion: ' + str(e))
+                logging.debug('insertBatch: Detalles de la excepcion: ' + str(e))
+
+                # Discard the partial batch, it will be retried as a whole
+                try:
+                    self.conn.rollback()
+                except Exception:
+                    pass
 
         return 0
 
@@ -84,31 +526,32 @@ class Database():
 
         """
         if query:
-            try:
-                # Insert data
-                self.cursor.executescript(query)
+            with self.writeLock:
+                try:
+                    # Insert data
+                    self.cursor.executescript(query)
 
-                # Save (commit) the changes
-                self.conn.commit()
+                    # Save (commit) the changes
+                    self.conn.commit()
 
-                return 1
+                    return 1
 
-            #Si la base de datos esta cerrada la abrimos:
-            except sqlite3.ProgrammingError as e:
-                logging.debug("executescript: Exception: %s" % e)
-                if "Cannot operate on a closed database" in str(e):
-                    self.connect()
+                #Si la base de datos esta cerrada la abrimos:
+                except sqlite3.ProgrammingError as e:
+                    logging.debug("executescript: Exception: %s", e)
+                    if "Cannot operate on a closed database" in str(e):
+                        self.connect()
 
-            except Exception as e:
+                except Exception as e:
 
-                logging.error('executescript: Exception when trying to executescript')
-                #Importante: nunca mostrar trazas de debug en entorno de produccion, estamos exponiendo datos potencialmente sensibles.
-                logging.debug('executescript: Exception details: ' + str(e))
+                    logging.error('executescript: Exception when trying to executescript')
+                    #Importante: nunca mostrar trazas de debug en entorno de produccion, estamos exponiendo datos potencialmente sensibles.
+                    logging.debug('executescript: Exception details: ' + str(e))
 
         return 0
 
     def select(self, query, values, scalar=0):
-        """Realiza una operacion de select sobre la base de datos configurada
+        """Realiza una operacion de select sobre la base de datos configurada, usando la conexion de lectura del thread
 
         Args:
             query: un string con la query a ejecutar
@@ -121,26 +564,26 @@ class Database():
         """
         if query:
             try:
-                # Insert data
-                self.cursor.execute(query, values)
+                # Select data
+                cursor = self.readerConnection().execute(query, values)
 
                 #In case we want to return a single result
                 if scalar:
-                    result = self.cursor.fetchone()
+                    result = cursor.fetchone()
                     if result is not None:
                         return result[0]
                     else:
                         return 0
 
                 #Rerturn all the data
-                r = self.cursor.fetchall()          
+                r = cursor.fetchall()          
                 return r    
 
             #Si la base de datos esta cerrada la abrimos:
             except sqlite3.ProgrammingError as e:
-                logging.debug("insert: Exception: %s" % e)
+                logging.debug("select: Exception: %s", e)
                 if "Cannot operate on a closed database" in str(e):
-                    self.connect()
+                    self.closeReaderConnection()
 
             except Exception as e:
                 logging.error('select: Exception when trying to perform a select')
@@ -150,7 +593,68 @@ class Database():
         return 0
 
 
+    def iterate(self, query, values, chunkSize=500):
+        """Realiza una select y devuelve las filas poco a poco, sin cargar todo el resultado en memoria.
+           Usa la conexion de lectura del thread, por lo que el generador se debe consumir en el mismo thread
+
+        Args:
+            query: un string con la query a ejecutar
+            values: un array con la lista de valores a pasar como parametros a la query
+            chunkSize: numero de filas que se leen de la base de datos cada vez
+        Returns:
+            un generador con las filas devueltas por la query
+
+        """
+        try:
+            # sqlite3 keeps the prepared statements of the connection, a repeated query is not compiled again
+            cursor = self.readerConnection().execute(query, values)
+
+            while True:
+                rows = cursor.fetchmany(chunkSize)
+                if not rows:
+                    break
+
+                for row in rows:
+                    yield row
+
+        except sqlite3.ProgrammingError as e:
+            logging.debug("iterate: Exception: %s", e)
+            if "Cannot operate on a closed database" in str(e):
+                self.closeReaderConnection()
+
+        except sqlite3.Error as e:
+            logging.error('iterate: Exception when trying to perform a select')
+            logging.debug('iterate: Detalles de la excepcion: ' + str(e))
+
     def close(self):
-        """Cerramos la conexion con la base de datos"""
+        """Cerramos las conexiones con la base de datos"""
+
+        with self.readersLock:
+            readers = self.readers
+            self.readers = []
+
+        for conn in readers:
+            conn.close()
+
+        with self.writeLock:
+            self.conn.close()
+
+
+if __name__ == '__main__':
+    # Convierte la tabla data de una base de datos a otro formato:
+    #   python database.py carrascas.db compact
+    import sys
+
+    logging.basicConfig(level=logging.INFO)
+
+    if len(sys.argv) != 3 or sys.argv[2] not in DATA_LAYOUTS:
+        print("Uso: python database.py <dbPath> <%s>" % "|".join(sorted(DATA_LAYOUTS)))
+        sys.exit(1)
+
+    db = Database(sys.argv[1])
+    if not db.migrateLayout(sys.argv[2]):
+        sys.exit(1)
 
-        self.conn.close()
+    # Reclaim the space of the old table. The database is rebuilt with auto_vacuum = INCREMENTAL
+    db.executescript("VACUUM;")
+    db.close()
@@ -0,0 +1,140 @@
+import json
+import struct
+
+# Usamos el decodificador de JSON mas rapido que este instalado. Todos lanzan un ValueError
+# (o una subclase) si el mensaje no es un JSON valido
+try:
+    import orjson
+
+    loads = orjson.loads
+    DECODER = "orjson"
+except ImportError:
+    try:
+        import ujson
+
+        loads = ujson.loads
+        DECODER = "ujson"
+    except ImportError:
+        loads = json.loads
+        DECODER = "json"
+
+
+# Formatos binarios de los mensajes realtime para dispositivos con pocos recursos, little endian:
+#   version 1: version (uint8) = 1, deviceId (uint32), temperature (float32), humidity (float32), rainPulses (uint16)
+#   version 2: version (uint8) = 2, deviceId (uint32), timestamp (uint64, epoch en milisegundos),
+#              temperature (float32), humidity (float32), rainPulses (uint16)
+REALTIME_BINARY_VERSION = 1
+REALTIME_BINARY = struct.Struct('<BIffH')
+REALTIME_BINARY_TIMESTAMP_VERSION = 2
+REALTIME_BINARY_TIMESTAMP = struct.Struct('<BIQffH')
+
+REALTIME_BINARY_FORMATS = {REALTIME_BINARY_VERSION: REALTIME_BINARY, REALTIME_BINARY_TIMESTAMP_VERSION: REALTIME_BINARY_TIMESTAMP}
+
+
+def realtimeBinaryMessage(deviceId, timestamp, temperature, humidity, rainPulses):
+    """Build the dict of a decoded binary message, with the same structure as the JSON realtime messages"""
+
+    receivedData = {"deviceId": deviceId, "data": {"temperature": temperature, "humidity": humidity, "rainPulses": rainPulses}}
+    if timestamp is not None:
+        receivedData["timestamp"] = timestamp
+
+    return receivedData
+
+
+def loadsRealtimeBinary(payload):
+    """Decode a binary realtime message
+
+    Args:
+        payload: the bytes of the message
+    Returns:
+        a dict with the same structure as the JSON realtime messages
+    Raises:
+        ValueError if the payload is not a valid binary message
+
+    """
+    if not payload:
+        raise ValueError("Invalid binary payload: empty message")
+
+    version = payload[0]
+    binaryFormat = REALTIME_BINARY_FORMATS.get(version)
+    if binaryFormat is None:
+        raise ValueError("Unknown binary payload version: %s" % version)
+
+    try:
+        fields = binaryFormat.unpack(payload)
+    except struct.error as e:
+        raise ValueError("Invalid binary payload: %s" % e)
+
+    if version == REALTIME_BINARY_VERSION:
+        version, deviceId, temperature, humidity, rainPulses = fields
+        return realtimeBinaryMessage(deviceId, None, temperature, humidity, rainPulses)
+
+    return realtimeBinaryMessage(*fields[1:])
+
+
+def dumpsRealtimeBinary(deviceId, temperature, humidity, rainPulses, timestamp=None):
+    """Encode a binary realtime message, as the devices do
+
+    Args:
+        deviceId: the identifier of the device
+        temperature: the temperature
+        humidity: the humidity
+        rainPulses: the rain pulses
+        timestamp: optional timestamp of the sample in milliseconds. If it is given the version 2 is used
+    Returns:
+        the bytes of the message
+
+    """
+    if timestamp is None:
+        return REALTIME_BINARY.pack(REALTIME_BINARY_VERSION, deviceId, temperature, humidity, rainPulses)
+
+    return REALTIME_BINARY_TIMESTAMP.pack(REALTIME_BINARY_TIMESTAMP_VERSION, deviceId, timestamp, temperature, humidity, rainPulses)
+
+
+def loadsMany(payloads):
+    """Decode a group of JSON messages
+
+    Args:
+        payloads: a list with the bytes of the messages
+    Returns:
+        a list with the decoded object of each message, or None for the messages that are not valid JSON
+
+    """
+    # Each message is decoded on its own. Joining them in a single array lets several invalid
+    # messages combine into valid elements that would be attributed to the wrong topic
+    result = []
+    for payload in payloads:
+        try:
+            result.append(loads(payload))
+        except ValueError:
+            result.append(None)
+
+    return result
+
+
+def loadsRealtimeBinaryMany(payloads):
+    """Decode a group of binary realtime messages with a single unpack of all of them
+
+    Args:
+        payloads: a list with the bytes of the messages
+    Returns:
+        a list with the decoded dict of each message, or None for the messages that are not valid
+
+    """
+    # The usual case, all the devices use the same version
+    if payloads and all(len(payload) == REALTIME_BINARY.size for payload in payloads):
+        return [realtimeBinaryMessage(deviceId, None, temperature, humidity, rainPulses) if version == REALTIME_BINARY_VERSION else None
+                for version, deviceId, temperature, humidity, rainPulses in REALTIME_BINARY.iter_unpack(b"".join(payloads))]
+
+    if payloads and all(len(payload) == REALTIME_BINARY_TIMESTAMP.size for payload in payloads):
+        return [realtimeBinaryMessage(*fields[1:]) if fields[0] == REALTIME_BINARY_TIMESTAMP_VERSION else None
+                for fields in REALTIME_BINARY_TIMESTAMP.iter_unpack(b"".join(payloads))]
+
+    result = []
+    for payload in payloads:
+        try:
+            result.append(loadsRealtimeBinary(payload))
+        except ValueError:
+            result.append(None)
+
+    return result
@@ -0,0 +1,309 @@
+import json
+import logging
+import os
+import re
+import time
+from collections import OrderedDict
+
+from database import Database
+
+# Pyarrow es opcional, solo se necesita para exportar los datos
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+EXPORT_FORMATS = {"parquet": ".parquet", "arrow": ".arrow"}
+
+# Fichero del directorio de exportacion con hasta donde se han exportado los datos
+STATE_FILE = "_export.json"
+PART_NAME = re.compile(r'^\.part-(\d+)-(\d+)\.\w+\.tmp$')
+
+# Columnas exportadas, con los valores ya decodificados
+EXPORT_COLUMNS = ["deviceId", "temperature", "humidity", "rainPulses", "currentTimestamp"]
+
+
+class DataExporter():
+    """Exporta la tabla data a ficheros columnares Parquet o Arrow IPC para las analiticas.
+
+       Los datos se leen por bloques de chunkSize filas como tuplas, sin sqlite3.Row, y cada bloque
+       se convierte en columnas de pyarrow. Los ficheros se reparten por dispositivo y mes en particiones
+       de tipo hive, por lo que el deviceId y el mes solo estan en la ruta:
+            directory/deviceId=1/month=2024-01/part-<run>-<n>.parquet
+       Las filas de cada particion se acumulan hasta rowGroupSize filas antes de escribirlas, y como
+       maximo se retienen maxBufferedRows filas en total y se mantienen abiertos maxOpenFiles ficheros,
+       por lo que la memoria no depende del tamano de la tabla.
+
+       Las exportaciones son incrementales. Con el formato rowid se exportan las filas con un dataId
+       mayor que el de la exportacion anterior. Los formatos compact y fixed no tienen dataId, por lo
+       que se exportan las filas de cada dispositivo posteriores a su ultimo timestamp exportado, y solo
+       hasta lag segundos antes de la hora actual, para no saltarse las que todavia pueden llegar tarde.
+       Las filas que compacta el RetentionEngine en formato rowid se guardan como filas nuevas, por lo
+       que se vuelven a exportar.
+
+       Cada ejecucion escribe ficheros nuevos, ocultos hasta que termina. El estado se guarda antes de
+       renombrarlos, y si el proceso muere a medias la siguiente ejecucion termina de renombrar los
+       ficheros de la ejecucion guardada y borra los de una ejecucion sin guardar.
+
+       Args:
+            db: instancia de Database
+            directory: directorio de la exportacion
+            format: formato de los ficheros, uno de EXPORT_FORMATS
+            chunkSize: numero de filas que se leen de la base de datos cada vez
+            rowGroupSize: numero de filas de cada grupo de filas de los ficheros
+            maxBufferedRows: numero maximo de filas retenidas en memoria
+            maxOpenFiles: numero maximo de ficheros abiertos a la vez
+            lag: segundos mas recientes que no se exportan con los formatos compact y fixed
+    """
+
+    def __init__(self, db, directory, format="parquet", chunkSize=100000, rowGroupSize=65536, maxBufferedRows=1000000, maxOpenFiles=512, lag=7200):
+
+        if pyarrow is None:
+            raise ImportError("pyarrow is required to export the data: pip install pyarrow")
+        if format not in EXPORT_FORMATS:
+            raise ValueError("Unknown export format: %s" % format)
+
+        self.db = db
+        self.directory = directory
+        self.format = format
+        self.chunkSize = chunkSize
+        self.rowGroupSize = rowGroupSize
+        self.maxBufferedRows = maxBufferedRows
+        self.maxOpenFiles = maxOpenFiles
+        self.lag = lag
+
+        columns = EXPORT_COLUMNS
+        if db.layout == "rowid":
+            columns = ["dataId"] + columns
+        self.schema = pyarrow.schema([(column, pyarrow.float64() if column in ("temperature", "humidity", "rainPulses") else pyarrow.int64())
+                                      for column in columns])
+        # The deviceId is part of the path of the partition, as the readers of hive partitions expect
+        self.fileSchema = self.schema.remove(self.schema.get_field_index("deviceId"))
+
+        if db.layout == "rowid":
+            self.chunkQuery = '''SELECT dataId, %s FROM data WHERE dataId > ? AND dataId <= ? ORDER BY dataId LIMIT ?''' % db.dataColumns()
+        else:
+            self.chunkQuery = '''SELECT %s FROM data WHERE deviceId = ? AND currentTimestamp > ? AND currentTimestamp <= ?
+                                 ORDER BY currentTimestamp LIMIT ?''' % db.dataColumns()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.state = self.loadState()
+
+    def loadState(self):
+        """Read the state of the last export and finish or discard the files of an interrupted one
+
+        Args:
+            ---
+        Returns:
+            a dict with the run number and the position of the last export
+
+        """
+        state = {"run": 0, "dataId": 0, "devices": {}}
+        path = os.path.join(self.directory, STATE_FILE)
+        if os.path.exists(path):
+            with open(path) as stateFile:
+                state.update(json.load(stateFile))
+
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                match = PART_NAME.match(name)
+                if not match:
+                    continue
+
+                path = os.path.join(root, name)
+                if int(match.group(1)) == state["run"]:
+                    os.rename(path, os.path.join(root, name[1:-len(".tmp")]))
+                else:
+                    logging.warning("DataExporter loadState: Deleting the file %s of an interrupted export", path)
+                    os.remove(path)
+
+        return state
+
+    def saveState(self, state):
+        """Save the state of an export, replacing the previous one atomically"""
+
+        path = os.path.join(self.directory, STATE_FILE)
+        with open(path + ".tmp", "w") as stateFile:
+            json.dump(state, stateFile)
+            stateFile.flush()
+            os.fsync(stateFile.fileno())
+        os.rename(path + ".tmp", path)
+
+    def export(self):
+        """Export the rows added since the last export
+
+        Args:
+            ---
+        Returns:
+            the number of rows exported
+
+        """
+        state = {"run": self.state["run"] + 1, "dataId": self.state["dataId"], "devices": dict(self.state["devices"])}
+
+        # deviceId, month -> list of pending tables and their number of rows
+        self.pending = {}
+        self.pendingCounts = {}
+        self.pendingRows = 0
+        # deviceId, month -> open writer, the least recently used first
+        self.writers = OrderedDict()
+        self.parts = []
+        self.run = state["run"]
+
+        rows = 0
+        startTime = time.time()
+
+        # Plain tuples, sqlite3.Row is only needed to read the columns by name
+        cursor = self.db.readerConnection().cursor()
+        cursor.row_factory = None
+
+        if self.db.layout == "rowid":
+            # The rows added while exporting are left for the next export
+            lastDataId = self.db.select('''SELECT max(dataId) FROM data''', [], scalar=1) or 0
+            while state["dataId"] < lastDataId:
+                chunk = cursor.execute(self.chunkQuery, [state["dataId"], lastDataId, self.chunkSize]).fetchall()
+                if not chunk:
+                    break
+                self.add(chunk)
+                rows += len(chunk)
+                state["dataId"] = chunk[-1][0]
+        else:
+            limit = int(time.time() - self.lag)
+            # The devices with data, also the ones that have never sent their configuration
+            devices = self.db.getDeviceIds("data")
+            for deviceId in devices:
+                lastTimestamp = state["devices"].get(str(deviceId), -1)
+                while True:
+                    chunk = cursor.execute(self.chunkQuery, [deviceId, lastTimestamp, limit, self.chunkSize]).fetchall()
+                    if not chunk:
+                        break
+                    self.add(chunk)
+                    rows += len(chunk)
+                    lastTimestamp = chunk[-1][-1]
+                state["devices"][str(deviceId)] = lastTimestamp
+
+        cursor.close()
+
+        # Write the rest of the rows and close the files
+        for key in list(self.pending):
+            self.writePartition(key)
+        for writer in self.writers.values():
+            writer.close()
+
+        # The files are visible once the state that includes their rows is saved
+        self.saveState(state)
+        for path in self.parts:
+            directory, name = os.path.split(path)
+            os.rename(path, os.path.join(directory, name[1:-len(".tmp")]))
+
+        self.state = state
+
+        elapsedTime = time.time() - startTime
+        logging.info("DataExporter export: %s rows exported to %s files in %.3f s (%.0f rows/s)", rows, len(self.parts), elapsedTime, rows / elapsedTime if elapsedTime else 0)
+        return rows
+
+    def add(self, chunk):
+        """Split a chunk of rows by device and month and add them to the pending rows
+
+        Args:
+            chunk: a list of tuples with the columns of the schema
+        Returns:
+           it does not return anything
+
+        """
+        arrays = [pyarrow.array(column, type=field.type) for column, field in zip(zip(*chunk), self.schema)]
+        table = pyarrow.Table.from_arrays(arrays, schema=self.schema)
+
+        # The month of each row as yyyymm
+        timestamps = pyarrow.compute.cast(table["currentTimestamp"], pyarrow.timestamp("s"))
+        months = pyarrow.compute.add(pyarrow.compute.multiply(pyarrow.compute.year(timestamps), 100), pyarrow.compute.month(timestamps))
+        keyed = table.append_column("month", months)
+
+        # Group the rows of each partition, keeping their order
+        order = "dataId" if "dataId" in self.schema.names else "currentTimestamp"
+        indices = pyarrow.compute.sort_indices(keyed, sort_keys=[("deviceId", "ascending"), ("month", "ascending"), (order, "ascending")])
+        table = table.take(indices)
+        devices = table["deviceId"].combine_chunks()
+        months = months.take(indices).combine_chunks()
+
+        changes = pyarrow.compute.or_(pyarrow.compute.not_equal(devices[1:], devices[:-1]), pyarrow.compute.not_equal(months[1:], months[:-1]))
+        starts = [0] + [index + 1 for index in pyarrow.compute.indices_nonzero(changes).to_pylist()] + [len(table)]
+
+        for start, end in zip(starts, starts[1:]):
+            month = months[start].as_py()
+            key = (devices[start].as_py(), "%04d-%02d" % (month // 100, month % 100))
+            self.pending.setdefault(key, []).append(table.slice(start, end - start))
+            self.pendingCounts[key] = self.pendingCounts.get(key, 0) + end - start
+            self.pendingRows += end - start
+
+            if self.pendingCounts[key] >= self.rowGroupSize:
+                self.writePartition(key)
+
+        # Bound the memory, writing the biggest partitions first
+        while self.pendingRows > self.maxBufferedRows:
+            self.writePartition(max(self.pendingCounts, key=self.pendingCounts.get))
+
+    def writePartition(self, key):
+        """Write the pending rows of a partition to its file
+
+        Args:
+            key: a (deviceId, month) tuple
+        Returns:
+           it does not return anything
+
+        """
+        table = pyarrow.concat_tables(self.pending.pop(key))
+        self.pendingRows -= self.pendingCounts.pop(key)
+
+        self.getWriter(key).write_table(table.drop_columns(["deviceId"]))
+
+    def getWriter(self, key):
+        """Get the open file of a partition, creating a new one if it is not open"""
+
+        writer = self.writers.get(key)
+        if writer is not None:
+            self.writers.move_to_end(key)
+            return writer
+
+        # Close the least recently used file, the next rows of its partition go to a new file
+        if len(self.writers) >= self.maxOpenFiles:
+            _, oldest = self.writers.popitem(last=False)
+            oldest.close()
+
+        directory = os.path.join(self.directory, "deviceId=%s" % key[0], "month=%s" % key[1])
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        path = os.path.join(directory, ".part-%s-%s%s.tmp" % (self.run, len(self.parts), EXPORT_FORMATS[self.format]))
+        self.parts.append(path)
+
+        if self.format == "parquet":
+            writer = pyarrow.parquet.ParquetWriter(path, self.fileSchema)
+        else:
+            writer = pyarrow.ipc.new_file(path, self.fileSchema)
+
+        self.writers[key] = writer
+        return writer
+
+
+if __name__ == '__main__':
+    # Exporta la tabla data de forma incremental:
+    #   python export.py carrascas.db export [parquet|arrow]
+    # La medida de la exportacion esta en benchmarks/bench_export.py
+    import sys
+
+    logging.basicConfig(level=logging.INFO)
+
+    format = sys.argv[3] if len(sys.argv) > 3 else "parquet"
+    if len(sys.argv) < 3 or format not in EXPORT_FORMATS:
+        print("Uso: python export.py <dbPath> <directory> [%s]" % "|".join(sorted(EXPORT_FORMATS)))
+        sys.exit(1)
+
+    db = Database(sys.argv[1])
+    DataExporter(db, sys.argv[2], format).export()
+    db.close()
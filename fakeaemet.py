@@ -0,0 +1,157 @@
+import datetime
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeAemet():
+    """Servidor HTTP local que sustituye a la API OpenData de AEMET en las pruebas.
+
+       Responde a las peticiones de observaciones y de predicciones igual que AEMET: primero con
+       la url donde descargar los datos y despues con los datos. Cuenta las peticiones de cada
+       ruta y las conexiones abiertas, y puede tardar delay segundos en responder o devolver un
+       error 503 en las rutas de failures.
+
+       Args:
+            delay: segundos que tarda en responder cada peticion
+    """
+
+    def __init__(self, delay=0.0):
+
+        self.delay = delay
+        # Paths that answer with a 503
+        self.failures = set()
+
+        # Metrics
+        self.lock = threading.Lock()
+        # path -> number of requests
+        self.requests = {}
+        self.connections = 0
+        self.apiKeys = []
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive, as the real API
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                BaseHTTPRequestHandler.setup(self)
+                with fake.lock:
+                    fake.connections += 1
+
+            def do_GET(self):
+                fake.handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = "http://127.0.0.1:%s" % self.server.server_address[1]
+        self.baseUrl = self.url + "/opendata/api/"
+        self.thread = None
+
+    def start(self):
+        """Start serving in a background thread"""
+
+        self.thread = threading.Thread(target=self.server.serve_forever, name="FakeAemet")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop the server and close its socket"""
+
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, prefix):
+        """Get the number of requests to the paths that start with a prefix"""
+
+        with self.lock:
+            return sum(count for path, count in self.requests.items() if path.startswith(prefix))
+
+    def handle(self, request):
+        """Answer a request
+
+        Args:
+            request: the BaseHTTPRequestHandler of the request
+        Returns:
+           it does not return anything
+
+        """
+        path, _, query = request.path.partition("?")
+        with self.lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+            if path.startswith("/opendata/api/"):
+                self.apiKeys.append(query)
+
+        if self.delay:
+            time.sleep(self.delay)
+
+        if path in self.failures:
+            return self.send(request, 503, {"estado": 503, "descripcion": "Servicio no disponible"})
+
+        identifier = path.rsplit("/", 1)[-1]
+
+        if path.startswith("/opendata/api/observacion/convencional/datos/estacion/"):
+            return self.send(request, 200, {"estado": 200, "datos": "%s/datos/observacion/%s" % (self.url, identifier)})
+        if path.startswith("/opendata/api/prediccion/especifica/municipio/diaria/"):
+            return self.send(request, 200, {"estado": 200, "datos": "%s/datos/prediccion/%s" % (self.url, identifier)})
+        if path.startswith("/datos/observacion/"):
+            return self.send(request, 200, observation(identifier))
+        if path.startswith("/datos/prediccion/"):
+            return self.send(request, 200, forecast(identifier))
+
+        self.send(request, 404, {"estado": 404, "descripcion": "No encontrado"})
+
+    def send(self, request, status, body):
+        """Send a JSON response"""
+
+        data = json.dumps(body).encode()
+        request.send_response(status)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+
+def observation(idema, hours=3):
+    """Build the observations of the last hours of a station, with the fields used by carrascas"""
+
+    now = datetime.datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+    return [{"idema": idema,
+             "fint": (now - datetime.timedelta(hours=hours - 1 - hour)).strftime("%Y-%m-%dT%H:%M:%S"),
+             "ta": 15.0 + hour, "hr": 60.0 + hour, "prec": 0.0, "tamin": 10.0, "tamax": 20.0}
+            for hour in range(hours)]
+
+
+def forecast(municipio, days=7):
+    """Build the daily forecast of a municipality, with the fields used by carrascas"""
+
+    today = datetime.datetime.utcnow().date()
+    dias = []
+    for day in range(days):
+        fecha = today + datetime.timedelta(days=day)
+        dias.append({"fecha": fecha.isoformat() + "T00:00:00",
+                     "probPrecipitacion": [{"value": 10 * day, "periodo": "00-24"},
+                                           {"value": 5 * day, "periodo": "00-12"},
+                                           {"value": 3 * day, "periodo": "12-24"}],
+                     "estadoCielo": [{"value": "11", "periodo": "00-24", "descripcion": "Despejado"}],
+                     "temperatura": {"maxima": 20 + day, "minima": 10 + day, "dato": []}})
+
+    return [{"nombre": "Municipio %s" % municipio, "id": municipio, "elaborado": today.isoformat() + "T08:00:00",
+             "prediccion": {"dia": dias}}]
+
+
+if __name__ == '__main__':
+    # Sirve la API falsa para probar el cliente a mano con AemetClient(apiKey, baseUrl=<url>/opendata/api/)
+    fakeAemet = FakeAemet()
+    fakeAemet.start()
+    print("API de AEMET falsa en %s" % fakeAemet.baseUrl)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fakeAemet.stop()
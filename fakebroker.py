@@ -0,0 +1,397 @@
+import logging
+import socket
+import struct
+import threading
+
+import paho.mqtt.client as mqtt
+
+
+# Tipos de los paquetes de MQTT 3.1.1
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+
+def encodeLength(length):
+    """Encode the remaining length of a packet"""
+
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length:
+            byte |= 0x80
+        encoded.append(byte)
+        if not length:
+            return bytes(encoded)
+
+
+def encodePacket(packetType, flags, body):
+    """Build a packet with its fixed header"""
+
+    return bytes([packetType << 4 | flags]) + encodeLength(len(body)) + body
+
+
+def decodePacket(buffer, offset):
+    """Decode the next complete packet of a buffer
+
+    Args:
+        buffer: the bytes received
+        offset: the position of the packet in the buffer
+    Returns:
+        a (first byte, body, next offset) tuple, or None if the packet is not complete
+
+    """
+    position = offset + 1
+    length = 0
+    multiplier = 1
+    while True:
+        if position >= len(buffer):
+            return
+        byte = buffer[position]
+        position += 1
+        length += (byte & 0x7F) * multiplier
+        multiplier *= 128
+        if not byte & 0x80:
+            break
+
+    end = position + length
+    if end > len(buffer):
+        return
+
+    return buffer[offset], bytes(buffer[position:end]), end
+
+
+def decodeString(body, offset):
+    """Decode a string with its length prefix, returning it and the next offset"""
+
+    length, = struct.unpack_from("!H", body, offset)
+    return body[offset + 2:offset + 2 + length].decode(), offset + 2 + length
+
+
+class FakeSession():
+    """Conexion de un cliente con el FakeBroker.
+
+       Args:
+            broker: el FakeBroker
+            connection: el socket del cliente
+    """
+
+    def __init__(self, broker, connection):
+
+        self.broker = broker
+        self.connection = connection
+        self.sendLock = threading.Lock()
+        # topic filter -> share group, None if it is not a shared subscription
+        self.subscriptions = {}
+        self.closed = False
+
+        self.thread = threading.Thread(target=self.run, name="FakeSession")
+        self.thread.daemon = True
+
+    def send(self, data):
+        """Send bytes to the client, closing the session if it fails"""
+
+        try:
+            with self.sendLock:
+                self.connection.sendall(data)
+        except OSError:
+            self.close()
+
+    def run(self):
+        """Read and process the packets of the client until it disconnects
+
+        Args:
+            ---
+        Returns:
+           it does not return anything
+
+        """
+        buffer = bytearray()
+
+        try:
+            while not self.closed:
+                data = self.connection.recv(262144)
+                if not data:
+                    break
+                buffer.extend(data)
+
+                # The messages of every complete packet received are sent together to each subscriber
+                outgoing = {}
+                offset = 0
+                while True:
+                    packet = decodePacket(buffer, offset)
+                    if packet is None:
+                        break
+                    firstByte, body, offset = packet
+                    if not self.handle(firstByte, body, outgoing):
+                        return
+
+                del buffer[:offset]
+
+                for session, packets in outgoing.items():
+                    session.send(b"".join(packets))
+
+        except OSError:
+            pass
+        finally:
+            self.close()
+
+    def handle(self, firstByte, body, outgoing):
+        """Process a packet of the client
+
+        Args:
+            firstByte: the first byte of the fixed header, with the type and the flags
+            body: the rest of the packet
+            outgoing: dict session -> list of packets to send, where the published messages are added
+        Returns:
+            False if the client has disconnected
+
+        """
+        packetType = firstByte >> 4
+
+        if packetType == PUBLISH:
+            qos = (firstByte >> 1) & 0x03
+            topic, offset = decodeString(body, 0)
+            if qos:
+                packetId = body[offset:offset + 2]
+                offset += 2
+                self.send(encodePacket(PUBACK, 0, packetId))
+            # The subscribers always receive it with QoS 0 and without the retain flag
+            self.broker.route(topic, encodePacket(PUBLISH, 0, body[:2 + len(topic.encode())] + body[offset:]), outgoing)
+
+        elif packetType == CONNECT:
+            self.send(encodePacket(CONNACK, 0, b"\x00\x00"))
+
+        elif packetType == SUBSCRIBE:
+            packetId = body[:2]
+            offset = 2
+            granted = bytearray()
+            while offset < len(body):
+                topicFilter, offset = decodeString(body, offset)
+                offset += 1
+                self.broker.subscribe(self, topicFilter)
+                granted.append(0)
+            self.send(encodePacket(SUBACK, 0, packetId + bytes(granted)))
+
+        elif packetType == UNSUBSCRIBE:
+            packetId = body[:2]
+            offset = 2
+            while offset < len(body):
+                topicFilter, offset = decodeString(body, offset)
+                self.broker.unsubscribe(self, topicFilter)
+            self.send(encodePacket(UNSUBACK, 0, packetId))
+
+        elif packetType == PINGREQ:
+            self.send(encodePacket(PINGRESP, 0, b""))
+
+        elif packetType == DISCONNECT:
+            return False
+
+        return True
+
+    def close(self):
+        """Close the connection and remove the subscriptions of the client"""
+
+        if self.closed:
+            return
+        self.closed = True
+
+        self.broker.remove(self)
+        # The shutdown wakes up the thread blocked in recv
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.connection.close()
+
+
+class FakeBroker():
+    """Broker MQTT 3.1.1 minimo que sustituye a mosquitto en las pruebas.
+
+       Acepta conexiones, suscripciones y mensajes con QoS 0 (los de QoS 1 se confirman y se
+       entregan con QoS 0), sin sesiones persistentes ni mensajes retenidos. Las suscripciones
+       compartidas ($share/<grupo>/<filtro>) se reparten por turnos entre los clientes del grupo,
+       como hace mosquitto, y cada mensaje se entrega una sola vez a cada cliente.
+
+       Args:
+            host: direccion donde escucha
+            port: puerto donde escucha, con 0 se elige uno libre
+    """
+
+    def __init__(self, host="127.0.0.1", port=0):
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(64)
+        self.host, self.port = self.listener.getsockname()
+
+        self.lock = threading.Lock()
+        self.sessions = []
+        # (group, topic filter) -> [sessions, index of the next one]
+        self.groups = {}
+
+        # Metrics
+        self.published = 0
+        self.delivered = 0
+
+        self.thread = None
+
+    def start(self):
+        """Accept connections in a background thread"""
+
+        self.thread = threading.Thread(target=self.accept, name="FakeBroker")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def accept(self):
+        """Start a session for each new connection until the broker is stopped"""
+
+        while True:
+            try:
+                connection, _ = self.listener.accept()
+            except OSError:
+                break
+
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            session = FakeSession(self, connection)
+            with self.lock:
+                self.sessions.append(session)
+            session.thread.start()
+
+    def stop(self):
+        """Stop accepting connections and disconnect every client"""
+
+        # The shutdown wakes up the thread blocked in accept
+        try:
+            self.listener.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.listener.close()
+        if self.thread is not None:
+            self.thread.join()
+
+        with self.lock:
+            sessions = list(self.sessions)
+        for session in sessions:
+            session.close()
+
+    def subscribe(self, session, topicFilter):
+        """Add a subscription of a client"""
+
+        group = None
+        if topicFilter.startswith("$share/"):
+            _, group, topicFilter = topicFilter.split("/", 2)
+
+        with self.lock:
+            session.subscriptions[topicFilter] = group
+            if group is not None:
+                members = self.groups.setdefault((group, topicFilter), [[], 0])[0]
+                if session not in members:
+                    members.append(session)
+
+    def unsubscribe(self, session, topicFilter):
+        """Remove a subscription of a client"""
+
+        group = None
+        if topicFilter.startswith("$share/"):
+            _, group, topicFilter = topicFilter.split("/", 2)
+
+        with self.lock:
+            session.subscriptions.pop(topicFilter, None)
+            if group is not None and (group, topicFilter) in self.groups:
+                members = self.groups[(group, topicFilter)][0]
+                if session in members:
+                    members.remove(session)
+
+    def remove(self, session):
+        """Remove a client that has disconnected"""
+
+        with self.lock:
+            if session in self.sessions:
+                self.sessions.remove(session)
+            for members, _ in self.groups.values():
+                if session in members:
+                    members.remove(session)
+
+    def subscriptions(self):
+        """Get the number of subscriptions of all the clients"""
+
+        with self.lock:
+            return sum(len(session.subscriptions) for session in self.sessions)
+
+    def publish(self, messages):
+        """Publish messages from the broker itself, without the cost of a publishing client
+
+        Args:
+            messages: a list of (topic, payload) tuples, the payloads as bytes
+        Returns:
+           it does not return anything
+
+        """
+        outgoing = {}
+        for topic, payload in messages:
+            encodedTopic = topic.encode()
+            self.route(topic, encodePacket(PUBLISH, 0, struct.pack("!H", len(encodedTopic)) + encodedTopic + payload), outgoing)
+
+        for session, packets in outgoing.items():
+            session.send(b"".join(packets))
+
+    def route(self, topic, packet, outgoing):
+        """Add a published message to the packets of each subscriber
+
+        Args:
+            topic: the topic of the message
+            packet: the PUBLISH packet sent to the subscribers
+            outgoing: dict session -> list of packets to send
+        Returns:
+           it does not return anything
+
+        """
+        targets = set()
+
+        with self.lock:
+            self.published += 1
+
+            for session in self.sessions:
+                for topicFilter, group in session.subscriptions.items():
+                    if group is None and mqtt.topic_matches_sub(topicFilter, topic):
+                        targets.add(session)
+                        break
+
+            # Each shared group delivers the message to one of its members, in turns
+            for (group, topicFilter), entry in self.groups.items():
+                members, index = entry
+                if members and mqtt.topic_matches_sub(topicFilter, topic):
+                    targets.add(members[index % len(members)])
+                    entry[1] = index + 1
+
+            self.delivered += len(targets)
+
+        for session in targets:
+            outgoing.setdefault(session, []).append(packet)
+
+
+if __name__ == '__main__':
+    # Arranca el broker para probar carrascas a mano, con [MQTT] host = 127.0.0.1 y port = 1883 en el config.ini
+    import time
+
+    logging.basicConfig(level=logging.INFO)
+
+    broker = FakeBroker(port=1883)
+    broker.start()
+    logging.info("FakeBroker: listening on %s:%s", broker.host, broker.port)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        broker.stop()
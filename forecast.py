@@ -0,0 +1,134 @@
+from datetime import datetime
+
+# Columnas del resultado de parseForecasts
+COLUMNS = ["municipio", "fecha", "dayOffset", "periodo", "elaborado", "probPrecipitacion", "estadoCielo", "temperaturaMaxima", "temperaturaMinima"]
+
+
+def toNumber(value):
+    """Convert an AEMET value to a number. Empty values are returned as None"""
+
+    if value is None or value == "":
+        return None
+
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+
+
+def parseForecasts(forecasts, today=None):
+    """Convert the daily forecasts of several municipalities to a columnar structure, with a row
+       per municipality, day and period. The periods are the ones of probPrecipitacion and estadoCielo
+       (00-24, 00-12, 12-24, 00-06...) and the maximum and minimum temperatures of the day are
+       repeated in every period of the day
+
+    Args:
+        forecasts: a list of (municipio, forecast) tuples, where forecast is the first element of the AEMET data
+        today: optional date used to calculate dayOffset. By default the current UTC date
+    Returns:
+        a dict with a list for each one of the COLUMNS
+
+    """
+    if today is None:
+        today = datetime.utcnow().date()
+
+    columns = dict((column, []) for column in COLUMNS)
+
+    # Each date is parsed only once for all the municipalities
+    dayOffsets = {}
+
+    for municipio, forecast in forecasts:
+        elaborado = forecast.get("elaborado")
+
+        for dia in forecast["prediccion"]["dia"]:
+            fecha = dia["fecha"][:10]
+
+            dayOffset = dayOffsets.get(fecha)
+            if dayOffset is None:
+                dayOffset = dayOffsets[fecha] = (datetime.strptime(fecha, '%Y-%m-%d').date() - today).days
+
+            temperatura = dia.get("temperatura") or {}
+            temperaturaMaxima = toNumber(temperatura.get("maxima"))
+            temperaturaMinima = toNumber(temperatura.get("minima"))
+
+            # Join the values of the different features by period
+            periods = {}
+            for probability in dia.get("probPrecipitacion", []):
+                periods.setdefault(probability.get("periodo", "00-24"), {})["probPrecipitacion"] = toNumber(probability.get("value"))
+            for sky in dia.get("estadoCielo", []):
+                periods.setdefault(sky.get("periodo", "00-24"), {})["estadoCielo"] = sky.get("value") or None
+
+            for periodo in sorted(periods):
+                values = periods[periodo]
+                columns["municipio"].append(municipio)
+                columns["fecha"].append(fecha)
+                columns["dayOffset"].append(dayOffset)
+                columns["periodo"].append(periodo)
+                columns["elaborado"].append(elaborado)
+                columns["probPrecipitacion"].append(values.get("probPrecipitacion"))
+                columns["estadoCielo"].append(values.get("estadoCielo"))
+                columns["temperaturaMaxima"].append(temperaturaMaxima)
+                columns["temperaturaMinima"].append(temperaturaMinima)
+
+    return columns
+
+
+def maxProbPrecipitacion(columns):
+    """Get the maximum rain probability of each day
+
+    Args:
+        columns: the result of parseForecasts
+    Returns:
+        a dict indexed by (municipio, fecha, dayOffset) with the maximum probability of the day
+
+    """
+    result = {}
+
+    for municipio, fecha, dayOffset, probability in zip(columns["municipio"], columns["fecha"], columns["dayOffset"], columns["probPrecipitacion"]):
+        if probability is None:
+            continue
+
+        key = (municipio, fecha, dayOffset)
+        if probability > result.get(key, -1):
+            result[key] = probability
+
+    return result
+
+
+def storeOperations(columns):
+    """Build the operations that save the parsed forecasts
+
+    Args:
+        columns: the result of parseForecasts
+    Returns:
+        a list of (query, valuesList) tuples
+
+    """
+    periods = list(zip(columns["municipio"], columns["fecha"], columns["periodo"], columns["elaborado"], columns["probPrecipitacion"],
+                       columns["estadoCielo"], columns["temperaturaMaxima"], columns["temperaturaMinima"]))
+
+    # The date when each forecast was made, to keep it in the daily table
+    elaborados = dict(((municipio, fecha), elaborado) for municipio, fecha, elaborado in zip(columns["municipio"], columns["fecha"], columns["elaborado"]))
+    days = [[municipio, fecha, elaborados[(municipio, fecha)], probability] for (municipio, fecha, _), probability in maxProbPrecipitacion(columns).items()]
+
+    return [('''INSERT OR REPLACE INTO forecastPeriods (municipio, fecha, periodo, elaborado, probPrecipitacion, estadoCielo, temperaturaMaxima, temperaturaMinima)
+                VALUES (?,?,?,?,?,?,?,?)''', periods),
+            ('''INSERT OR REPLACE INTO forecasts (municipio, fecha, elaborado, probPrecipitacion) VALUES (?,?,?,?)''', days)]
+
+
+def readForecast(db, municipio, fromDate):
+    """Read the stored forecast of a municipality, without downloading it again
+
+    Args:
+        db: instance of Database
+        municipio: the identifier of the municipality
+        fromDate: the first date to read, as a YYYY-MM-DD string
+    Returns:
+        a list with the rows of forecastPeriods ordered by date and period
+
+    """
+    return db.select('''SELECT fecha, periodo, elaborado, probPrecipitacion, estadoCielo, temperaturaMaxima, temperaturaMinima
+                        FROM forecastPeriods WHERE municipio = ? AND fecha >= ? ORDER BY fecha, periodo''', [municipio, fromDate])
@@ -0,0 +1,123 @@
+import threading
+import time
+from collections import defaultdict
+from functools import partial
+
+from aggregation import RunningAggregate
+
+
+def receivedTimestamp():
+    """Get the reception time of a message, as an epoch in seconds with decimals. It follows the system
+       clock, also when it is adjusted, so the intervals are measured with time.monotonic() instead"""
+
+    return time.time()
+
+
+class IngestBuffer():
+    """Buffer de muestras por dispositivo compartido entre el thread de red del MQTT
+       (que escribe) y el thread que guarda los datos (que lee).
+
+       Las muestras se acumulan en una generacion (un diccionario deviceId -> RunningAggregate),
+       por lo que la memoria no crece con el numero de mensajes recibidos.
+       Para leer, se sustituye la generacion entera por una vacia y se devuelve la anterior,
+       que a partir de ese momento nadie mas modifica. El lock solo protege el append y el
+       intercambio de la referencia, por lo que el thread del MQTT nunca espera a que se
+       procesen o se guarden los datos.
+
+       Si se indica un SampleSpool, cada muestra se escribe tambien en el, dentro del mismo lock, y
+       el spool se rota a la vez que se intercambia la generacion. Dentro del lock el spool solo copia
+       la muestra o cambia de fichero; los ficheros se crean por adelantado en su propio thread.
+
+       Args:
+            reorderWindow: segundos que se retiene cada muestra para ordenar las que llegan desordenadas
+            spool: opcional, instancia de SampleSpool donde se guarda una copia de las muestras
+    """
+
+    def __init__(self, reorderWindow=0, spool=None):
+
+        self.lock = threading.Lock()
+        self.spool = spool
+        self.factory = partial(RunningAggregate, reorderWindow)
+        self.generation = defaultdict(self.factory)
+
+    def append(self, deviceId, timestamp, values):
+        """Add a new sample to the current generation
+
+        Args:
+            deviceId: the identifier of the device
+            timestamp: the timestamp of the sample
+            values: a list with the values of the sample
+        Returns:
+           Does not return anything
+        Raises:
+           ValueError or TypeError if any of the values is not a number
+
+        """
+        with self.lock:
+            self.generation[deviceId].add(timestamp, values)
+            if self.spool is not None:
+                self.spool.append(deviceId, timestamp, values)
+
+    def appendMany(self, samples):
+        """Add the samples of several devices to the current generation, taking the lock only once
+
+        Args:
+            samples: a dict indexed by deviceId with a list of (timestamp, values) tuples for each device
+        Returns:
+           a list of (deviceId, timestamp, values, exception) tuples with the samples that could not be added
+
+        """
+        failed = []
+
+        with self.lock:
+            for deviceId, deviceSamples in samples.items():
+                runningAggregate = self.generation[deviceId]
+                for timestamp, values in deviceSamples:
+                    try:
+                        runningAggregate.add(timestamp, values)
+                    except (TypeError, ValueError) as e:
+                        failed.append((deviceId, timestamp, values, e))
+                        continue
+
+                    if self.spool is not None:
+                        self.spool.append(deviceId, timestamp, values)
+
+        return failed
+
+    def swap(self):
+        """Replace the current generation by an empty one
+
+        Args:
+            ---
+        Returns:
+           a tuple with a dict with the RunningAggregate of each device updated since the last swap, indexed by deviceId,
+           and the group of spool segments with its samples, to be released once it is saved (None without a spool).
+           The dict is not modified anymore so it can be processed without locking.
+
+        """
+        spoolGroup = None
+
+        with self.lock:
+            generation = self.generation
+            self.generation = defaultdict(self.factory)
+            if self.spool is not None:
+                spoolGroup = self.spool.rotate()
+
+        return generation, spoolGroup
+
+    def depths(self):
+        """Get the number of samples of each device in the current generation
+
+        Args:
+            ---
+        Returns:
+           a dict with the number of samples of each device, indexed by deviceId
+
+        """
+        with self.lock:
+            return dict((deviceId, len(runningAggregate)) for deviceId, runningAggregate in self.generation.items())
+
+    def __len__(self):
+        """Number of devices with data in the current generation"""
+
+        return len(self.generation)
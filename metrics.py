@@ -0,0 +1,244 @@
+import bisect
+import threading
+
+# Limites superiores en segundos de los intervalos de los histogramas de tiempos
+LATENCY_BUCKETS = [0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60]
+
+
+def escapeLabelValue(value):
+    """Escape the backslashes, double quotes and line feeds of a label value, as the Prometheus text format requires"""
+
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def escapeHelp(text):
+    """Escape the backslashes and line feeds of a help text, as the Prometheus text format requires"""
+
+    return str(text).replace("\\", "\\\\").replace("\n", "\\n")
+
+
+class Histogram():
+    """Histograma de valores con intervalos fijos, como los de Prometheus.
+
+       Cada valor solo incrementa el contador de su intervalo, por lo que ocupa lo mismo sin
+       importar cuantos valores se observen. Los percentiles se estiman a partir de los intervalos.
+
+       Args:
+            buckets: lista ordenada con el limite superior de cada intervalo
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+
+        self.buckets = list(buckets)
+        # The last one counts the values over the last limit
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """Add a value. It must be called with the lock of the Metrics"""
+
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def observeMany(self, values):
+        """Add several values, counting each interval with a bisection of the sorted values instead
+           of locating each value. It must be called with the lock of the Metrics"""
+
+        values = sorted(values)
+
+        previous = 0
+        for index, limit in enumerate(self.buckets):
+            below = bisect.bisect_right(values, limit, previous)
+            self.counts[index] += below - previous
+            previous = below
+        self.counts[-1] += len(values) - previous
+
+        self.sum += sum(values)
+        self.count += len(values)
+
+    def percentile(self, fraction):
+        """Estimate a percentile as the upper limit of the interval where it falls
+
+        Args:
+            fraction: the percentile between 0 and 1
+        Returns:
+            the estimated value or None if no value has been observed
+
+        """
+        if not self.count:
+            return
+
+        accumulated = 0
+        for limit, count in zip(self.buckets + [float("inf")], self.counts):
+            accumulated += count
+            if accumulated >= fraction * self.count:
+                return limit if limit != float("inf") else self.buckets[-1]
+
+
+class Metrics():
+    """Registro de las metricas de una instancia: contadores, histogramas y gauges.
+
+       Los hilos que procesan los datos actualizan las metricas con un lock que solo protege
+       la suma, por lo que cuesta menos de un microsegundo. Los gauges y los valores que ya se
+       cuentan en otros objetos (el writer, el buffer...) no se duplican: se leen al generar el
+       informe a traves de las funciones registradas con addCollector.
+
+       Se exportan en el formato de texto de Prometheus con render() y como un dict con snapshot()
+       para publicarlas por MQTT.
+
+       Args:
+            prefix: prefijo del nombre de las metricas de Prometheus
+    """
+
+    def __init__(self, prefix="carrascas"):
+
+        self.prefix = prefix
+        self.lock = threading.Lock()
+
+        # name -> value
+        self.counters = {}
+        # name -> Histogram
+        self.histograms = {}
+        # name -> help text
+        self.descriptions = {}
+        # Functions that return a list of (name, type, value, labels) tuples
+        self.collectors = []
+
+    def describe(self, name, description):
+        """Set the help text of a metric"""
+
+        self.descriptions[name] = description
+
+    def increment(self, name, value=1):
+        """Add a value to a counter
+
+        Args:
+            name: the name of the counter
+            value: optional, the value to add
+        Returns:
+           it does not return anything
+
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        """Add a value to a histogram
+
+        Args:
+            name: the name of the histogram
+            value: the value to add, usually a time in seconds
+        Returns:
+           it does not return anything
+
+        """
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def observeMany(self, name, values):
+        """Add several values to a histogram, taking the lock only once"""
+
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observeMany(values)
+
+    def addCollector(self, collector):
+        """Register a function that is called to read metrics kept somewhere else
+
+        Args:
+            collector: a function without arguments that returns a list of (name, type, value, labels) tuples.
+                       type is "counter" or "gauge" and labels a dict or None
+        Returns:
+           it does not return anything
+
+        """
+        self.collectors.append(collector)
+
+    def collect(self):
+        """Get the metrics of the collectors, ignoring the ones that fail"""
+
+        samples = []
+        for collector in self.collectors:
+            try:
+                samples.extend(collector())
+            except Exception:
+                continue
+
+        return samples
+
+    def render(self):
+        """Get all the metrics in the Prometheus text format
+
+        Args:
+            ---
+        Returns:
+            a string with the metrics
+
+        """
+        lines = []
+
+        def header(name, metricType):
+            if name in self.descriptions:
+                lines.append("# HELP %s_%s %s" % (self.prefix, name, escapeHelp(self.descriptions[name])))
+            lines.append("# TYPE %s_%s %s" % (self.prefix, name, metricType))
+
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = [(name, list(histogram.buckets), list(histogram.counts), histogram.sum, histogram.count)
+                          for name, histogram in sorted(self.histograms.items())]
+
+        for name, value in counters:
+            header(name, "counter")
+            lines.append("%s_%s %s" % (self.prefix, name, value))
+
+        # The samples of the same metric are grouped under a single header
+        written = set()
+        for name, metricType, value, labels in sorted(self.collect(), key=lambda sample: sample[0]):
+            if name not in written:
+                header(name, metricType)
+                written.add(name)
+            labels = "{%s}" % ",".join('%s="%s"' % (key, escapeLabelValue(labelValue)) for key, labelValue in sorted(labels.items())) if labels else ""
+            lines.append("%s_%s%s %s" % (self.prefix, name, labels, value))
+
+        for name, buckets, counts, total, count in histograms:
+            header(name, "histogram")
+            accumulated = 0
+            for limit, bucketCount in zip(buckets, counts):
+                accumulated += bucketCount
+                lines.append('%s_%s_bucket{le="%s"} %s' % (self.prefix, name, limit, accumulated))
+            lines.append('%s_%s_bucket{le="+Inf"} %s' % (self.prefix, name, count))
+            lines.append("%s_%s_sum %s" % (self.prefix, name, total))
+            lines.append("%s_%s_count %s" % (self.prefix, name, count))
+
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """Get the metrics as a dict, with a summary of each histogram. The metrics with labels are not included
+
+        Args:
+            ---
+        Returns:
+            a dict with the value of each metric
+
+        """
+        with self.lock:
+            result = dict(self.counters)
+            for name, histogram in self.histograms.items():
+                result[name] = {"count": histogram.count,
+                                "sum": histogram.sum,
+                                "p50": histogram.percentile(0.5),
+                                "p90": histogram.percentile(0.9),
+                                "p99": histogram.percentile(0.99)}
+
+        for name, metricType, value, labels in self.collect():
+            if not labels:
+                result[name] = value
+
+        return result
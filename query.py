@@ -0,0 +1,437 @@
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from rollups import FEATURES, ROLLUPS
+
+
+# Columnas de las filas de la tabla data que devuelven las consultas y la cache
+DATA_COLUMNS = ["deviceId", "temperature", "humidity", "rainPulses", "currentTimestamp"]
+
+
+class DataQuery():
+    """Consultas de rango sobre los datos guardados.
+
+       Las consultas se construyen una sola vez con las columnas del formato de la tabla data,
+       por lo que sqlite3 reutiliza siempre la misma sentencia preparada, y devuelven las filas
+       con un generador, sin cargar todo el resultado en memoria.
+
+       Args:
+            db: instancia de Database
+    """
+
+    def __init__(self, db):
+
+        self.db = db
+
+        columns = db.dataColumns()
+        self.rangeQuery = '''SELECT %s FROM data WHERE deviceId = ? AND currentTimestamp >= ? AND currentTimestamp < ?
+                             ORDER BY currentTimestamp''' % columns
+        self.latestQuery = '''SELECT %s FROM data WHERE deviceId = ? ORDER BY currentTimestamp DESC LIMIT 1''' % columns
+
+        # The rollups return the mean of the minute means and the extremes of each bucket
+        rollupColumns = ", ".join("%(feature)sSum / samples AS %(feature)s, %(feature)sMin, %(feature)sMax" % {"feature": feature} for feature in FEATURES)
+        self.rollupQueries = dict((table, '''SELECT deviceId, bucketTimestamp, samples, %s FROM %s
+                                             WHERE deviceId = ? AND bucketTimestamp >= ? AND bucketTimestamp < ?
+                                             ORDER BY bucketTimestamp''' % (rollupColumns, table))
+                                  for table, _ in ROLLUPS)
+
+    def range(self, deviceId, fromTimestamp, toTimestamp, chunkSize=500):
+        """Get the rows of a device between two timestamps
+
+        Args:
+            deviceId: the identifier of the device
+            fromTimestamp: the first timestamp, included
+            toTimestamp: the last timestamp, not included
+            chunkSize: number of rows read from the database each time
+        Returns:
+            a generator of dicts with the DATA_COLUMNS, ordered by timestamp
+
+        """
+        for row in self.db.iterate(self.rangeQuery, [deviceId, fromTimestamp, toTimestamp], chunkSize):
+            yield dict(zip(DATA_COLUMNS, row))
+
+    def rollup(self, table, deviceId, fromTimestamp, toTimestamp, chunkSize=500):
+        """Get the hourly or daily aggregates of a device between two timestamps
+
+        Args:
+            table: the name of the rollup table, dataHourly or dataDaily
+            deviceId: the identifier of the device
+            fromTimestamp: the first bucket, included
+            toTimestamp: the last bucket, not included
+            chunkSize: number of rows read from the database each time
+        Returns:
+            a generator of dicts with the columns of the rollup, ordered by bucket
+        Raises:
+            ValueError if the table is not a rollup table
+
+        """
+        if table not in self.rollupQueries:
+            raise ValueError("Unknown rollup table: %s" % table)
+
+        for row in self.db.iterate(self.rollupQueries[table], [deviceId, fromTimestamp, toTimestamp], chunkSize):
+            yield dict(zip(row.keys(), row))
+
+    def latest(self, deviceId):
+        """Get the last row of a device
+
+        Args:
+            deviceId: the identifier of the device
+        Returns:
+            a dict with the DATA_COLUMNS or None if the device has no data
+
+        """
+        for row in self.db.iterate(self.latestQuery, [deviceId], 1):
+            return dict(zip(DATA_COLUMNS, row))
+
+
+class HotCache():
+    """Cache en memoria del ultimo dato y de los datos recientes de cada dispositivo.
+
+       El writer actualiza la cache con cada fila en cuanto se guarda en la base de datos, por lo que
+       las consultas del ultimo dato y de la ventana reciente (por defecto 24 horas) no leen la
+       base de datos. Si un dispositivo no esta en la cache, o lleva mas de ttl segundos sin
+       recargarse (otro proceso puede haber escrito datos suyos), se lee de la base de datos.
+       Se guardan como maximo maxDevices dispositivos, descartando los usados hace mas tiempo.
+
+       Args:
+            query: instancia de DataQuery con la que se cargan los datos que no estan en la cache
+            maxDevices: numero maximo de dispositivos en la cache
+            window: segundos de datos recientes que se guardan de cada dispositivo
+            ttl: segundos tras los que se recargan de la base de datos los datos de un dispositivo
+    """
+
+    def __init__(self, query, maxDevices=1000, window=86400, ttl=300):
+
+        self.query = query
+        self.maxDevices = maxDevices
+        self.window = window
+        self.ttl = ttl
+
+        self.lock = threading.Lock()
+        # deviceId -> {"latest": row, "window": deque of rows or None if not loaded, "expires": time}
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def update(self, rows):
+        """Add the rows just committed to the cache
+
+        Args:
+            rows: a list of [deviceId, temperature, humidity, rainPulses, currentTimestamp] rows
+        Returns:
+           it does not return anything
+
+        """
+        with self.lock:
+            for row in rows:
+                row = dict(zip(DATA_COLUMNS, row))
+                entry = self.entries.get(row["deviceId"])
+
+                if entry is None:
+                    # Only the latest row is known, the window is loaded when it is requested
+                    entry = self.entries[row["deviceId"]] = {"latest": row, "window": None, "expires": time.time() + self.ttl}
+                elif row["currentTimestamp"] >= entry["latest"]["currentTimestamp"]:
+                    entry["latest"] = row
+
+                if entry["window"] is not None:
+                    entry["window"].append(row)
+                    self.trim(entry["window"], row["currentTimestamp"])
+
+                self.entries.move_to_end(row["deviceId"])
+
+            self.evict()
+
+    def trim(self, window, newestTimestamp):
+        """Remove the rows older than the window"""
+
+        while window and window[0]["currentTimestamp"] < newestTimestamp - self.window:
+            window.popleft()
+
+    def evict(self):
+        """Remove the least recently used devices over maxDevices. Must be called with the lock"""
+
+        while len(self.entries) > self.maxDevices:
+            self.entries.popitem(last=False)
+
+    def getLatest(self, deviceId):
+        """Get the last row of a device
+
+        Args:
+            deviceId: the identifier of the device
+        Returns:
+            a dict with the DATA_COLUMNS or None if the device has no data
+
+        """
+        with self.lock:
+            entry = self.entries.get(deviceId)
+            if entry is not None and entry["expires"] > time.time():
+                self.entries.move_to_end(deviceId)
+                self.hits += 1
+                return entry["latest"]
+
+            self.misses += 1
+
+        latest = self.query.latest(deviceId)
+        if latest is None:
+            return
+
+        with self.lock:
+            entry = self.entries.get(deviceId)
+            if entry is None:
+                self.entries[deviceId] = {"latest": latest, "window": None, "expires": time.time() + self.ttl}
+            else:
+                entry["latest"] = latest
+                entry["expires"] = time.time() + self.ttl
+            self.evict()
+
+        return latest
+
+    def getWindow(self, deviceId, seconds=None):
+        """Get the recent rows of a device
+
+        Args:
+            deviceId: the identifier of the device
+            seconds: optional, number of seconds before the last row. By default the whole window
+        Returns:
+            a list of dicts with the DATA_COLUMNS, ordered by timestamp
+
+        """
+        seconds = self.window if seconds is None else min(seconds, self.window)
+
+        with self.lock:
+            entry = self.entries.get(deviceId)
+            if entry is not None and entry["window"] is not None and entry["expires"] > time.time():
+                self.entries.move_to_end(deviceId)
+                self.hits += 1
+                return self.select(entry, seconds)
+
+            self.misses += 1
+
+        now = time.time()
+        rows = deque(self.query.range(deviceId, int(now - self.window), 2 ** 62))
+
+        with self.lock:
+            # Keep the rows committed and added by the flusher while the window was being read
+            previous = self.entries.get(deviceId)
+            if previous is not None and (not rows or previous["latest"]["currentTimestamp"] > rows[-1]["currentTimestamp"]):
+                rows.append(previous["latest"])
+
+            entry = {"latest": rows[-1] if rows else None, "window": rows, "expires": now + self.ttl}
+            if entry["latest"] is None:
+                return []
+
+            self.entries[deviceId] = entry
+            self.evict()
+
+            return self.select(entry, seconds)
+
+    def select(self, entry, seconds):
+        """Get the rows of a window entry newer than seconds before its last row. Must be called with the lock"""
+
+        window = entry["window"]
+        if not window:
+            return []
+
+        limit = window[-1]["currentTimestamp"] - seconds
+        return [row for row in window if row["currentTimestamp"] >= limit]
+
+    def getStats(self):
+        """Get the metrics of the cache"""
+
+        return {"cachedDevices": len(self.entries), "cacheHits": self.hits, "cacheMisses": self.misses}
+
+
+class QueryServer():
+    """Servidor HTTP local de solo lectura para los dashboards.
+
+       Atiende cada peticion en su propio thread, con una conexion de lectura que se cierra al
+       terminar, para que una consulta de rango larga no retrase las de la cache:
+            GET /latest?deviceId=1                  ultimo dato del dispositivo (de la cache)
+            GET /window?deviceId=1&seconds=3600     datos recientes del dispositivo (de la cache)
+            GET /range?deviceId=1&from=...&to=...   datos de un rango, una fila JSON por linea
+            GET /rollup?table=dataHourly&deviceId=1&from=...&to=...
+            GET /metrics                            metricas en formato de texto de Prometheus
+
+       Args:
+            cache: instancia de HotCache
+            query: instancia de DataQuery
+            host: direccion donde se escucha, por defecto solo la local
+            port: puerto donde se escucha
+            metrics: opcional, instancia de Metrics que se sirve en /metrics
+            retryInterval: segundos entre dos intentos de abrir el puerto si esta ocupado
+
+       Durante un reinicio sin corte el proceso anterior mantiene el puerto abierto hasta que
+       termina, por lo que el puerto se abre desde el thread del servidor, reintentandolo hasta
+       que quede libre, sin retrasar ni interrumpir la ingesta.
+    """
+
+    def __init__(self, cache, query, host="127.0.0.1", port=8080, metrics=None, retryInterval=1.0):
+
+        self.cache = cache
+        self.query = query
+        self.metrics = metrics
+        self.address = (host, port)
+        self.retryInterval = retryInterval
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                server.handle(self)
+
+            def log_message(self, format, *args):
+                logging.debug("QueryServer: " + format % args)
+
+        self.handler = Handler
+        # Created once the port is bound
+        self.httpServer = None
+        self.lock = threading.Lock()
+        self.stopEvent = threading.Event()
+
+        self.thread = threading.Thread(target=self.run, name="QueryServer")
+        self.thread.daemon = True
+
+    def start(self):
+        """Start serving the requests in the background"""
+
+        self.thread.start()
+
+    def run(self):
+        """Bind the port, waiting until it is free, and serve the requests until the server is stopped
+
+        Args:
+            ---
+        Returns:
+           it does not return anything
+
+        """
+        logged = False
+        while True:
+            with self.lock:
+                if self.stopEvent.is_set():
+                    return
+                try:
+                    self.httpServer = ThreadingHTTPServer(self.address, self.handler)
+                    break
+                except OSError as e:
+                    # Only the first failure is logged, it is expected while the previous process is stopping
+                    if not logged:
+                        logging.warning("QueryServer run: The port %s could not be opened, retrying every %s s. Exception: %s", self.address[1], self.retryInterval, e)
+                        logged = True
+
+            if self.stopEvent.wait(self.retryInterval):
+                return
+
+        logging.info("QueryServer run: listening on %s:%s", *self.address)
+        self.httpServer.serve_forever()
+
+    def handle(self, request):
+        """Answer a request
+
+        Args:
+            request: the BaseHTTPRequestHandler of the request
+        Returns:
+           it does not return anything
+
+        """
+        url = urlparse(request.path)
+        params = dict((key, values[0]) for key, values in parse_qs(url.query).items())
+
+        if url.path == "/metrics" and self.metrics is not None:
+            self.sendText(request, self.metrics.render())
+            return
+
+        try:
+            self.route(request, url, params)
+        finally:
+            # Each request runs in its own thread, its reader connection is not reused
+            self.query.db.closeReaderConnection()
+
+    def route(self, request, url, params):
+        """Answer a data request from the cache or the database
+
+        Args:
+            request: the BaseHTTPRequestHandler of the request
+            url: the parsed path of the request
+            params: a dict with the query parameters
+        Returns:
+           it does not return anything
+
+        """
+        try:
+            deviceId = int(params["deviceId"])
+
+            if url.path == "/latest":
+                self.sendJson(request, self.cache.getLatest(deviceId))
+            elif url.path == "/window":
+                self.sendJson(request, self.cache.getWindow(deviceId, int(params["seconds"]) if "seconds" in params else None))
+            elif url.path == "/range":
+                self.sendLines(request, self.query.range(deviceId, int(params.get("from", 0)), int(params.get("to", 2 ** 62))))
+            elif url.path == "/rollup":
+                self.sendLines(request, self.query.rollup(params.get("table", "dataHourly"), deviceId, int(params.get("from", 0)), int(params.get("to", 2 ** 62))))
+            else:
+                request.send_error(404)
+
+        except (KeyError, ValueError) as e:
+            request.send_error(400, "Invalid parameters: %s" % e)
+
+    def sendJson(self, request, result):
+        """Send a result as a single JSON document"""
+
+        body = json.dumps(result).encode()
+
+        request.send_response(200 if result is not None else 404)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def sendText(self, request, text):
+        """Send a plain text document in the Prometheus exposition format"""
+
+        body = text.encode()
+
+        request.send_response(200)
+        request.send_header("Content-Type", "text/plain; version=0.0.4")
+        request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def sendLines(self, request, rows):
+        """Send the rows of a generator as they are read, one JSON document per line"""
+
+        # Validate the parameters before sending the headers
+        rows = iter(rows)
+        try:
+            first = next(rows)
+        except StopIteration:
+            first = None
+
+        request.send_response(200)
+        request.send_header("Content-Type", "application/x-ndjson")
+        request.end_headers()
+
+        if first is None:
+            return
+
+        request.wfile.write((json.dumps(first) + "\n").encode())
+        for row in rows:
+            request.wfile.write((json.dumps(row) + "\n").encode())
+
+    def stop(self):
+        """Stop the server, or the attempts to bind the port"""
+
+        with self.lock:
+            self.stopEvent.set()
+            httpServer = self.httpServer
+
+        if httpServer is not None:
+            httpServer.shutdown()
+            httpServer.server_close()
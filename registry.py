@@ -0,0 +1,83 @@
+import logging
+import threading
+
+
+class DeviceRegistry():
+    """Registro en memoria de los dispositivos conocidos.
+
+       Se carga de la tabla devices al arrancar y solo se escribe en la base de datos
+       cuando aparece un dispositivo nuevo, por lo que un mensaje de configuracion de un
+       dispositivo ya conocido solo cuesta una busqueda en un diccionario.
+
+       Args:
+            db: instancia de Database de donde se cargan los dispositivos
+            writer: instancia de DatabaseWriter por donde se guardan los dispositivos nuevos
+    """
+
+    def __init__(self, db, writer):
+
+        self.writer = writer
+        self.lock = threading.Lock()
+        self.devices = set()
+
+        self.load(db)
+
+    def load(self, db):
+        """Load the devices saved in the database
+
+        Args:
+            db: instance of Database to read the devices from
+        Returns:
+           it does not return anything
+
+        """
+        rows = db.select('''SELECT deviceId FROM devices''', [])
+
+        with self.lock:
+            self.devices.update(row["deviceId"] for row in rows or [])
+
+        logging.debug("DeviceRegistry load: %s devices loaded", len(self.devices))
+
+    def register(self, deviceId):
+        """Register a device, saving it in the database if it is new
+
+        Args:
+            deviceId: the identifier of the device
+        Returns:
+            True if the device is new
+
+        """
+        return bool(self.registerMany([deviceId]))
+
+    def registerMany(self, deviceIds):
+        """Register a group of devices, saving the new ones in the database with a single upsert
+
+        Args:
+            deviceIds: an iterable with the identifiers of the devices
+        Returns:
+            a list with the new devices
+
+        """
+        with self.lock:
+            newDevices = [deviceId for deviceId in set(deviceIds) if deviceId not in self.devices]
+
+            if not newDevices:
+                return []
+
+            # If the writer queue is full the devices are not registered, they are saved with the next message
+            if not self.writer.put('''INSERT OR IGNORE INTO devices (deviceId) VALUES (?)''', [[deviceId] for deviceId in newDevices]):
+                return []
+
+            self.devices.update(newDevices)
+
+        logging.debug("DeviceRegistry registerMany: new devices: %s", newDevices)
+
+        return newDevices
+
+    def __contains__(self, deviceId):
+
+        return deviceId in self.devices
+
+    def __len__(self):
+
+        return len(self.devices)
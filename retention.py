@@ -0,0 +1,284 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from aggregation import DeviceSamples, aggregate
+
+# Tamano en segundos de los intervalos en los que se compactan los datos
+COMPACT_INTERVAL = 3600
+DAY = 86400
+
+# Tablas con retencion propia y la columna con su timestamp
+RETENTION_TABLES = [("data", "currentTimestamp"), ("dataHourly", "bucketTimestamp"), ("dataDaily", "bucketTimestamp")]
+
+
+class RetentionEngine():
+    """Limpieza periodica de la base de datos en segundo plano.
+
+       Cada interval segundos ejecuta tres tareas:
+            - Compacta los datos de la tabla data con mas de compactAfter dias: las filas de cada
+              dispositivo de cada hora se sustituyen por una sola fila con la media ponderada por el
+              tiempo, igual que la de getDataFromBuffer. Las tablas dataHourly y dataDaily no cambian.
+            - Borra las filas de data, dataHourly y dataDaily mas antiguas que su retencion.
+            - Libera las paginas vacias con un incremental_vacuum y hace un checkpoint del WAL.
+
+       Todas las escrituras se hacen a traves del DatabaseWriter en lotes pequenos, de un dispositivo
+       y un dia, de batchDevices dispositivos o de vacuumPages paginas, y se espera a que cada lote se
+       guarde antes de encolar el siguiente, por lo que el lock de escritura nunca se retiene mucho
+       tiempo. El checkpoint es PASSIVE y se hace con la conexion de lectura del thread: copia lo que
+       puede sin esperar a los lectores ni bloquear al writer. Hasta donde se ha
+       procesado cada tarea se guarda en la tabla retention, y tras un reinicio se continua desde ahi.
+
+       Args:
+            db: instancia de Database
+            writer: instancia de DatabaseWriter donde se guardan los cambios
+            compactAfter: dias tras los que se compactan los datos. Con 0 no se compactan
+            retention: dict con los dias que se guarda cada tabla de RETENTION_TABLES. Con 0 se guardan siempre
+            interval: segundos entre dos ejecuciones
+            batchDevices: numero maximo de dispositivos de cada lote de borrado
+            vacuumPages: numero maximo de paginas liberadas en cada ejecucion
+    """
+
+    def __init__(self, db, writer, compactAfter=30, retention=None, interval=3600, batchDevices=100, vacuumPages=2000):
+
+        self.db = db
+        self.writer = writer
+        self.compactAfter = compactAfter
+        self.retention = retention or {}
+        self.interval = interval
+        self.batchDevices = batchDevices
+        self.vacuumPages = vacuumPages
+
+        self.dayQuery = '''SELECT %s FROM data WHERE deviceId = ? AND currentTimestamp >= ? AND currentTimestamp < ?
+                           ORDER BY currentTimestamp''' % db.dataColumns()
+
+        # Metrics
+        self.compacted = 0
+        self.lastRunTime = 0.0
+
+        self.stopEvent = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="RetentionEngine")
+        self.thread.daemon = True
+
+    def start(self):
+        """Start the periodic cleanup in the background"""
+
+        self.thread.start()
+
+    def run(self, delay=60):
+        """Run the jobs every interval seconds until the engine is stopped
+
+        Args:
+            delay: seconds to wait before the first run, so it does not compete with the start up
+        Returns:
+           it does not return anything
+
+        """
+        while not self.stopEvent.wait(delay):
+            delay = self.interval
+
+            startTime = time.time()
+            try:
+                self.runJobs()
+            except Exception as e:
+                logging.error("RetentionEngine run: Exception running the jobs. Exception: %s", e)
+
+            self.lastRunTime = time.time() - startTime
+            logging.info("RetentionEngine run: done in %.3f s. Compacted rows: %s", self.lastRunTime, self.compacted)
+
+        # Do not keep a reader connection open once the thread has finished
+        self.db.closeReaderConnection()
+
+    def runJobs(self, now=None):
+        """Run the compaction, the retention and the maintenance once
+
+        Args:
+            now: optional, the current timestamp. By default the current time
+        Returns:
+           it does not return anything
+
+        """
+        now = time.time() if now is None else now
+
+        if self.compactAfter > 0:
+            self.compact(int(now - self.compactAfter * DAY))
+
+        for table, column in RETENTION_TABLES:
+            days = self.retention.get(table, 0)
+            if days > 0:
+                self.purge(table, column, int(now - days * DAY))
+
+        self.maintenance()
+
+    def compact(self, cutoff):
+        """Compact the data of the complete days older than cutoff, one device and day at a time
+
+        Args:
+            cutoff: the timestamp until the data is compacted
+        Returns:
+           it does not return anything
+
+        """
+        start = self.getWatermark("compact")
+        if start is None:
+            start = self.db.select('''SELECT min(currentTimestamp) FROM data''', [], scalar=1)
+            if not start:
+                return
+            start -= start % DAY
+
+        # The devices with data, also the ones that have never sent their configuration
+        devices = self.db.getDeviceIds("data")
+        if not devices:
+            return
+
+        # Only the complete days are compacted
+        while start + DAY <= cutoff and not self.stopEvent.is_set():
+            for deviceId in devices:
+                if self.stopEvent.is_set():
+                    return
+                self.compactDay(deviceId, start)
+
+            start += DAY
+            self.write([self.watermarkOperation("compact", start)])
+
+    def compactDay(self, deviceId, dayTimestamp):
+        """Replace the rows of every hour of a device and day with a single row
+
+        Args:
+            deviceId: the identifier of the device
+            dayTimestamp: the timestamp of the start of the day
+        Returns:
+           it does not return anything
+
+        """
+        # The samples of each hour, the rows are already ordered by time
+        hours = OrderedDict()
+        for row in self.db.iterate(self.dayQuery, [deviceId, dayTimestamp, dayTimestamp + DAY]):
+            bucket = row["currentTimestamp"] - row["currentTimestamp"] % COMPACT_INTERVAL
+            if bucket not in hours:
+                hours[bucket] = DeviceSamples()
+            hours[bucket].append(row["currentTimestamp"], [row["temperature"], row["humidity"], row["rainPulses"]])
+
+        # The hours with a single row are already compacted
+        hours = OrderedDict((bucket, samples) for bucket, samples in hours.items() if len(samples) > 1)
+        if not hours:
+            return
+
+        rows = []
+        for bucket, data in aggregate(hours).items():
+            temperature, humidity, rainPulses = data.mean
+            rows.append([deviceId, temperature, humidity, rainPulses, data.timestamp])
+
+        # The DELETE is never committed without the rows that replace it
+        deletes = [[deviceId, bucket, bucket + COMPACT_INTERVAL] for bucket in hours]
+        if self.write([('''DELETE FROM data WHERE deviceId = ? AND currentTimestamp >= ? AND currentTimestamp < ?''', deletes),
+                       self.db.dataOperation(rows)], atomic=True):
+            self.compacted += sum(len(samples) for samples in hours.values()) - len(rows)
+
+    def purge(self, table, column, cutoff):
+        """Delete the rows of a table older than cutoff, one day and batchDevices devices at a time
+
+        Args:
+            table: the name of the table
+            column: the name of the column with the timestamp of the rows
+            cutoff: the timestamp until the rows are deleted
+        Returns:
+           it does not return anything
+
+        """
+        start = self.getWatermark(table)
+        if start is None:
+            start = self.db.select('''SELECT min(%s) FROM %s''' % (column, table), [], scalar=1)
+            if not start:
+                return
+
+        devices = self.db.getDeviceIds(table)
+        if not devices:
+            return
+        query = '''DELETE FROM %s WHERE deviceId = ? AND %s < ?''' % (table, column)
+
+        while start < cutoff and not self.stopEvent.is_set():
+            end = min(start - start % DAY + DAY, cutoff)
+
+            for index in range(0, len(devices), self.batchDevices):
+                if self.stopEvent.is_set():
+                    return
+                self.write([(query, [[deviceId, end] for deviceId in devices[index:index + self.batchDevices]])])
+
+            start = end
+            self.write([self.watermarkOperation(table, start)])
+
+    def maintenance(self):
+        """Release the free pages and move the WAL to the database file
+
+        Args:
+            ---
+        Returns:
+           it does not return anything
+
+        """
+        # Only the databases created with auto_vacuum = INCREMENTAL can release pages without a full VACUUM
+        if self.db.select('''PRAGMA auto_vacuum''', [], scalar=1) != 2:
+            logging.debug("RetentionEngine maintenance: auto_vacuum is not incremental, run python database.py <dbPath> <layout> to enable it")
+        else:
+            freePages = self.db.select('''PRAGMA freelist_count''', [], scalar=1)
+            # The writer runs the pragma with executemany, that only steps it once: each execution releases one page
+            pages = min(freePages, self.vacuumPages)
+            if pages and self.write([('''PRAGMA incremental_vacuum(1)''', [[]] * pages)]):
+                logging.info("RetentionEngine maintenance: %s of %s free pages released", pages, freePages)
+
+        # A PASSIVE checkpoint does not wait for the readers, and from a reader connection it does not take the write lock
+        checkpoint = self.db.select('''PRAGMA wal_checkpoint(PASSIVE)''', [])
+        if checkpoint:
+            busy, walFrames, checkpointedFrames = checkpoint[0]
+            logging.debug("RetentionEngine maintenance: %s of %s WAL frames checkpointed", checkpointedFrames, walFrames)
+
+    def getWatermark(self, job):
+        """Get the timestamp until a job has processed the data, or None if it has not run yet"""
+
+        for row in self.db.iterate('''SELECT timestamp FROM retention WHERE job = ?''', [job], 1):
+            return row["timestamp"]
+
+    def watermarkOperation(self, job, timestamp):
+        """Build the operation that saves the timestamp until a job has processed the data"""
+
+        return ('''INSERT OR REPLACE INTO retention (job, timestamp) VALUES (?,?)''', [[job, timestamp]])
+
+    def write(self, batch, atomic=False):
+        """Save a batch with the writer and wait until it is committed
+
+        Args:
+            batch: a list of (query, valuesList) tuples
+            atomic: optional boolean. If true, the writer saves or drops the batch as a whole, it is never split
+        Returns:
+            True if the batch has been saved, False if the engine has been stopped before
+
+        """
+        committed = threading.Event()
+        self.writer.putBatch(batch, block=True, onCommit=committed.set, atomic=atomic)
+
+        while not committed.wait(1):
+            if self.stopEvent.is_set():
+                return False
+
+        return True
+
+    def getStats(self):
+        """Get the metrics of the engine"""
+
+        return {"compactedRows": self.compacted, "lastRetentionTime": self.lastRunTime}
+
+    def stop(self, timeout=60):
+        """Stop the engine after the batch in progress
+
+        Args:
+            timeout: the maximum number of seconds to wait
+        Returns:
+           it does not return anything
+
+        """
+        self.stopEvent.set()
+
+        if self.thread.is_alive():
+            self.thread.join(timeout)
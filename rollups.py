@@ -0,0 +1,40 @@
+# Tablas con los agregados de los datos y el tamano en segundos de sus intervalos
+ROLLUPS = [("dataHourly", 3600), ("dataDaily", 86400)]
+
+FEATURES = ["temperature", "humidity", "rainPulses"]
+
+
+def rollupOperations(aggregates):
+    """Build the operations that add the aggregated data of a flush cycle to the rollup tables.
+       Each row of a rollup table keeps the number of samples, the sum of the means and the
+       extremes of each feature, so it can be updated without reading the data table
+
+    Args:
+        aggregates: a list of (deviceId, Aggregate) tuples
+    Returns:
+        a list of (query, valuesList) tuples to be saved in the same commit as the data
+
+    """
+    operations = []
+
+    for table, interval in ROLLUPS:
+        keys = []
+        updates = []
+        for deviceId, data in aggregates:
+            bucketTimestamp = data.timestamp - data.timestamp % interval
+            keys.append([deviceId, bucketTimestamp])
+
+            values = []
+            for mean, minimum, maximum in zip(data.mean, data.minimum, data.maximum):
+                values.extend([mean, minimum, minimum, maximum, maximum])
+            updates.append(values + [deviceId, bucketTimestamp])
+
+        # Create the row of the interval if it does not exist yet
+        operations.append(('''INSERT OR IGNORE INTO %s (deviceId, bucketTimestamp, samples) VALUES (?,?,0)''' % table, keys))
+
+        assignments = ", ".join('''%(feature)sSum = coalesce(%(feature)sSum, 0) + ?,
+                                   %(feature)sMin = min(coalesce(%(feature)sMin, ?), ?),
+                                   %(feature)sMax = max(coalesce(%(feature)sMax, ?), ?)''' % {"feature": feature} for feature in FEATURES)
+        operations.append(('''UPDATE %s SET samples = samples + 1, %s WHERE deviceId = ? AND bucketTimestamp = ?''' % (table, assignments), updates))
+
+    return operations
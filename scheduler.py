@@ -0,0 +1,215 @@
+import calendar
+import heapq
+import itertools
+import logging
+import queue
+import random
+import threading
+import time
+
+from forecast import parseForecasts, storeOperations
+
+
+class WeatherScheduler():
+    """Descarga de forma periodica las observaciones y predicciones de AEMET en segundo plano.
+
+       Cada tarea se ejecuta cada interval segundos, con un desfase aleatorio de hasta un
+       jitter por uno del intervalo para que las peticiones no coincidan. Las tareas se
+       ejecutan en paralelo en un grupo de workers. Si una tarea falla se reintenta con un
+       backoff exponencial, hasta un maximo de maxBackoff segundos.
+
+       Los datos descargados se acumulan y se guardan todos juntos a traves del DatabaseWriter.
+
+       Args:
+            client: instancia de AemetClient
+            writer: instancia de DatabaseWriter donde se guardan los datos
+            workers: numero de tareas que se ejecutan en paralelo
+            jitter: fraccion del intervalo que se usa como desfase aleatorio
+            retryDelay: segundos hasta el primer reintento de una tarea que ha fallado
+            maxBackoff: segundos maximos hasta el reintento de una tarea que ha fallado
+    """
+
+    def __init__(self, client, writer, workers=4, jitter=0.1, retryDelay=30, maxBackoff=3600):
+
+        self.client = client
+        self.writer = writer
+        self.jitter = jitter
+        self.retryDelay = retryDelay
+        self.maxBackoff = maxBackoff
+
+        # Scheduled tasks: heap of (next run time, sequence, task)
+        self.tasks = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+
+        self.pendingQueue = queue.Queue()
+        self.workQueue = queue.Queue()
+
+        self.stopEvent = threading.Event()
+        self.threads = [threading.Thread(target=self.dispatch, name="WeatherScheduler")]
+        self.threads.extend(threading.Thread(target=self.work, name="WeatherWorker-%s" % index) for index in range(workers))
+
+    def schedule(self, name, interval, function, *args):
+        """Add a periodic task. The first run is done as soon as possible
+
+        Args:
+            name: a name for the task, used in the logs
+            interval: the number of seconds between runs
+            function: a function that returns a list of (query, valuesList) operations with the
+                      data to save or None if it fails
+            args: the arguments for the function
+        Returns:
+           it does not return anything
+
+        """
+        task = {"name": name, "interval": interval, "function": function, "args": args, "failures": 0}
+        self.push(time.time() + random.uniform(0, self.jitter * interval), task)
+
+    def scheduleObservation(self, idema, interval=3600):
+        """Add a periodic download of the observations of a station"""
+
+        self.schedule("observation %s" % idema, interval, observationOperations, self.client, idema)
+
+    def scheduleForecast(self, municipio, interval=3 * 3600):
+        """Add a periodic download of the forecast of a municipality"""
+
+        self.schedule("forecast %s" % municipio, interval, forecastOperations, self.client, municipio)
+
+    def push(self, runTime, task):
+        """Add a task to the heap and wake up the dispatcher"""
+
+        with self.condition:
+            heapq.heappush(self.tasks, (runTime, next(self.sequence), task))
+            self.condition.notify()
+
+    def start(self):
+        """Start the dispatcher and the workers"""
+
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def dispatch(self):
+        """Send the tasks to the workers when they are due and save the downloaded data
+
+        Args:
+            ---
+        Returns:
+           it does not return anything
+
+        """
+        while not self.stopEvent.is_set():
+            with self.condition:
+                now = time.time()
+                while self.tasks and self.tasks[0][0] <= now:
+                    self.workQueue.put(heapq.heappop(self.tasks)[2])
+
+                waitTime = self.tasks[0][0] - now if self.tasks else 60
+                # Wake up at least every second to save the downloaded data
+                self.condition.wait(min(waitTime, 1))
+
+            self.save()
+
+        self.save()
+
+    def work(self):
+        """Run the tasks sent by the dispatcher and reschedule them
+
+        Args:
+            ---
+        Returns:
+           it does not return anything
+
+        """
+        while not self.stopEvent.is_set():
+            try:
+                task = self.workQueue.get(timeout=1)
+            except queue.Empty:
+                continue
+
+            try:
+                operations = task["function"](*task["args"])
+            except Exception as e:
+                logging.error("WeatherScheduler work: Exception in the task: %s. Exception: %s", task["name"], e)
+                operations = None
+
+            if operations is None:
+                # Exponential backoff, up to maxBackoff seconds
+                delay = min(self.retryDelay * 2 ** task["failures"], self.maxBackoff)
+                task["failures"] += 1
+                logging.warning("WeatherScheduler work: The task %s failed %s times. Retrying in %s s", task["name"], task["failures"], delay)
+            else:
+                delay = task["interval"] * random.uniform(1 - self.jitter, 1 + self.jitter)
+                task["failures"] = 0
+                self.pendingQueue.put(operations)
+
+            self.push(time.time() + delay, task)
+
+    def save(self):
+        """Save all the downloaded data with a single writer operation"""
+
+        batch = []
+        while True:
+            try:
+                batch.extend(self.pendingQueue.get_nowait())
+            except queue.Empty:
+                break
+
+        if batch:
+            self.writer.putBatch(batch, block=True)
+
+    def stop(self, timeout=10):
+        """Stop the scheduler, saving the data already downloaded"""
+
+        self.stopEvent.set()
+        with self.condition:
+            self.condition.notify()
+
+        for thread in self.threads:
+            if thread.is_alive():
+                thread.join(timeout)
+
+
+def parseTimestamp(value):
+    """Convert an AEMET UTC date (2018-04-14T10:00:00) to an epoch"""
+
+    return calendar.timegm(time.strptime(value[:19], '%Y-%m-%dT%H:%M:%S'))
+
+
+def observationOperations(client, idema):
+    """Download the observations of a station
+
+    Args:
+        client: instance of AemetClient
+        idema: the identifier of the station
+    Returns:
+        a list with the operation to save the observations or None if they could not be downloaded
+
+    """
+    datos = client.getObservation(idema)
+
+    if datos is None:
+        return
+
+    rows = [[idema, parseTimestamp(dato["fint"]), dato.get("ta"), dato.get("hr"), dato.get("prec"), dato.get("tamin"), dato.get("tamax")]
+            for dato in datos if "fint" in dato]
+
+    return [('''INSERT OR REPLACE INTO observations (idema, observationTimestamp, ta, hr, prec, tamin, tamax) VALUES (?,?,?,?,?,?,?)''', rows)]
+
+
+def forecastOperations(client, municipio):
+    """Download the forecast of a municipality
+
+    Args:
+        client: instance of AemetClient
+        municipio: the identifier of the municipality
+    Returns:
+        a list with the operation to save the forecast or None if it could not be downloaded
+
+    """
+    forecast = client.getForecast(municipio)
+
+    if forecast is None:
+        return
+
+    return storeOperations(parseForecasts([(municipio, forecast)]))
@@ -0,0 +1,427 @@
+import fcntl
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+
+
+# Registro de una muestra, little endian: deviceId (int64), timestamp (double), temperature,
+# humidity y rainPulses (double), crc32 de los campos anteriores (uint32) y relleno hasta 48 bytes.
+# Un registro con el crc incorrecto (a medio escribir o la zona del fichero aun sin usar) marca el final
+SAMPLE = struct.Struct('<qdddd')
+RECORD = struct.Struct('<40sI4x')
+SEGMENT_NAME = re.compile(r'^spool-(\d+)\.bin$')
+SLOT_NAME = re.compile(r'^slot-(\d+)$')
+
+
+class SpoolSegment():
+    """Fichero del spool de tamano fijo, mapeado en memoria.
+
+       Args:
+            path: ruta del fichero
+            capacity: numero de registros del fichero
+    """
+
+    def __init__(self, path, capacity):
+
+        self.path = path
+        self.capacity = capacity
+        self.count = 0
+
+        with open(path, "w+b") as segmentFile:
+            segmentFile.truncate(capacity * RECORD.size)
+            self.map = mmap.mmap(segmentFile.fileno(), capacity * RECORD.size)
+
+    def append(self, sample):
+        """Write a packed sample at the end of the segment
+
+        Args:
+            sample: the bytes of the sample packed with SAMPLE
+        Returns:
+            False if the segment is full
+
+        """
+        if self.count >= self.capacity:
+            return False
+
+        RECORD.pack_into(self.map, self.count * RECORD.size, sample, zlib.crc32(sample) & 0xffffffff)
+        self.count += 1
+        return True
+
+    def sync(self):
+        """Write the modified pages of the segment to disk"""
+
+        try:
+            self.map.flush()
+        except ValueError:
+            # The segment has been released meanwhile
+            pass
+
+    def remove(self):
+        """Close and delete the segment"""
+
+        self.map.close()
+        os.remove(self.path)
+
+
+def readSegment(path):
+    """Read the valid samples saved in a segment file
+
+    Args:
+        path: the path of the segment
+    Returns:
+        a list of (deviceId, timestamp, values) tuples
+
+    """
+    samples = []
+
+    with open(path, "rb") as segmentFile:
+        data = segmentFile.read()
+
+    for offset in range(0, len(data) - RECORD.size + 1, RECORD.size):
+        sample, crc = RECORD.unpack_from(data, offset)
+        if zlib.crc32(sample) & 0xffffffff != crc:
+            break
+
+        deviceId, timestamp, temperature, humidity, rainPulses = SAMPLE.unpack(sample)
+        samples.append((deviceId, timestamp, [temperature, humidity, rainPulses]))
+
+    return samples
+
+
+def segmentFiles(directory):
+    """Get the segment files of a directory
+
+    Args:
+        directory: the directory of a slot
+    Returns:
+        a list with the paths of the segments, in the order they were created
+
+    """
+    sequences = sorted(int(match.group(1)) for match in (SEGMENT_NAME.match(name) for name in os.listdir(directory)) if match)
+    return [os.path.join(directory, "spool-%010d.bin" % sequence) for sequence in sequences]
+
+
+def tryLock(path):
+    """Take an exclusive flock of a file without waiting, creating the file if it does not exist
+
+    Args:
+        path: the path of the lock file
+    Returns:
+        the open lock file, that keeps the lock until it is closed or the process exits, or None if another process has it
+
+    """
+    lockFile = open(path, "a")
+    try:
+        fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        lockFile.close()
+        return
+
+    return lockFile
+
+
+def lockSlot(directory):
+    """Take the lock of a slot directory, creating it if it does not exist
+
+    Args:
+        directory: the directory of the slot
+    Returns:
+        the open lock file, that keeps the lock until it is closed, or None if another process has the slot
+
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    return tryLock(os.path.join(directory, "lock"))
+
+
+class SampleSpool():
+    """Copia en disco de las muestras que todavia no se han guardado en la base de datos.
+
+       Cada muestra que entra en el IngestBuffer se escribe tambien como un registro de tamano
+       fijo en un fichero mapeado en memoria, por lo que escribirla solo cuesta copiar 48 bytes.
+       Si el proceso muere, las paginas ya escritas se quedan en la cache del sistema operativo y
+       llegan al disco igualmente; un thread las sincroniza con el disco cada syncInterval segundos
+       para cubrir tambien un corte de luz.
+
+       Los ficheros se agrupan igual que las generaciones del IngestBuffer: rotate() cierra el grupo
+       actual cuando se intercambia la generacion y lo devuelve, y release() borra ese grupo cuando
+       sus datos ya estan guardados en la base de datos, aunque se guarden en otro orden. Al arrancar,
+       los ficheros que quedan de la ejecucion anterior contienen las muestras que no se llegaron a
+       guardar.
+
+       El siguiente fichero se crea por adelantado desde el thread del spool, por lo que append() y
+       rotate(), que se llaman con el lock del IngestBuffer, solo cambian de fichero sin crearlo.
+
+       Los registros tienen un formato fijo con el deviceId como entero de 64 bits. Las muestras de
+       los dispositivos con otro tipo de identificador no se copian al disco: se cuentan en skipped
+       y se pierden si el proceso muere antes de guardarlas en la base de datos.
+
+       Cada proceso usa un subdirectorio slot-N bloqueado con flock, por lo que durante un reinicio
+       sin corte el proceso nuevo y el anterior no comparten ficheros. Al arrancar se recuperan los
+       ficheros del slot propio y los de los slots que no usa ningun proceso.
+
+       Args:
+            directory: directorio donde se guardan los ficheros
+            capacity: numero de registros de cada fichero
+            syncInterval: segundos entre dos sincronizaciones con el disco
+    """
+
+    def __init__(self, directory, capacity=65536, syncInterval=1.0):
+
+        self.capacity = capacity
+        self.syncInterval = syncInterval
+
+        # Take the first slot that is not used by another process
+        slot = 0
+        while True:
+            self.directory = os.path.join(directory, "slot-%s" % slot)
+            self.lockFile = lockSlot(self.directory)
+            if self.lockFile is not None:
+                break
+            slot += 1
+
+        # Files left by the previous executions, in order
+        self.recovered = segmentFiles(self.directory)
+        self.sequence = int(SEGMENT_NAME.match(os.path.basename(self.recovered[-1])).group(1)) + 1 if self.recovered else 0
+
+        # The slots of the processes that are not running anymore are kept locked until their files are saved
+        self.recoveredLocks = []
+        for name in sorted(os.listdir(directory)):
+            match = SLOT_NAME.match(name)
+            if not match or int(match.group(1)) == slot:
+                continue
+
+            lockFile = lockSlot(os.path.join(directory, name))
+            if lockFile is None:
+                continue
+
+            files = segmentFiles(os.path.join(directory, name))
+            if files:
+                self.recovered.extend(files)
+                self.recoveredLocks.append(lockFile)
+            else:
+                lockFile.close()
+
+        self.lock = threading.Lock()
+        # Groups of segments waiting for their data to be saved, the oldest first
+        self.sealed = deque()
+        self.current = [self.newSegment()]
+        # Next segment, created in advance by the thread of the spool
+        self.spare = self.newSegment()
+        # Samples that can not be written with the fixed layout, such as non numeric deviceIds
+        self.skipped = 0
+
+        self.stopEvent = threading.Event()
+        # Set when the spare segment is used, so the thread creates the next one
+        self.spareUsed = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="SampleSpool")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def segmentPath(self, sequence):
+        """Get the path of the segment with the given sequence number"""
+
+        return os.path.join(self.directory, "spool-%010d.bin" % sequence)
+
+    def newSegment(self):
+        """Create the next segment file"""
+
+        with self.lock:
+            sequence = self.sequence
+            self.sequence += 1
+
+        return SpoolSegment(self.segmentPath(sequence), self.capacity)
+
+    def nextSegment(self):
+        """Get the segment that follows the current one, the spare if it is ready. It must be called with the lock
+
+        Args:
+            ---
+        Returns:
+            the SpoolSegment
+
+        """
+        segment = self.spare
+        self.spare = None
+        self.spareUsed.set()
+
+        if segment is None:
+            # The thread has not created it yet, it is created here
+            segment = SpoolSegment(self.segmentPath(self.sequence), self.capacity)
+            self.sequence += 1
+
+        return segment
+
+    def prepare(self):
+        """Create the spare segment if it has been used"""
+
+        with self.lock:
+            if self.spare is not None:
+                return
+
+        # The file is created without the lock, only this thread sets the spare
+        segment = self.newSegment()
+
+        with self.lock:
+            self.spare = segment
+
+    def append(self, deviceId, timestamp, values):
+        """Write a sample. It must be called with the lock of the IngestBuffer, so the sample is
+           always in the same generation in memory and on disk
+
+        Args:
+            deviceId: the identifier of the device
+            timestamp: the timestamp of the sample
+            values: a list with the temperature, the humidity and the rain pulses
+        Returns:
+           it does not return anything
+
+        """
+        try:
+            sample = SAMPLE.pack(deviceId, timestamp, *values)
+        except (struct.error, TypeError):
+            self.skipped += 1
+            # Only the first one is logged, the rest are counted
+            if self.skipped == 1:
+                logging.warning("SampleSpool append: The samples of the deviceId %r can not be spooled, only 64 bit integer deviceIds are supported", deviceId)
+            return
+
+        if not self.current[-1].append(sample):
+            # The segment is full, continue in a new one of the same group
+            with self.lock:
+                self.current.append(self.nextSegment())
+            self.current[-1].append(sample)
+
+    def rotate(self):
+        """Close the current group of segments and start a new one. It must be called with the lock of
+           the IngestBuffer, when the generation is swapped
+
+        Args:
+            ---
+        Returns:
+           the group of segments closed, to be passed to release() once its data is saved
+
+        """
+        with self.lock:
+            # An empty group keeps its segment, there is nothing to release
+            if not self.current[-1].count and len(self.current) == 1:
+                return []
+
+            group = self.current
+            self.sealed.append(group)
+            self.current = [self.nextSegment()]
+
+        return group
+
+    def release(self, group):
+        """Delete a group of segments, once its data is saved in the database
+
+        Args:
+            group: the group of segments returned by rotate()
+        Returns:
+           it does not return anything
+
+        """
+        with self.lock:
+            # The groups are compared by identity, the empty ones are never sealed
+            for index, sealedGroup in enumerate(self.sealed):
+                if sealedGroup is group:
+                    del self.sealed[index]
+                    break
+            else:
+                return
+
+        for segment in group:
+            segment.remove()
+
+    def replay(self):
+        """Read the samples left by the previous execution
+
+        Args:
+            ---
+        Returns:
+            a list of (deviceId, timestamp, values) tuples, in the order they were received
+
+        """
+        samples = []
+        for path in self.recovered:
+            try:
+                samples.extend(readSegment(path))
+            except (IOError, OSError) as e:
+                logging.error("SampleSpool replay: The file %s could not be read. Exception: %s", path, e)
+
+        return samples
+
+    def discardRecovered(self):
+        """Delete the files left by the previous execution, once their samples are saved"""
+
+        for path in self.recovered:
+            try:
+                os.remove(path)
+            except OSError as e:
+                logging.error("SampleSpool discardRecovered: The file %s could not be deleted. Exception: %s", path, e)
+
+        self.recovered = []
+
+        for lockFile in self.recoveredLocks:
+            lockFile.close()
+        self.recoveredLocks = []
+
+    def sync(self):
+        """Write to disk the segments that still have data not saved in the database"""
+
+        with self.lock:
+            segments = list(self.current)
+            for group in self.sealed:
+                segments.extend(group)
+
+        for segment in segments:
+            segment.sync()
+
+    def run(self):
+        """Create the spare segment when it is used and synchronize the segments periodically, until the spool is closed"""
+
+        nextSync = time.monotonic() + self.syncInterval
+        while not self.stopEvent.is_set():
+            self.spareUsed.wait(max(0, nextSync - time.monotonic()))
+            self.spareUsed.clear()
+            if self.stopEvent.is_set():
+                break
+
+            self.prepare()
+
+            if time.monotonic() >= nextSync:
+                self.sync()
+                nextSync = time.monotonic() + self.syncInterval
+
+    def close(self):
+        """Stop the synchronization and close the segments. The ones that have not been released are kept"""
+
+        self.stopEvent.set()
+        self.spareUsed.set()
+        self.thread.join()
+        self.sync()
+
+        with self.lock:
+            segments = list(self.current)
+            for group in self.sealed:
+                segments.extend(group)
+            if self.spare is not None:
+                segments.append(self.spare)
+                self.spare = None
+
+        for segment in segments:
+            # Nothing to recover from the empty segments
+            if segment.count:
+                segment.map.close()
+            else:
+                segment.remove()
+
+        self.lockFile.close()
@@ -0,0 +1,40 @@
+import logging
+
+# Estaciones y municipios que se usan si no hay una seccion STATIONS en el config.ini
+DEFAULT_STATIONS = ["8523X"]
+DEFAULT_MUNICIPIOS = ["12027"]
+
+
+def parseList(value):
+    """Split a comma or new line separated list of identifiers"""
+
+    return [item.strip() for item in value.replace("\n", ",").split(",") if item.strip()]
+
+
+def readStations(config):
+    """Read the AEMET stations and municipalities from the STATIONS section of the configuration:
+
+           [STATIONS]
+           observations = 8523X, 8500A
+           forecasts = 12027,
+                       12040
+
+    Args:
+        config: the ConfigParser instance with the configuration
+    Returns:
+        a tuple with the list of station identifiers (idema) and the list of municipality identifiers
+
+    """
+    if not config.has_section('STATIONS'):
+        return list(DEFAULT_STATIONS), list(DEFAULT_MUNICIPIOS)
+
+    stations = parseList(config.get('STATIONS', 'observations', fallback=""))
+    municipios = parseList(config.get('STATIONS', 'forecasts', fallback=""))
+
+    # Remove the duplicates keeping the order
+    stations = sorted(set(stations), key=stations.index)
+    municipios = sorted(set(municipios), key=municipios.index)
+
+    logging.info("readStations: %s stations and %s municipalities configured", len(stations), len(municipios))
+
+    return stations, municipios
@@ -0,0 +1,232 @@
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import time
+
+from carrascas import SHARE_GROUP, Carrascas, config
+from database import Database
+
+
+PARTITIONS = ["shared", "hash"]
+
+# Metricas que se combinan con el maximo en lugar de con la suma
+MAX_STATS = ["lastCommitTime"]
+
+
+def runWorker(index, count, partition, statsQueue, stopEvent, statsInterval):
+    """Run an ingest worker until the supervisor stops it
+
+    Args:
+        index: the index of the worker
+        count: the number of workers
+        partition: "shared" to use a shared subscription or "hash" to partition by deviceId
+        statsQueue: multiprocessing queue where the metrics are sent as (index, stats)
+        stopEvent: multiprocessing event set by the supervisor to stop the worker
+        statsInterval: seconds between two metric reports
+    Returns:
+       it does not return anything
+
+    """
+    # The supervisor receives the signals and stops the workers in order
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    # Only the first worker downloads the weather data and serves the queries. Each worker takes its own slot of the spool
+    queryPort = None if index == 0 else 0
+    # With the shared subscription the broker delivers each message to only one of the workers
+    if partition == "shared":
+        worker = Carrascas(shareGroup=SHARE_GROUP, weather=index == 0, queryPort=queryPort)
+    else:
+        worker = Carrascas(shard=(index, count), weather=index == 0, queryPort=queryPort)
+
+    try:
+        while not stopEvent.wait(statsInterval):
+            statsQueue.put((index, worker.getStats()))
+    finally:
+        # Flush the buffer and the writer queue before exiting
+        worker.stop()
+        statsQueue.put((index, worker.getStats()))
+
+    logging.info("runWorker: worker %s stopped", index)
+
+
+class Supervisor():
+    """Lanza varios procesos de ingesta para repartir los mensajes MQTT entre varios cores.
+
+       Cada worker es una instancia de Carrascas con su propio cliente MQTT, buffer y writer.
+       Los mensajes se reparten con una suscripcion compartida ($share/carrascas/...), o bien
+       todos los workers reciben todos los mensajes y cada uno procesa solo los dispositivos de
+       su particion. En ese modo los mensajes de otras particiones se descartan por su topic,
+       antes de decodificarlos, pero cada worker sigue leyendo todo el trafico del broker, por lo
+       que solo la suscripcion compartida reparte tambien la red.
+
+       El supervisor reinicia los workers que terminan de forma inesperada, combina sus metricas
+       y los para de forma ordenada.
+
+       Args:
+            workers: numero de procesos de ingesta
+            partition: "shared" o "hash"
+            statsInterval: segundos entre dos informes de metricas de cada worker
+    """
+
+    def __init__(self, workers, partition="shared", statsInterval=10):
+
+        if partition not in PARTITIONS:
+            raise ValueError("Unknown partition: %s" % partition)
+
+        self.count = workers
+        self.partition = partition
+        self.statsInterval = statsInterval
+
+        self.statsQueue = multiprocessing.Queue()
+        self.stopEvent = multiprocessing.Event()
+        self.stopping = False
+
+        # index -> Process
+        self.processes = {}
+        # index -> last stats received
+        self.stats = {}
+
+    def start(self):
+        """Prepare the database and start the workers
+
+        Args:
+            ---
+        Returns:
+           it does not return anything
+
+        """
+        # Apply the migrations once, before the workers open the database at the same time
+        Database("carrascas.db").close()
+
+        for index in range(self.count):
+            self.startWorker(index)
+
+    def startWorker(self, index):
+        """Start or restart the process of a worker"""
+
+        process = multiprocessing.Process(target=runWorker, name="CarrascasWorker-%s" % index,
+                                          args=(index, self.count, self.partition, self.statsQueue, self.stopEvent, self.statsInterval))
+        process.start()
+        self.processes[index] = process
+
+        logging.info("Supervisor startWorker: worker %s started. pid: %s", index, process.pid)
+
+    def collect(self, timeout):
+        """Receive the metrics sent by the workers
+
+        Args:
+            timeout: seconds to wait for the first report
+        Returns:
+           it does not return anything
+
+        """
+        try:
+            index, stats = self.statsQueue.get(timeout=timeout)
+            self.stats[index] = stats
+            while True:
+                index, stats = self.statsQueue.get_nowait()
+                self.stats[index] = stats
+        except queue.Empty:
+            pass
+
+    def getStats(self):
+        """Get the metrics of all the workers combined
+
+        Args:
+            ---
+        Returns:
+            a dict with the sum of the metrics of the workers and the number of workers alive
+
+        """
+        merged = {"workers": sum(1 for process in self.processes.values() if process.is_alive())}
+
+        for stats in self.stats.values():
+            for key, value in stats.items():
+                if key in MAX_STATS:
+                    merged[key] = max(merged.get(key, 0), value)
+                else:
+                    merged[key] = merged.get(key, 0) + value
+
+        return merged
+
+    def run(self):
+        """Supervise the workers until a SIGINT or SIGTERM is received
+
+        Args:
+            ---
+        Returns:
+           it does not return anything
+
+        """
+        signal.signal(signal.SIGINT, self.handleSignal)
+        signal.signal(signal.SIGTERM, self.handleSignal)
+
+        lastReport = time.time()
+
+        while not self.stopping:
+            self.collect(1)
+
+            for index, process in list(self.processes.items()):
+                if not process.is_alive() and not self.stopping:
+                    logging.error("Supervisor run: worker %s exited with code %s. Restarting it", index, process.exitcode)
+                    self.startWorker(index)
+
+            if time.time() - lastReport >= self.statsInterval:
+                lastReport = time.time()
+                logging.info("Supervisor run: stats: %s", self.getStats())
+
+        self.stop()
+
+    def handleSignal(self, signum, frame):
+        """Mark the supervisor to stop. The workers are stopped from the main loop"""
+
+        self.stopping = True
+
+    def stop(self, timeout=90):
+        """Stop all the workers, waiting for them to save their data
+
+        Args:
+            timeout: seconds to wait for the workers before killing them
+        Returns:
+           it does not return anything
+
+        """
+        self.stopping = True
+        self.stopEvent.set()
+
+        deadline = time.time() + timeout
+        for index, process in self.processes.items():
+            # Keep reading the metrics so the queue does not block the workers while they exit
+            while process.is_alive() and time.time() < deadline:
+                self.collect(0.5)
+                process.join(0.5)
+
+            if process.is_alive():
+                logging.error("Supervisor stop: worker %s did not stop in time. Killing it", index)
+                os.kill(process.pid, signal.SIGKILL)
+                process.join()
+
+        self.collect(0)
+        logging.info("Supervisor stop: final stats: %s", self.getStats())
+
+
+if __name__ == '__main__':
+    # Lanza varios procesos de ingesta:
+    #   python supervisor.py [workers] [shared|hash]
+    import sys
+
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else config.getint('SUPERVISOR', 'workers', fallback=multiprocessing.cpu_count())
+    partition = sys.argv[2] if len(sys.argv) > 2 else config.get('SUPERVISOR', 'partition', fallback="shared")
+
+    if partition not in PARTITIONS:
+        print("Uso: python supervisor.py [workers] [%s]" % "|".join(PARTITIONS))
+        sys.exit(1)
+
+    print("Arrancando %s workers..." % workers)
+    supervisor = Supervisor(workers, partition)
+    supervisor.start()
+    supervisor.run()
+    print("La aplicacion se ha cerrado")
@@ -0,0 +1,54 @@
+import os
+import sys
+import tempfile
+import time
+
+# The modules of carrascas are in the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# carrascas reads the config.ini of the working directory when it is imported, and opens its log there.
+# It is imported here, in a temporary directory, before any test module imports it
+CONFIG = """[AEMET]
+apiKey = test
+
+[INGEST]
+spool =
+
+[QUERY]
+port = 0
+
+[METRICS]
+publishInterval = 0
+
+[LOGGING]
+level = WARNING
+"""
+
+_workingDirectory = os.getcwd()
+os.chdir(tempfile.mkdtemp(prefix="carrascas-tests-"))
+try:
+    with open("config.ini", "w") as configFile:
+        configFile.write(CONFIG)
+    import carrascas  # noqa: F401
+finally:
+    os.chdir(_workingDirectory)
+
+
+def waitUntil(condition, timeout=10, interval=0.01):
+    """Wait until a condition is true
+
+    Args:
+        condition: a function without arguments
+        timeout: the maximum number of seconds to wait
+        interval: seconds between two checks
+    Returns:
+        True if the condition is true, False if the timeout has expired
+
+    """
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(interval)
+
+    return True
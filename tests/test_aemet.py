@@ -0,0 +1,140 @@
+import threading
+import time
+
+import pytest
+
+import aemet
+from aemet import AemetClient
+from fakeaemet import FakeAemet
+
+OBSERVATION_PATH = "/opendata/api/observacion/convencional/datos/estacion/"
+FORECAST_PATH = "/opendata/api/prediccion/especifica/municipio/diaria/"
+
+
+@pytest.fixture
+def fakeAemet():
+    server = FakeAemet()
+    server.start()
+    yield server
+    server.stop()
+
+
+def newClient(fakeAemet, **kwargs):
+    """An AemetClient of the fake API, without the rate limit unless it is given"""
+
+    kwargs.setdefault("minInterval", 0)
+    return AemetClient("test", baseUrl=fakeAemet.baseUrl, timeout=5, **kwargs)
+
+
+def test_observation_and_forecast(fakeAemet):
+    client = newClient(fakeAemet)
+
+    observations = client.getObservation("8523X")
+    assert [observation["idema"] for observation in observations] == ["8523X"] * 3
+    assert client.getForecast("12040")["id"] == "12040"
+
+    # The api key is only sent to the API, not to the urls of the data
+    assert fakeAemet.apiKeys == ["api_key=test", "api_key=test"]
+    assert fakeAemet.count("/datos/") == 2
+
+
+def test_the_session_reuses_the_connection(fakeAemet):
+    client = newClient(fakeAemet)
+
+    for index in range(10):
+        assert client.getObservation("station%s" % index)
+
+    assert fakeAemet.count(OBSERVATION_PATH) == 10
+    assert fakeAemet.connections == 1
+
+
+def test_responses_are_cached_until_they_expire(fakeAemet, monkeypatch):
+    monkeypatch.setattr(aemet, "OBSERVATION_TTL", 0.5)
+    client = newClient(fakeAemet)
+
+    first = client.getObservation("8523X")
+    assert client.getObservation("8523X") is first
+    assert client.getForecast("12040") == client.getForecast("12040")
+    assert fakeAemet.count(OBSERVATION_PATH) == 1
+    assert fakeAemet.count(FORECAST_PATH) == 1
+
+    time.sleep(0.6)
+    assert client.getObservation("8523X") == first
+    assert fakeAemet.count(OBSERVATION_PATH) == 2
+
+
+def test_concurrent_requests_are_coalesced(fakeAemet):
+    fakeAemet.delay = 0.2
+    client = newClient(fakeAemet)
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(client.getObservation("8523X"))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(results) == 8
+    assert all(result is results[0] for result in results)
+    assert fakeAemet.count(OBSERVATION_PATH) == 1
+
+
+def test_requests_are_rate_limited(fakeAemet):
+    client = newClient(fakeAemet, minInterval=0.2)
+
+    startTime = time.time()
+    for idema in ("A", "B", "C", "D"):
+        assert client.getObservation(idema)
+
+    assert time.time() - startTime >= 0.6
+
+
+def test_concurrent_requests_are_limited_per_host(fakeAemet):
+    fakeAemet.delay = 0.2
+    client = newClient(fakeAemet, maxPerHost=2)
+
+    threads = [threading.Thread(target=client.getObservation, args=("station%s" % index, )) for index in range(4)]
+    startTime = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Two requests at a time, each one a metadata request and a data request of 0.2 seconds
+    assert time.time() - startTime >= 0.75
+    assert fakeAemet.count(OBSERVATION_PATH) == 4
+
+
+def test_the_session_keeps_a_connection_per_concurrent_request(fakeAemet):
+    fakeAemet.delay = 0.1
+    client = newClient(fakeAemet, maxPerHost=16)
+
+    for round in range(2):
+        threads = [threading.Thread(target=client.getObservation, args=("station%s-%s" % (round, index), )) for index in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    # The second round reuses the connections of the first one
+    assert fakeAemet.count(OBSERVATION_PATH) == 32
+    assert fakeAemet.connections <= 16
+
+
+def test_server_errors_are_not_cached(fakeAemet):
+    client = newClient(fakeAemet)
+    fakeAemet.failures.add(OBSERVATION_PATH + "8523X")
+
+    assert client.getObservation("8523X") is None
+    assert client.getForecast("12040") is not None
+
+    fakeAemet.failures.clear()
+    assert client.getObservation("8523X")
+    assert fakeAemet.count(OBSERVATION_PATH) == 2
+
+
+def test_connection_errors_return_none(fakeAemet):
+    client = newClient(fakeAemet)
+    fakeAemet.stop()
+
+    assert client.getObservation("8523X") is None
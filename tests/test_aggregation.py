@@ -0,0 +1,143 @@
+import random
+
+import pytest
+
+from aggregation import DeviceSamples, RunningAggregate, aggregateSamples
+
+
+def weightedMean(samples):
+    """The weighted mean of the original getDataFromBuffer, samples is a list of [timestamp, value, ...]"""
+
+    totalTime = samples[-1][0] - samples[0][0]
+    agregatedValues = [0.0] * (len(samples[0]) - 1)
+    for index, sample in enumerate(samples[:-1]):
+        deltaTime = samples[index + 1][0] - sample[0]
+        for feature, value in enumerate(sample[1:]):
+            agregatedValues[feature] += deltaTime * value
+
+    return [value / totalTime for value in agregatedValues]
+
+
+def randomSamples(rng, count):
+    """Build count samples with increasing timestamps, some of them repeated"""
+
+    timestamp = 1523700000
+    samples = []
+    for _ in range(count):
+        timestamp += rng.choice([0, 1, 2, 5])
+        samples.append([timestamp, rng.uniform(-5, 40), rng.uniform(10, 100), rng.randint(0, 3)])
+
+    # The mean is only defined if some time has transcurred
+    samples[-1][0] += 1
+    return samples
+
+
+@pytest.mark.parametrize("reorderWindow", [0, 5])
+def test_ordered_samples_match_the_weighted_mean(reorderWindow):
+    rng = random.Random(reorderWindow)
+
+    for _ in range(100):
+        samples = randomSamples(rng, rng.randint(2, 40))
+        runningAggregate = RunningAggregate(reorderWindow)
+        deviceSamples = DeviceSamples()
+        for sample in samples:
+            runningAggregate.add(sample[0], sample[1:])
+            deviceSamples.append(sample[0], sample[1:])
+
+        result = runningAggregate.result()
+        assert result.timestamp == samples[0][0]
+        assert result.mean == pytest.approx(weightedMean(samples))
+        assert result.count == len(samples)
+        assert result.minimum == [min(sample[index] for sample in samples) for index in (1, 2, 3)]
+        assert result.maximum == [max(sample[index] for sample in samples) for index in (1, 2, 3)]
+        assert result.last == samples[-1][1:]
+        assert runningAggregate.late == 0
+        assert result == aggregateSamples(deviceSamples)
+
+
+def test_out_of_order_samples_inside_the_window_are_reordered():
+    rng = random.Random(1)
+
+    for _ in range(100):
+        # Distinct timestamps, so the ordered series is unique
+        samples = [[1523700000 + index, rng.uniform(-5, 40), rng.uniform(10, 100), rng.randint(0, 3)] for index in range(30)]
+
+        # Every sample arrives at most 3 seconds late
+        arrival = sorted(samples, key=lambda sample: sample[0] + rng.uniform(0, 3))
+        assert arrival != samples
+
+        runningAggregate = RunningAggregate(reorderWindow=5)
+        for sample in arrival:
+            runningAggregate.add(sample[0], sample[1:])
+
+        result = runningAggregate.result()
+        assert runningAggregate.late == 0
+        assert result.timestamp == samples[0][0]
+        assert result.mean == pytest.approx(weightedMean(samples))
+        assert result.last == samples[-1][1:]
+        assert result.count == len(samples)
+
+
+def test_late_samples_outside_the_window_only_count_for_the_extremes():
+    runningAggregate = RunningAggregate(reorderWindow=5)
+    for timestamp in range(100, 120):
+        runningAggregate.add(timestamp, [10.0])
+
+    # 15 seconds older than the newest sample, its interval has already been added
+    runningAggregate.add(104, [-50.0])
+
+    result = runningAggregate.result()
+    assert runningAggregate.late == 1
+    assert result.count == 21
+    assert result.minimum == [-50.0]
+    assert result.maximum == [10.0]
+    assert result.mean == pytest.approx([10.0])
+    assert result.last == [10.0]
+
+
+def test_out_of_order_samples_without_window_are_late():
+    runningAggregate = RunningAggregate()
+    runningAggregate.add(100, [1.0])
+    runningAggregate.add(110, [3.0])
+    runningAggregate.add(105, [100.0])
+    runningAggregate.add(120, [5.0])
+
+    result = runningAggregate.result()
+    assert runningAggregate.late == 1
+    assert result.count == 4
+    assert result.mean == pytest.approx([(10 * 1.0 + 10 * 3.0) / 20])
+    assert result.maximum == [100.0]
+
+
+def test_no_elapsed_time_returns_the_last_value():
+    runningAggregate = RunningAggregate(reorderWindow=5)
+    runningAggregate.add(100, [1.0, 2.0])
+    runningAggregate.add(100, [3.0, 4.0])
+
+    result = runningAggregate.result()
+    assert result.timestamp == 100
+    assert result.mean == [3.0, 4.0]
+    assert result.last == [3.0, 4.0]
+    assert result.count == 2
+
+
+def test_state_does_not_grow_with_the_samples():
+    runningAggregate = RunningAggregate(reorderWindow=5)
+    for timestamp in range(100000):
+        runningAggregate.add(timestamp, [1.0, 2.0, 0.0])
+
+        # Only the samples of the reorder window are retained
+        assert len(runningAggregate.pending) <= 6
+
+    assert len(runningAggregate) == 100000
+
+
+def test_invalid_values_are_rejected_without_changing_the_state():
+    runningAggregate = RunningAggregate(reorderWindow=5)
+    runningAggregate.add(100, [1.0])
+
+    with pytest.raises(ValueError):
+        runningAggregate.add(101, ["invalid"])
+
+    assert len(runningAggregate) == 1
+    assert runningAggregate.result().count == 1
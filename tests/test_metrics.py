@@ -0,0 +1,13 @@
+from metrics import Metrics
+
+
+def test_label_values_and_help_texts_are_escaped():
+    metrics = Metrics()
+    metrics.describe("messages", 'Messages by topic\nwith a \\ in the help')
+    metrics.addCollector(lambda: [("messages", "counter", 3, {"topic": 'carrascas/"1"\\realtime\n'})])
+
+    lines = metrics.render().splitlines()
+
+    assert lines == ['# HELP carrascas_messages Messages by topic\\nwith a \\\\ in the help',
+                     '# TYPE carrascas_messages counter',
+                     'carrascas_messages{topic="carrascas/\\"1\\"\\\\realtime\\n"} 3']
@@ -0,0 +1,54 @@
+import pytest
+
+import carrascas
+from conftest import waitUntil
+from fakebroker import FakeBroker
+
+
+@pytest.fixture
+def broker(tmp_path, monkeypatch):
+    """A FakeBroker that the instances connect to, with the database in tmp_path"""
+
+    monkeypatch.chdir(tmp_path)
+
+    fakeBroker = FakeBroker()
+    fakeBroker.start()
+
+    # Without stations the weather scheduler makes no requests
+    carrascas.config.read_dict({"MQTT": {"host": fakeBroker.host, "port": str(fakeBroker.port)},
+                                "STATIONS": {"observations": "", "forecasts": ""}})
+    try:
+        yield fakeBroker
+    finally:
+        carrascas.config.remove_section("MQTT")
+        carrascas.config.remove_section("STATIONS")
+        fakeBroker.stop()
+
+
+def startInstance():
+    """Start a Carrascas instance with the weather downloads and the retention, and wait until it is subscribed"""
+
+    instance = carrascas.Carrascas(queryPort=0)
+    assert waitUntil(lambda: getattr(instance, 'pendingSubscriptions', None) == set())
+    return instance
+
+
+def test_only_one_process_runs_the_background_jobs_during_a_restart(broker):
+    previous = startInstance()
+    assert waitUntil(lambda: hasattr(previous, 'weatherScheduler'))
+
+    # Both instances are subscribed while they overlap, with a plain subscription by default
+    current = startInstance()
+    assert previous.subscriptionPrefix == current.subscriptionPrefix == ""
+    assert broker.subscriptions() == 6
+    assert not broker.groups
+
+    try:
+        # The new process does not run the weather downloads nor the retention until the previous one exits
+        assert not waitUntil(lambda: hasattr(current, 'weatherScheduler'), timeout=1.5)
+        assert not hasattr(current, 'retentionEngine')
+
+        previous.stop()
+        assert waitUntil(lambda: hasattr(current, 'weatherScheduler') and hasattr(current, 'retentionEngine'))
+    finally:
+        current.stop()
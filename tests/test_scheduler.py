@@ -0,0 +1,104 @@
+import socket
+import time
+
+import pytest
+
+from aemet import AemetClient
+from conftest import waitUntil
+from database import Database
+from fakeaemet import FakeAemet
+from scheduler import WeatherScheduler
+from writer import DatabaseWriter
+
+OBSERVATION_PATH = "/opendata/api/observacion/convencional/datos/estacion/"
+
+# Seconds of each task cycle, much shorter than the first retry
+INTERVAL = 0.05
+RETRY_DELAY = 1
+
+
+@pytest.fixture
+def fakeAemet():
+    server = FakeAemet()
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def writer(tmp_path):
+    db = Database(str(tmp_path / "carrascas.db"))
+    writer = DatabaseWriter(db)
+    yield writer
+    writer.stop()
+    db.close()
+
+
+def startScheduler(client, writer, stations):
+    """Start a WeatherScheduler that downloads the stations every INTERVAL seconds, with a task
+       that counts its cycles
+
+    Args:
+        client: the AemetClient
+        writer: the DatabaseWriter
+        stations: the list of station identifiers
+    Returns:
+        a tuple with the WeatherScheduler and the list where each cycle of the counting task is appended
+
+    """
+    scheduler = WeatherScheduler(client, writer, workers=2, jitter=0, retryDelay=RETRY_DELAY)
+    cycles = []
+    scheduler.schedule("cycles", INTERVAL, lambda: cycles.append(time.time()) or [])
+    for idema in stations:
+        scheduler.scheduleObservation(idema, interval=INTERVAL)
+
+    scheduler.start()
+    return scheduler, cycles
+
+
+def taskFailures(scheduler, name):
+    """Get the consecutive failures of a scheduled task, None if it is running"""
+
+    with scheduler.condition:
+        for _, _, task in scheduler.tasks:
+            if task["name"] == name:
+                return task["failures"]
+
+
+def test_a_station_that_fails_is_retried_with_a_backoff(fakeAemet, writer):
+    fakeAemet.failures.add(OBSERVATION_PATH + "FAIL")
+    client = AemetClient("test", baseUrl=fakeAemet.baseUrl, timeout=5, minInterval=0)
+
+    scheduler, cycles = startScheduler(client, writer, ["FAIL"])
+    try:
+        time.sleep(1.5)
+
+        # The other tasks keep their interval, the failing one is only retried after 1 s and then 2 s
+        assert len(cycles) >= 10
+        assert 1 <= fakeAemet.count(OBSERVATION_PATH + "FAIL") <= 2
+        assert waitUntil(lambda: taskFailures(scheduler, "observation FAIL") in (1, 2))
+
+        # Once the API answers again the station is saved and its backoff reset
+        fakeAemet.failures.clear()
+        assert waitUntil(lambda: writer.db.select('''SELECT count(*) FROM observations WHERE idema = ?''', ["FAIL"], scalar=1) > 0)
+        assert waitUntil(lambda: taskFailures(scheduler, "observation FAIL") == 0)
+    finally:
+        scheduler.stop()
+
+
+def test_a_station_that_can_not_be_reached_is_retried_with_a_backoff(writer):
+    # A port where nobody listens, every request fails to connect
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    port = listener.getsockname()[1]
+    listener.close()
+    client = AemetClient("test", baseUrl="http://127.0.0.1:%s/opendata/api/" % port, timeout=5, minInterval=0)
+
+    scheduler, cycles = startScheduler(client, writer, ["8523X"])
+    try:
+        time.sleep(1.5)
+
+        assert len(cycles) >= 10
+        assert waitUntil(lambda: taskFailures(scheduler, "observation 8523X") in (1, 2))
+    finally:
+        scheduler.stop()
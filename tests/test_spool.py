@@ -0,0 +1,80 @@
+import os
+import threading
+
+import spool
+from conftest import waitUntil
+from ingest import IngestBuffer
+from spool import SampleSpool
+
+
+def newSpool(tmp_path, capacity=4):
+    """A SampleSpool with small segments, its spare segment already created"""
+
+    sampleSpool = SampleSpool(str(tmp_path / "spool"), capacity=capacity, syncInterval=60)
+    assert waitUntil(lambda: sampleSpool.spare is not None)
+    return sampleSpool
+
+
+def test_release_only_deletes_the_group_of_its_generation(tmp_path):
+    sampleSpool = newSpool(tmp_path)
+    buffer = IngestBuffer(0, sampleSpool)
+
+    buffer.append(1, 100.0, [20.0, 50.0, 0])
+    _, first = buffer.swap()
+    buffer.append(2, 200.0, [21.0, 51.0, 1])
+    _, second = buffer.swap()
+
+    # An empty generation has nothing to release and releasing it does not touch the others
+    _, empty = buffer.swap()
+    sampleSpool.release(empty)
+    assert [group for group in sampleSpool.sealed] == [first, second]
+
+    # The second generation is committed before the first one
+    sampleSpool.release(second)
+    assert not any(os.path.exists(segment.path) for segment in second)
+    assert all(os.path.exists(segment.path) for segment in first)
+    sampleSpool.close()
+
+    # Only the samples of the first generation are recovered
+    recovered = SampleSpool(str(tmp_path / "spool"))
+    assert recovered.replay() == [(1, 100.0, [20.0, 50.0, 0.0])]
+    recovered.close()
+
+
+def test_full_segments_and_swaps_do_not_create_files_in_the_ingest_thread(tmp_path, monkeypatch):
+    sampleSpool = newSpool(tmp_path)
+    creators = []
+    segmentClass = spool.SpoolSegment
+
+    def recordedSegment(path, capacity):
+        creators.append(threading.current_thread())
+        return segmentClass(path, capacity)
+
+    monkeypatch.setattr(spool, "SpoolSegment", recordedSegment)
+    buffer = IngestBuffer(0, sampleSpool)
+
+    # Each generation fills a segment and continues in the next one
+    for generation in range(3):
+        for index in range(6):
+            buffer.append(1, generation * 10.0 + index, [20.0, 50.0, 0])
+            assert waitUntil(lambda: sampleSpool.spare is not None)
+        buffer.swap()
+        assert waitUntil(lambda: sampleSpool.spare is not None)
+
+    assert creators
+    assert threading.current_thread() not in creators
+    sampleSpool.close()
+
+
+def test_samples_with_deviceIds_that_are_not_integers_are_counted(tmp_path):
+    sampleSpool = newSpool(tmp_path)
+    buffer = IngestBuffer(0, sampleSpool)
+
+    buffer.append("sensor-1", 100.0, [20.0, 50.0, 0])
+    buffer.append(1, 100.0, [20.0, 50.0, 0])
+
+    # The sample is still buffered in memory, it is only missing on disk
+    generation, _ = buffer.swap()
+    assert sorted(generation, key=str) == [1, "sensor-1"]
+    assert sampleSpool.skipped == 1
+    sampleSpool.close()
@@ -0,0 +1,110 @@
+import os
+import time
+
+import pytest
+
+import carrascas
+from bench import DeviceFleet
+from conftest import waitUntil
+from database import Database
+from fakebroker import FakeBroker
+from supervisor import Supervisor
+
+# Workers of the scaling test, it needs a core for each one and another for the broker
+SCALING_WORKERS = 4
+
+
+@pytest.fixture
+def broker(tmp_path, monkeypatch):
+    """A FakeBroker that the workers connect to, with the database in tmp_path"""
+
+    monkeypatch.chdir(tmp_path)
+
+    fakeBroker = FakeBroker()
+    fakeBroker.start()
+
+    # The workers are forked, they inherit the configuration. Without stations the weather worker makes no requests
+    carrascas.config.read_dict({"MQTT": {"host": fakeBroker.host, "port": str(fakeBroker.port)},
+                                "STATIONS": {"observations": "", "forecasts": ""}})
+    try:
+        yield fakeBroker
+    finally:
+        carrascas.config.remove_section("MQTT")
+        carrascas.config.remove_section("STATIONS")
+        fakeBroker.stop()
+
+
+def runSupervisor(broker, workers, partition, devices, messages, timeout=60):
+    """Start the workers, publish the messages of a fleet and stop them once every message is processed
+
+    Args:
+        broker: the FakeBroker
+        workers: number of worker processes
+        partition: "shared" or "hash"
+        devices: number of devices
+        messages: number of realtime messages
+        timeout: maximum seconds to wait for the messages to be processed
+    Returns:
+        a (supervisor, seconds until the messages were processed) tuple
+
+    """
+    supervisor = Supervisor(workers, partition, statsInterval=0.1)
+    supervisor.start()
+
+    try:
+        # Every worker subscribes to the conf, realtime and binary topics
+        assert waitUntil(lambda: broker.subscriptions() == 3 * workers, timeout=30)
+
+        fleet = DeviceFleet(None, devices=devices)
+        broker.publish([fleet.confMessage(deviceId) for deviceId in range(devices)])
+
+        startTime = time.time()
+        for index in range(0, messages, 1000):
+            broker.publish([fleet.realtimeMessage(deviceId % devices) for deviceId in range(index, min(index + 1000, messages))])
+
+        deadline = startTime + timeout
+        while supervisor.getStats().get("received", 0) < messages and time.time() < deadline:
+            supervisor.collect(0.1)
+        elapsedTime = time.time() - startTime
+    finally:
+        supervisor.stop()
+
+    return supervisor, elapsedTime
+
+
+@pytest.mark.parametrize("partition", ["shared", "hash"])
+def test_every_message_is_processed_once(broker, partition):
+    devices = 50
+    messages = 5000
+
+    supervisor, _ = runSupervisor(broker, 3, partition, devices, messages)
+
+    stats = supervisor.getStats()
+    assert stats["received"] == messages
+    assert stats.get("batchDropped", 0) == 0
+    assert stats.get("dropped", 0) == 0
+
+    # Every worker has processed part of the messages
+    assert len(supervisor.stats) == 3
+    assert all(workerStats["received"] > 0 for workerStats in supervisor.stats.values())
+
+    # The shared subscription delivers each message to a single worker, with the partitions every worker receives all of them
+    copies = 1 if partition == "shared" else 3
+    assert broker.delivered == (devices + messages) * copies
+
+    db = Database("carrascas.db")
+    assert db.select('''SELECT count(*) FROM devices''', [], scalar=1) == devices
+    assert db.select('''SELECT count(DISTINCT deviceId) FROM data''', [], scalar=1) == devices
+    db.close()
+
+
+@pytest.mark.skipif((os.cpu_count() or 1) <= SCALING_WORKERS, reason="needs more than %s cores" % SCALING_WORKERS)
+def test_throughput_scales_with_the_workers(broker):
+    messages = 200000
+
+    _, single = runSupervisor(broker, 1, "shared", 1000, messages)
+    supervisor, parallel = runSupervisor(broker, SCALING_WORKERS, "shared", 1000, messages)
+
+    assert supervisor.getStats()["received"] == messages
+    # Near linear, the broker and the publisher share the machine with the workers
+    assert single / parallel >= 0.6 * SCALING_WORKERS
@@ -0,0 +1,138 @@
+import sqlite3
+import threading
+import time
+
+import carrascas
+from bench import DeviceFleet, FakeClient, percentiles
+from conftest import waitUntil
+from database import Database
+from writer import DatabaseWriter
+
+# Seconds that the database is locked by another connection. The original loop retried
+# in the MQTT thread for as long as the lock lasted
+LOCK_SECONDS = 3
+# Milliseconds that the writer waits for the lock before its commit fails. Much shorter than
+# LOCK_SECONDS, so the writer goes through its retries and backoff instead of waiting in SQLite
+BUSY_TIMEOUT = 100
+
+
+def startInstance(monkeypatch, tmp_path):
+    """Start a Carrascas instance connected to a FakeClient, with its database in tmp_path"""
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(carrascas.mqtt, "Client", FakeClient)
+
+    instance = carrascas.Carrascas(weather=False, queryPort=0)
+    assert waitUntil(lambda: getattr(instance, 'pendingSubscriptions', None) == set())
+
+    return instance
+
+
+def flush(instance, devices=None):
+    """Save the buffered samples and wait until they are committed
+
+    Args:
+        instance: the Carrascas instance
+        devices: optional list where the number of devices of the generation saved is appended
+    Returns:
+        an Event that is set once the samples are committed
+
+    """
+    committed = threading.Event()
+    generation, _ = instance.dataBuffer.swap()
+    if devices is not None:
+        devices.append(len(generation))
+    instance.saveGeneration(generation, committed.set)
+    return committed
+
+
+def test_callback_latency_stays_flat_while_the_database_is_locked(monkeypatch, tmp_path):
+    instance = startInstance(monkeypatch, tmp_path)
+    client = instance.client
+
+    try:
+        fleet = DeviceFleet(client, devices=100, rate=2000)
+        fleet.sendConf()
+        fleet.send(2000)
+        client.wait()
+        assert waitUntil(lambda: instance.batcher.processed >= 2000)
+        assert flush(instance).wait(10)
+        unlocked = list(client.callbackTimes)
+
+        savedRows = instance.db.select('''SELECT count(*) FROM data''', [], scalar=1)
+
+        # Another process holds the write lock, the readers still work in WAL mode
+        instance.db.conn.execute("PRAGMA busy_timeout = %s" % BUSY_TIMEOUT)
+        lock = sqlite3.connect("carrascas.db", isolation_level=None)
+        lock.execute("BEGIN EXCLUSIVE")
+        written = instance.writer.written
+
+        # New devices are registered and the samples flushed while it is locked
+        newFleet = DeviceFleet(client, devices=200, rate=2000, seed=1)
+        newFleet.sendConf()
+        lockedDevices = []
+        flusher = threading.Timer(LOCK_SECONDS / 2.0, flush, [instance, lockedDevices])
+        flusher.start()
+        newFleet.run(LOCK_SECONDS)
+        client.wait()
+        flusher.join()
+        locked = list(client.callbackTimes)[len(unlocked):]
+
+        assert instance.writer.written == written
+        retries = instance.writer.retries
+        lock.execute("COMMIT")
+        lock.close()
+
+        # The generation flushed during the lock is saved by a retry once it is released
+        assert waitUntil(lambda: instance.db.select('''SELECT count(*) FROM data''', [], scalar=1) == savedRows + lockedDevices[0])
+    finally:
+        instance.stop()
+
+    # The writer retried with its backoff while the lock lasted
+    assert retries > 0
+
+    # The callbacks never waited for the lock
+    assert len(locked) >= LOCK_SECONDS * 1000
+    assert max(locked) < 0.5
+    assert percentiles(locked)["p99"] < max(0.01, 5 * percentiles(unlocked)["p99"])
+    assert client.dropped == 0
+    assert instance.batcher.dropped == 0
+    assert instance.writer.dropped == 0
+
+    # Everything queued during the lock is saved once it is released
+    assert instance.db.select('''SELECT count(*) FROM devices''', [], scalar=1) == 200
+    assert instance.db.select('''SELECT count(DISTINCT deviceId) FROM data''', [], scalar=1) == 200
+    instance.db.close()
+
+
+def test_rows_that_always_fail_are_dropped(tmp_path):
+    db = Database(str(tmp_path / "carrascas.db"))
+    writer = DatabaseWriter(db)
+
+    rows = [[1, 21.5, 60.0, 0, 100], [2, 21.5, 60.0, 0, 100], [3, 21.5, 2 ** 70, 0, 100], [4, 21.5, 60.0, 0, 100]]
+    committed = threading.Event()
+    writer.putBatch([db.dataOperation(rows)], onCommit=committed.set)
+    assert committed.wait(10)
+    writer.stop()
+
+    assert writer.written == 3
+    assert writer.dropped == 1
+    assert [row["deviceId"] for row in db.select('''SELECT deviceId FROM data ORDER BY deviceId''', [])] == [1, 2, 4]
+    db.close()
+
+
+def test_atomic_batches_are_never_split(tmp_path):
+    db = Database(str(tmp_path / "carrascas.db"))
+    writer = DatabaseWriter(db)
+    db.insertBatch([db.dataOperation([[1, 20.0, 50.0, 0, 100], [1, 21.0, 51.0, 0, 160]])])
+
+    # A compaction that fails after its DELETE, committed together with a plain batch
+    compaction = [('''DELETE FROM data WHERE deviceId = ?''', [[1]]), db.dataOperation([[1, 20.5, 2 ** 70, 0, 160]])]
+    writer.commit([db.dataOperation([[2, 21.5, 60.0, 0, 100]])], [compaction])
+    writer.stop()
+
+    # The DELETE is dropped with the INSERT, the plain batch is saved
+    assert writer.written == 1
+    assert writer.dropped == 2
+    assert [(row["deviceId"], row["currentTimestamp"]) for row in db.select('''SELECT deviceId, currentTimestamp FROM data ORDER BY deviceId, currentTimestamp''', [])] == [(1, 100), (1, 160), (2, 100)]
+    db.close()
@@ -5,12 +5,21 @@ import logging
 import git
 import os
 import signal
+import sys
 
 
 logging.basicConfig(filename='updater.log', level=logging.INFO, filemode="w")
 
-# Definiemos el comando a ejecutar
-cmd = 'python carrascas.py'
+# Definiemos el comando a ejecutar, con el mismo interprete (Python 3) que el updater. Se ejecuta sin
+# shell para que las senales lleguen directamente al proceso y poder esperar a que termine de guardar sus datos
+cmd = [sys.executable, 'carrascas.py']
+
+# Fichero donde el proceso nuevo indica que ya esta suscrito y recibiendo mensajes
+READY_FILE = 'carrascas.ready'
+# Tiempo maximo que se espera a que el proceso nuevo este listo
+READY_TIMEOUT = 120
+# Tiempo maximo que se espera a que el proceso anterior guarde sus datos
+STOP_TIMEOUT = 120
 
 
 def runProcess():
@@ -21,7 +30,103 @@ def runProcess():
     Returns:
         El proceso que se acaba de arrancar
     """
-    return subprocess.Popen(cmd, stdout=subprocess.PIPE, shell=True, preexec_fn=os.setsid)
+    # Borramos el aviso del proceso anterior
+    if os.path.exists(READY_FILE):
+        os.remove(READY_FILE)
+
+    env = dict(os.environ, CARRASCAS_READY_FILE=READY_FILE)
+    return subprocess.Popen(cmd, stdout=subprocess.PIPE, preexec_fn=os.setsid, env=env)
+
+
+def waitReady(process, timeout):
+    """Espera a que el proceso indique que esta suscrito a los topicos
+
+    Args:
+        process: proceso a esperar
+        timeout: tiempo maximo en segundos
+    Returns:
+        El momento (epoch) en que el proceso estuvo listo o None si ha terminado o no esta listo a tiempo
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            return
+
+        try:
+            with open(READY_FILE) as f:
+                return float(f.read().split()[1])
+        except (IOError, OSError, IndexError, ValueError):
+            time.sleep(0.1)
+
+
+def stopProcess(process, timeout):
+    """Para el proceso con un SIGTERM, con el que guarda los datos que tiene en memoria, o lo mata
+       si no ha terminado pasado el timeout
+
+    Args:
+        process: proceso a parar
+        timeout: tiempo maximo en segundos
+    Returns:
+        El momento (epoch) en que se ha enviado el SIGTERM
+    """
+    stopTime = time.time()
+    try:
+        os.killpg(os.getpgid(process.pid), signal.SIGTERM)
+    except Exception as e:
+        logging.info(
+            'No se ha podido matar el proceso. Excepcion: %s', e)
+        return stopTime
+
+    deadline = time.time() + timeout
+    while process.poll() is None and time.time() < deadline:
+        time.sleep(0.1)
+
+    if process.poll() is None:
+        logging.error('El proceso no ha terminado en %s s, lo matamos', timeout)
+        try:
+            os.killpg(os.getpgid(process.pid), signal.SIGKILL)
+        except Exception as e:
+            logging.info(
+                'No se ha podido matar el proceso. Excepcion: %s', e)
+
+    return stopTime
+
+
+def restartProcess(process):
+    """Reinicia el proceso sin dejar de recibir datos: arranca el proceso nuevo, espera a que este
+       suscrito a los topicos y solo entonces para el anterior, que guarda sus datos antes de salir.
+       Si el proceso nuevo no llega a estar listo se mantiene el anterior
+
+    Args:
+        process: proceso actual
+    Returns:
+        El proceso que queda corriendo
+    """
+    # Si el proceso anterior no esta corriendo no hay nada que traspasar
+    if process.poll() is not None:
+        return runProcess()
+
+    startTime = time.time()
+    newProcess = runProcess()
+    readyTime = waitReady(newProcess, READY_TIMEOUT)
+
+    if readyTime is None:
+        logging.error('El proceso nuevo no ha llegado a estar listo, mantenemos el anterior')
+        if newProcess.poll() is None:
+            stopProcess(newProcess, STOP_TIMEOUT)
+        return process
+
+    stopTime = stopProcess(process, STOP_TIMEOUT)
+
+    # Los dos procesos estan suscritos a la vez entre que el nuevo esta listo y el anterior se desconecta,
+    # por lo que no hay ningun hueco en los datos recibidos. Si el broker soporta suscripciones compartidas y se
+    # configura [MQTT] shareGroup, el broker entrega cada mensaje a uno solo de los dos y no se duplican.
+    # Las descargas de AEMET y la retencion solo las ejecuta el proceso que tiene el lock de JOBS_LOCK
+    logging.info('Reinicio sin corte: proceso nuevo listo en %.3f s, ambos procesos suscritos durante %.3f s, '
+                 'proceso anterior parado y con sus datos guardados en %.3f s',
+                 readyTime - startTime, stopTime - readyTime, time.time() - stopTime)
+
+    return newProcess
 
 
 def isSourceCodeUpdated(repo):
@@ -44,7 +149,7 @@ def isSourceCodeUpdated(repo):
             #logging.info('isSourceCodeUpdated: ref: %s' % info.refe)
             sourceCodeUpdated = info.old_commit != None or sourceCodeUpdated
     except Exception as e:
-        logging.error('Excepcion al recuperar los ultimos commits. Excepcion: %s' % e)
+        logging.error('Excepcion al recuperar los ultimos commits. Excepcion: %s', e)
 
     # Si se ha actualizado el codigo lo indicamos en el log
     if sourceCodeUpdated:
@@ -87,16 +192,10 @@ try:
             logging.info('Reiniciamos el proceso...')
             # Recuperamos la nueva version del codigo
             g.pull()
-            # Matamos el proceso actual
-            try:
-                os.killpg(os.getpgid(process.pid), signal.SIGTERM)
-            except Exception as e:
-                logging.info(
-                    'No se ha podido matar el proceso. Excepcion: %s' % e)
-            # Rearrancamos el proceso
-            process = runProcess()
+            # Arrancamos el proceso nuevo y paramos el anterior cuando el nuevo este listo
+            process = restartProcess(process)
         # Dormimos durante un tiempo
         time.sleep(60)
 
 except KeyboardInterrupt:
-    print 'El usuario cierra la aplicacion...'
+    print('El usuario cierra la aplicacion...')
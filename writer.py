@@ -0,0 +1,278 @@
+import logging
+import queue
+import threading
+import time
+
+from database import isTransientError
+
+
+class DatabaseWriter():
+    """Unico punto de escritura en la base de datos.
+
+       Las escrituras se encolan en una cola acotada y un thread dedicado las guarda.
+       Cada vez que el thread se despierta recoge todo lo que haya en la cola (hasta batchSize
+       elementos encolados) y lo guarda con un unico commit. Si el commit falla porque la base de
+       datos esta bloqueada, el grupo entero se reintenta con un backoff exponencial. Cualquier otro
+       error se repetiria siempre, asi que el grupo se divide en mitades hasta aislar las filas que
+       fallan, que se descartan (y se cuentan en dropped) para no bloquear al resto. Las operaciones
+       encoladas como atomicas (por ejemplo un DELETE y el INSERT que lo sustituye) no se dividen
+       nunca: se guardan o se descartan enteras.
+
+       Si la cola esta llena, put() descarta la operacion (y la cuenta en dropped) o espera,
+       segun se le indique. Asi los callbacks del MQTT nunca esperan a la base de datos.
+
+       Args:
+            db: instancia de Database donde se guardan los datos
+            maxSize: numero maximo de elementos en la cola
+            batchSize: numero maximo de elementos encolados que se guardan en un mismo commit
+            metrics: opcional, instancia de Metrics donde se guarda la duracion de cada commit
+    """
+
+    def __init__(self, db, maxSize=10000, batchSize=1000, metrics=None):
+
+        self.db = db
+        self.batchSize = batchSize
+        self.metrics = metrics
+        self.queue = queue.Queue(maxSize)
+
+        # Metrics
+        self.statsLock = threading.Lock()
+        self.enqueued = 0
+        self.dropped = 0
+        self.written = 0
+        self.commits = 0
+        self.retries = 0
+        self.lastCommitTime = 0.0
+
+        self.stopEvent = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="DatabaseWriter")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, query, valuesList, block=False, timeout=None):
+        """Queue a write operation
+
+        Args:
+            query: a string with the query to execute
+            valuesList: a list of arrays, the query is executed with each one of them
+            block: optional boolean. If true, wait until there is room in the queue
+            timeout: optional, the maximum number of seconds to wait if block is true
+        Returns:
+            True if the operation has been queued, False if it has been dropped because the queue is full
+
+        """
+        return self.putBatch([(query, valuesList)], block, timeout)
+
+    def putBatch(self, batch, block=False, timeout=None, onCommit=None, atomic=False):
+        """Queue a group of write operations that are always saved in the same commit
+
+        Args:
+            batch: a list of (query, valuesList) tuples
+            block: optional boolean. If true, wait until there is room in the queue
+            timeout: optional, the maximum number of seconds to wait if block is true
+            onCommit: optional function called without arguments from the writer thread once the operations are saved
+            atomic: optional boolean. If true, the operations are never split if the commit fails: they are all saved or all dropped
+        Returns:
+            True if the operations have been queued, False if they have been dropped because the queue is full
+
+        """
+        try:
+            self.queue.put((batch, onCommit, atomic), block, timeout)
+        except queue.Full:
+            with self.statsLock:
+                self.dropped += 1
+            logging.error("DatabaseWriter putBatch: The queue is full, operation dropped. Dropped: %s", self.dropped)
+            return False
+
+        with self.statsLock:
+            self.enqueued += 1
+        return True
+
+    def run(self):
+        """Save the queued operations until the writer is stopped and the queue is empty
+
+        Args:
+            ---
+        Returns:
+           it does not return anything
+
+        """
+        while not self.stopEvent.is_set() or not self.queue.empty():
+            try:
+                item = self.queue.get(timeout=1)
+            except queue.Empty:
+                continue
+
+            batch = []
+            atomicBatches = []
+            callbacks = []
+
+            # Group everything already queued in the same commit
+            items = 0
+            while True:
+                operations, onCommit, atomic = item
+                if atomic:
+                    atomicBatches.append(list(operations))
+                else:
+                    batch.extend(operations)
+                if onCommit:
+                    callbacks.append(onCommit)
+
+                items += 1
+                if items >= self.batchSize:
+                    break
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+
+            self.commit(batch, atomicBatches)
+
+            for callback in callbacks:
+                try:
+                    callback()
+                except Exception as e:
+                    logging.error("DatabaseWriter run: Exception in a commit callback. Exception: %s", e)
+
+    def commit(self, batch, atomicBatches=()):
+        """Save a group of operations with a single commit. If it fails with an error that a retry
+           does not fix, the operations are saved in smaller groups dropping the rows that fail.
+           Each atomic batch is then saved in its own commit, or dropped as a whole
+
+        Args:
+            batch: a list of (query, valuesList) tuples
+            atomicBatches: optional, a list of batches that can not be split
+        Returns:
+           it does not return anything
+
+        """
+        rows = sum(len(valuesList) for _, valuesList in batch)
+
+        startTime = time.time()
+        if self.save(batch + [operation for atomicBatch in atomicBatches for operation in atomicBatch]):
+            written = rows + sum(len(valuesList) for atomicBatch in atomicBatches for _, valuesList in atomicBatch)
+        else:
+            # The failure may come from an atomic batch, the rest is saved as it is if it can be
+            if batch and atomicBatches and self.save(batch):
+                written = rows
+            else:
+                written = self.split(batch) if batch else 0
+            for atomicBatch in atomicBatches:
+                written += self.saveAtomic(atomicBatch)
+
+        self.lastCommitTime = time.time() - startTime
+        self.commits += 1
+        self.written += written
+
+        if self.metrics is not None:
+            self.metrics.observe("commit_seconds", self.lastCommitTime)
+
+        logging.info("DatabaseWriter commit: %s rows written. Commit time: %.3f s. Queued: %s", written, self.lastCommitTime, self.queue.qsize())
+
+    def save(self, batch):
+        """Save a group of operations with a single commit, retrying with an exponential backoff while the database is locked
+
+        Args:
+            batch: a list of (query, valuesList) tuples
+        Returns:
+            True if the operations have been saved, False if they have failed with an error that a retry does not fix
+
+        """
+        retries = 0
+        retryDelay = 0.5
+        while not self.db.insertBatch(batch):
+            if not isTransientError(self.db.lastError):
+                return False
+
+            retries += 1
+            with self.statsLock:
+                self.retries += 1
+            logging.error("DatabaseWriter save: Reintentando guardar los datos... Intento: %s. Error: %s", retries, self.db.lastError)
+            time.sleep(retryDelay)
+            retryDelay = min(retryDelay * 2, 30)
+
+        return True
+
+    def saveAtomic(self, batch):
+        """Save a batch that can not be split in its own commit, dropping it as a whole if it fails
+
+        Args:
+            batch: a list of (query, valuesList) tuples
+        Returns:
+            the number of rows saved
+
+        """
+        rows = sum(len(valuesList) for _, valuesList in batch)
+
+        if self.save(batch):
+            return rows
+
+        with self.statsLock:
+            self.dropped += rows
+        logging.error("DatabaseWriter saveAtomic: Atomic batch of %s rows dropped, it can not be saved. Error: %s. Dropped: %s", rows, self.db.lastError, self.dropped)
+        return 0
+
+    def split(self, batch):
+        """Save the rows of a group that has failed in two halves, recursively, until the rows that fail are isolated and dropped
+
+        Args:
+            batch: a list of (query, valuesList) tuples
+        Returns:
+            the number of rows saved
+
+        """
+        rows = [(query, values) for query, valuesList in batch for values in valuesList]
+
+        if len(rows) <= 1:
+            with self.statsLock:
+                self.dropped += len(rows)
+            logging.error("DatabaseWriter split: Row dropped, it can not be saved. Error: %s. Dropped: %s", self.db.lastError, self.dropped)
+            logging.debug("DatabaseWriter split: Row dropped: %s", rows)
+            return 0
+
+        written = 0
+        middle = len(rows) // 2
+        for half in (rows[:middle], rows[middle:]):
+            # Join again the consecutive rows of the same query
+            halfBatch = []
+            for query, values in half:
+                if halfBatch and halfBatch[-1][0] == query:
+                    halfBatch[-1][1].append(values)
+                else:
+                    halfBatch.append((query, [values]))
+
+            if self.save(halfBatch):
+                written += len(half)
+            else:
+                written += self.split(halfBatch)
+
+        return written
+
+    def getStats(self):
+        """Get the writer metrics
+
+        Args:
+            ---
+        Returns:
+            a dict with the metrics of the writer
+
+        """
+        return {"queued": self.queue.qsize(),
+                "enqueued": self.enqueued,
+                "dropped": self.dropped,
+                "written": self.written,
+                "commits": self.commits,
+                "retries": self.retries,
+                "lastCommitTime": self.lastCommitTime}
+
+    def stop(self, timeout=60):
+        """Stop the writer once all the queued operations have been saved
+
+        Args:
+            timeout: the maximum number of seconds to wait
+        Returns:
+           it does not return anything
+
+        """
+        self.stopEvent.set()
+        self.thread.join(timeout)